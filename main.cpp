@@ -25,6 +25,10 @@ const String AWS_TIMESTAMP_URL = "https://your-api-id.execute-api.us-west-2.amaz
 const String AWS_ALARM_URL = "https://your-api-id.execute-api.us-west-2.amazonaws.com/dev/upcoming-alarms";
 const String AWS_DISMISS_URL = "https://your-api-id.execute-api.us-west-2.amazonaws.com/dev/dismiss-alarm";
 
+// Last schedule and its ETag; the server answers 304 while they are current
+String alarmsETag = "";
+String alarmsPayload = "";
+
 Adafruit_SSD1306 display(128, 64, &Wire, -1);  // Define OLED display
 
 void setup() {
@@ -125,11 +129,23 @@ void sendTimestampToAWS() {
 void getUpcomingAlarms() {
   HTTPClient http;
   http.begin(AWS_ALARM_URL);
+  const char* headerKeys[] = {"ETag"};
+  http.collectHeaders(headerKeys, 1);
+  if (alarmsETag.length() > 0) {
+    http.addHeader("If-None-Match", alarmsETag);
+  }
   int httpCode = http.GET();
-  if (httpCode > 0) {
-    String payload = http.getString();
+  if (httpCode == HTTP_CODE_NOT_MODIFIED) {
+    Serial.println("Upcoming alarms (unchanged):");
+    Serial.println(alarmsPayload);
+  } else if (httpCode == HTTP_CODE_OK) {
+    alarmsPayload = http.getString();
+    alarmsETag = http.header("ETag");
     Serial.println("Upcoming alarms:");
-    Serial.println(payload);
+    Serial.println(alarmsPayload);
+  } else if (httpCode > 0) {
+    // Errors keep the last good schedule and ETag
+    Serial.println("Error getting alarms: HTTP " + String(httpCode));
   } else {
     Serial.println("Error getting alarms.");
   }
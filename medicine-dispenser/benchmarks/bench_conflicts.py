@@ -0,0 +1,84 @@
+"""Benchmark the timing conflict detector against the original pairwise check.
+
+Usage: python benchmarks/bench_conflicts.py [--sizes 15,100,1000,5000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import time as dtime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from conflict_detector import find_timing_conflicts, MINUTES_PER_DAY  # noqa: E402
+from prescription_parser import PrescriptionDetails  # noqa: E402
+
+
+def legacy_conflicts(prescriptions, window=30):
+    """The previous O(P^2 * T^2) check, with its missing import fixed and no midnight wraparound"""
+    conflicts = []
+    for i, p1 in enumerate(prescriptions):
+        for p2 in prescriptions[i + 1:]:
+            for t1 in p1.timing:
+                for t2 in p2.timing:
+                    time_diff = abs(
+                        dtime.fromisoformat(t1.time).hour * 60 +
+                        dtime.fromisoformat(t1.time).minute -
+                        dtime.fromisoformat(t2.time).hour * 60 -
+                        dtime.fromisoformat(t2.time).minute
+                    )
+                    if time_diff < window:
+                        conflicts.append((p1.medication_name, p2.medication_name, t1.time, t2.time))
+    return conflicts
+
+
+def make_prescriptions(count, seed=7):
+    rng = random.Random(seed)
+    prescriptions = []
+    for i in range(count):
+        doses = rng.randint(1, 4)
+        first = rng.randrange(MINUTES_PER_DAY)
+        step = MINUTES_PER_DAY // doses
+        timing = [
+            {'time': f"{((first + k * step) % MINUTES_PER_DAY) // 60:02d}:{((first + k * step) % 60):02d}"}
+            for k in range(doses)
+        ]
+        prescriptions.append(PrescriptionDetails(
+            medication_name=f"Medication {i}",
+            dosage='10mg',
+            frequency=doses,
+            timing=timing,
+            start_date='2024-12-01',
+            end_date='2024-12-31'
+        ))
+    return prescriptions
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--sizes', default='15,100,1000,5000')
+    cli.add_argument('--legacy-limit', type=int, default=1000, help='skip the legacy check above this size')
+    args = cli.parse_args()
+
+    print(f"{'prescriptions':>13} {'doses':>6} {'conflicts':>9} {'new ms':>9} {'legacy ms':>10} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        prescriptions = make_prescriptions(size)
+        doses = sum(len(p.timing) for p in prescriptions)
+        conflicts, new_ms = timed(find_timing_conflicts, prescriptions)
+        if size <= args.legacy_limit:
+            _, legacy_ms = timed(legacy_conflicts, prescriptions)
+            legacy, speedup = f"{legacy_ms:10.1f}", f"{legacy_ms / new_ms:7.1f}x"
+        else:
+            legacy, speedup = f"{'skipped':>10}", f"{'-':>8}"
+        print(f"{size:>13} {doses:>6} {len(conflicts):>9} {new_ms:9.2f} {legacy} {speedup}")
+
+
+if __name__ == '__main__':
+    main()
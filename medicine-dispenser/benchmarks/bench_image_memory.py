@@ -0,0 +1,97 @@
+"""Benchmark peak memory and time of the image decode path, legacy vs draft decoding.
+
+Each mode runs in a fresh, identical subprocess so their peak RSS is directly comparable.
+
+Usage: python benchmarks/bench_image_memory.py [--width 4032 --height 3024 --runs 5]
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+
+def make_photo(width, height):
+    img = Image.new('RGB', (width, height), (250, 250, 245))
+    draw = ImageDraw.Draw(img)
+    for line in range(0, height, 40):
+        draw.text((60, line), 'Paracetamol 500mg - take one tablet every 6 hours after food', fill=(20, 20, 20))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=92)
+    return buffer.getvalue()
+
+
+def legacy_decode(data):
+    """The previous path: spool to a temp file, full decode, then thumbnail"""
+    temp_dir = tempfile.mkdtemp()
+    temp_path = os.path.join(temp_dir, 'prescription.jpg')
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        with open(temp_path, 'rb') as f:
+            img = Image.open(io.BytesIO(f.read()))
+            img.thumbnail((1200, 1200), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=85)
+            return buffer.getvalue()
+    finally:
+        os.remove(temp_path)
+        os.rmdir(temp_dir)
+
+
+def draft_decode(data):
+    from image_pipeline import normalize_image, encode_jpeg
+    return encode_jpeg(normalize_image(data))
+
+
+def run_mode(mode, path, runs):
+    with open(path, 'rb') as f:
+        data = f.read()
+    decode = legacy_decode if mode == 'legacy' else draft_decode
+    started = time.perf_counter()
+    for _ in range(runs):
+        decode(data)
+    elapsed = (time.perf_counter() - started) * 1000 / runs
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode': mode, 'input_bytes': len(data), 'ms': elapsed, 'peak_rss_kb': peak}))
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--width', type=int, default=4032)
+    cli.add_argument('--height', type=int, default=3024)
+    cli.add_argument('--runs', type=int, default=5)
+    cli.add_argument('--mode', choices=('legacy', 'draft'), help=argparse.SUPPRESS)
+    cli.add_argument('--image', help=argparse.SUPPRESS)
+    args = cli.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.image, args.runs)
+        return
+
+    # The photo is generated here so its full-size bitmap never counts against a mode
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as photo:
+        photo.write(make_photo(args.width, args.height))
+    try:
+        print(f"{'mode':>7} {'input KB':>9} {'ms/image':>9} {'peak RSS MB':>12}")
+        for mode in ('legacy', 'draft'):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--mode', mode, '--image', photo.name, '--runs', str(args.runs)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:>7} {result['input_bytes'] / 1024:9.0f} {result['ms']:9.1f} {result['peak_rss_kb'] / 1024:12.1f}")
+    finally:
+        os.remove(photo.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark LLM image payload variants: bytes, encode time and estimated input tokens.
+
+Runs over a local directory of sample photos, or over generated prescription
+photos when no directory is given. Nothing is sent to the API.
+
+Usage: python benchmarks/bench_llm_image.py [--samples DIR] [--runs 3]
+"""
+import argparse
+import base64
+import glob
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from PIL import Image, ImageDraw, ImageFont  # noqa: E402
+
+from image_pipeline import normalize_image, encode_jpeg, encode_for_llm, estimate_image_tokens  # noqa: E402
+
+
+def make_samples(count=6, seed=3):
+    """Phone-style photos of a printed prescription lying on a table"""
+    rng = random.Random(seed)
+    font = ImageFont.load_default(size=44)
+    samples = []
+    for index in range(count):
+        width, height = rng.choice([(4032, 3024), (3024, 4032), (2048, 1536)])
+        img = Image.new('RGB', (width, height), tuple(rng.randint(60, 140) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        left, top = int(width * rng.uniform(0.1, 0.25)), int(height * rng.uniform(0.05, 0.2))
+        right, bottom = int(width * rng.uniform(0.75, 0.9)), int(height * rng.uniform(0.8, 0.95))
+        draw.rectangle((left, top, right, bottom), fill=(244, 241, 232))
+        for line in range(rng.randint(8, 18)):
+            text = rng.choice(['Paracetamol 500mg', 'Amoxicillin 250mg', 'Take one tablet', 'every 6 hours after food',
+                               'Dr. A. Sharma  Reg 48213', '11 Dec 2024  x5 days'])
+            draw.text((left + 60, top + 60 + 70 * line), text, fill=(25, 25, 40), font=font)
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=92)
+        samples.append((f"generated_{index}.jpg", buffer.getvalue()))
+    return samples
+
+
+def load_samples(directory):
+    paths = sorted(p for p in glob.glob(os.path.join(directory, '*')) if p.lower().endswith(('.jpg', '.jpeg', '.png')))
+    samples = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            samples.append((os.path.basename(path), f.read()))
+    return samples
+
+
+def raw_photo(data):
+    with Image.open(io.BytesIO(data)) as img:
+        return data, img.width, img.height
+
+
+def normalized_rgb(data):
+    img = normalize_image(data)
+    return encode_jpeg(img), img.width, img.height
+
+
+def variant(**options):
+    def encode(data):
+        payload = encode_for_llm(normalize_image(data), **options)
+        return payload.data, payload.width, payload.height
+    return encode
+
+
+VARIANTS = [
+    ('raw upload', raw_photo),
+    ('normalized RGB q85', normalized_rgb),
+    ('downscale only', variant(grayscale=False, crop=False)),
+    ('+ grayscale/contrast', variant(crop=False)),
+    ('+ text crop (default)', variant()),
+]
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--samples', help='directory of sample prescription photos')
+    cli.add_argument('--runs', type=int, default=3)
+    args = cli.parse_args()
+
+    samples = load_samples(args.samples) if args.samples else make_samples()
+    if not samples:
+        sys.exit(f"No images found in {args.samples}")
+    print(f"{len(samples)} samples, median of {args.runs} runs per image\n")
+
+    print(f"{'variant':<22} {'avg bytes':>10} {'avg base64':>11} {'avg ms':>8} {'avg tokens':>11}")
+    for name, encode in VARIANTS:
+        sizes, encoded, times, tokens = [], [], [], []
+        for _, data in samples:
+            runs = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                payload, width, height = encode(data)
+                runs.append((time.perf_counter() - started) * 1000)
+            sizes.append(len(payload))
+            encoded.append(len(base64.b64encode(payload)))
+            times.append(statistics.median(runs))
+            tokens.append(estimate_image_tokens(width, height))
+        print(f"{name:<22} {statistics.mean(sizes):10.0f} {statistics.mean(encoded):11.0f} "
+              f"{statistics.mean(times):8.1f} {statistics.mean(tokens):11.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Benchmark the daily schedule path with print logging against the queued logger.
+
+Each call is PrescriptionHandler.get_daily_schedule on an in-memory
+schedule index, so the time measured is what the request thread spends
+building (a cached) schedule plus logging it. Output goes through a pipe
+to a separate process, like stdout to journald or a container runtime.
+
+Usage: python benchmarks/bench_logging.py [--prescriptions 100 --calls 2000]
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import log_config  # noqa: E402
+from metrics import current_trace, new_trace  # noqa: E402
+from prescription_handler import PrescriptionHandler  # noqa: E402
+from records import PrescriptionRecord, TimingRecord, dumps  # noqa: E402
+from schedule_index import ScheduleIndex  # noqa: E402
+
+DAY = date(2024, 12, 15)
+
+
+class IndexOnlyHandler(PrescriptionHandler):
+    """The real schedule path over a preloaded index, without AWS"""
+
+    def __init__(self, index):
+        self.schedule_index = index
+
+    def refresh_schedule_index(self, force: bool = False, max_age: float = 0):
+        pass
+
+
+def make_index(count):
+    index = ScheduleIndex()
+    records = [PrescriptionRecord(
+        id=f"PRESC_{i}", device_id='dispenser-1', created_at=f"2024-12-01T08:00:{i % 60:02d}",
+        medication_name=f"Medication {i}", dosage='500mg', frequency=3,
+        timing=tuple(TimingRecord(f"{8 + 4 * k:02d}:00", bool(k % 2), 'with water') for k in range(3)),
+        start_date=(DAY - timedelta(days=5)).isoformat(), end_date=(DAY + timedelta(days=5)).isoformat()
+    ) for i in range(count)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        index.load(records, 1)
+    return index
+
+
+def print_indented(index):
+    """The original path: progress prints, a stage print and the schedule at indent=2"""
+    print("\nRetrieving daily schedule...")
+    print(f"Processing schedule for date: {DAY}")
+    started = time.perf_counter()
+    schedule = index.schedule_for(DAY)
+    print(f"[trace {current_trace()}] schedule_build took {(time.perf_counter() - started) * 1000:.1f}ms")
+    print("\nFinal daily schedule:")
+    print(json.dumps([slot.to_dict() for slot in schedule], indent=2))
+    return schedule
+
+
+def print_compact(index):
+    """The same prints with the compact records serializer"""
+    print("\nRetrieving daily schedule...")
+    print(f"Processing schedule for date: {DAY}")
+    started = time.perf_counter()
+    schedule = index.schedule_for(DAY)
+    print(f"[trace {current_trace()}] schedule_build took {(time.perf_counter() - started) * 1000:.1f}ms")
+    print(f"\nFinal daily schedule: {dumps(schedule)}")
+    return schedule
+
+
+def set_logging(level, sample_rate):
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers:
+        for sampler in handler.filters:
+            if isinstance(sampler, log_config.TraceSampler):
+                sampler.threshold = int(sample_rate * 10000)
+
+
+def run(fn, arg, calls):
+    started = time.perf_counter()
+    for i in range(calls):
+        new_trace(f"bench-{i}")
+        fn(arg)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--prescriptions', type=int, default=100)
+    cli.add_argument('--calls', type=int, default=2000)
+    args = cli.parse_args()
+
+    index = make_index(args.prescriptions)
+    handler = IndexOnlyHandler(index)
+    # The reader side of the pipe: a separate process, as journald would be
+    sink = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    stream = io.TextIOWrapper(sink.stdin, line_buffering=True)
+    log_config.configure_logging(stream=stream)
+
+    results = []
+    with contextlib.redirect_stdout(stream):
+        results.append(('print, indent=2', run(print_indented, index, args.calls)))
+        results.append(('print, compact', run(print_compact, index, args.calls)))
+        for level, sample_rate in (('INFO', 1.0), ('DEBUG', 1.0), ('DEBUG', 0.1)):
+            set_logging(level, sample_rate)
+            micros = run(handler.get_daily_schedule, DAY.isoformat(), args.calls)
+            results.append((f"logger {level}, sample {sample_rate:g}", micros))
+            # Let the listener drain before the next run
+            time.sleep(0.5)
+
+    log_config.stop_logging()
+    stream.close()
+    sink.wait()
+
+    slots = len(index.schedule_for(DAY))
+    print(f"get_daily_schedule with {slots} doses, {args.calls} calls, mean time on the request thread\n")
+    baseline = results[0][1]
+    for name, micros in results:
+        print(f"{name:<26} {micros:9.1f} us  {baseline / micros:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Benchmark save_prescription latency with synchronous DynamoDB writes against the outbox.
+
+DynamoDB and IoT are in-process stubs that sleep --aws-ms per call (a
+BatchWriteItem of up to 25 items counts as one call). The synchronous path
+is the previous request path: put_item plus the version bump on the
+request thread (the device publish already ran on a timer). The outbox
+path commits to SQLite and returns; the flusher's batched writes and
+coalesced publishes are counted until the outbox drains.
+
+Usage: python benchmarks/bench_outbox.py [--threads 8 --saves 50 --aws-ms 25]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ['STATE_DIR'] = tempfile.mkdtemp(prefix='bench_outbox_')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from clients import clients  # noqa: E402
+from prescription_handler import PrescriptionHandler  # noqa: E402
+from prescription_parser import PrescriptionDetails  # noqa: E402
+
+
+class Calls:
+    def __init__(self, latency):
+        self.latency = latency
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+        time.sleep(self.latency)
+
+
+class StubBatchWriter:
+    def __init__(self, calls):
+        self.calls = calls
+        self.items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for _ in range(0, self.items, 25):
+            self.calls('batch_write_item')
+
+    def put_item(self, Item):
+        self.items += 1
+
+
+class StubTable:
+    """The DynamoDB Table calls the handler makes, each costing one round-trip"""
+
+    def __init__(self, name, calls):
+        self.name = name
+        self.calls = calls
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def put_item(self, **kwargs):
+        self.calls('put_item')
+
+    def update_item(self, **kwargs):
+        self.calls('update_item')
+        with self._lock:
+            self.version += 1
+            return {'Attributes': {'version': self.version}}
+
+    def get_item(self, **kwargs):
+        self.calls('get_item')
+        return {'Item': {'version': self.version}}
+
+    def scan(self, **kwargs):
+        self.calls('scan')
+        return {'Items': []}
+
+    def batch_writer(self):
+        return StubBatchWriter(self.calls)
+
+
+class StubDynamoDB:
+    def __init__(self, calls):
+        self.tables = {}
+        self.calls = calls
+
+    def Table(self, name):
+        return self.tables.setdefault(name, StubTable(name, self.calls))
+
+
+class StubIoT:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def publish(self, **kwargs):
+        self.calls('iot_publish')
+
+
+PRESCRIPTION = PrescriptionDetails(
+    medication_name='Amoxicillin', dosage='500mg', frequency=2,
+    timing=[{'time': '08:00', 'with_food': True}, {'time': '20:00', 'with_food': True}],
+    start_date='2024-12-11', end_date='2024-12-18'
+)
+
+
+def save_sync(handler):
+    """The request path before the outbox"""
+    record = handler.build_prescription_record(PRESCRIPTION)
+    handler.store.put(record.to_item())
+    handler.schedule_index.apply_write(lambda index: index.upsert(record), handler.store.bump_version())
+
+
+def save_outbox(handler):
+    handler.save_prescription(PRESCRIPTION)
+
+
+def run(handler, save, threads, saves):
+    def worker(_):
+        latencies = []
+        for _ in range(saves):
+            started = time.perf_counter()
+            save(handler)
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = sorted(latency for result in pool.map(worker, range(threads)) for latency in result)
+    return latencies, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--threads', type=int, default=8, help='concurrent requests')
+    cli.add_argument('--saves', type=int, default=50, help='saves per thread')
+    cli.add_argument('--aws-ms', type=float, default=25, help='latency of each DynamoDB/IoT call')
+    args = cli.parse_args()
+
+    calls = Calls(args.aws_ms / 1000)
+    clients.override('dynamodb', StubDynamoDB(calls))
+    clients.override('iot-data', StubIoT(calls))
+    handler = PrescriptionHandler()
+    total = args.threads * args.saves
+    print(f"{total} saves from {args.threads} threads, {args.aws_ms:g}ms per AWS call\n")
+    print(f"{'path':<8} {'p50 ms':>8} {'p99 ms':>8} {'saves/s':>9} {'drained s':>10}  AWS calls")
+
+    for name, save in (('sync', save_sync), ('outbox', save_outbox)):
+        calls.counts.clear()
+        started = time.perf_counter()
+        latencies, elapsed = run(handler, save, args.threads, args.saves)
+        # Everything written, on DynamoDB and the device
+        while handler.outbox.depth():
+            time.sleep(0.005)
+        drained = time.perf_counter() - started
+        summary = ', '.join(f"{call} {count}" for call, count in sorted(calls.counts.items()))
+        print(f"{name:<8} {percentile(latencies, 0.5):8.2f} {percentile(latencies, 0.99):8.2f} "
+              f"{total / elapsed:9.0f} {drained:10.2f}  {summary}")
+
+
+if __name__ == '__main__':
+    main()
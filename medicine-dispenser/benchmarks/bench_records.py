@@ -0,0 +1,142 @@
+"""Benchmark the slotted record model against the previous dict walk, per 10k schedule items.
+
+The legacy path is the code it replaced: decimal_to_float over every
+DynamoDB item, a dict per schedule slot, and json.dumps(indent=2) through
+a JSONEncoder subclass.
+
+Usage: python benchmarks/bench_records.py [--items 10000 --repeat 5]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from records import PrescriptionRecord, ScheduleItem, dumps  # noqa: E402
+
+TIMINGS_PER_PRESCRIPTION = 4
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def decimal_to_float(obj):
+    if isinstance(obj, list):
+        return [decimal_to_float(i) for i in obj]
+    elif isinstance(obj, dict):
+        return {k: decimal_to_float(v) for k, v in obj.items()}
+    elif isinstance(obj, Decimal):
+        return float(obj)
+    return obj
+
+
+def make_items(schedule_items):
+    """DynamoDB-shaped items, numbers as Decimal the way boto3 returns them"""
+    return [{
+        'id': f"PRESC_{i}",
+        'device_id': 'dispenser-1',
+        'created_at': f"2024-11-01T08:00:{i % 60:02d}",
+        'medication_name': f"Medication {i % 50}",
+        'dosage': '500mg',
+        'frequency': Decimal(TIMINGS_PER_PRESCRIPTION),
+        'timing': [{'time': f"{6 + 4 * k:02d}:00", 'with_food': bool(k % 2), 'special_instructions': 'with water'}
+                   for k in range(TIMINGS_PER_PRESCRIPTION)],
+        'start_date': '2024-12-01',
+        'end_date': '2024-12-31',
+        'refills': Decimal(0)
+    } for i in range(schedule_items // TIMINGS_PER_PRESCRIPTION)]
+
+
+def legacy_convert(items):
+    return decimal_to_float(items)
+
+
+def legacy_schedule(items):
+    return [{
+        'time': timing.get('time', '00:00'),
+        'medication_name': item.get('medication_name'),
+        'dosage': item.get('dosage', 'Unknown'),
+        'with_food': timing.get('with_food', False),
+        'special_instructions': timing.get('special_instructions', ''),
+        'prescription_id': item['id']
+    } for item in items for timing in item.get('timing', [])]
+
+
+def legacy_serialize(schedule):
+    return json.dumps(schedule, indent=2, cls=DecimalEncoder)
+
+
+def record_convert(items):
+    return [PrescriptionRecord.from_item(item) for item in items]
+
+
+def record_schedule(records):
+    return [ScheduleItem(timing.time, record.medication_name, record.dosage, timing.with_food,
+                         timing.special_instructions, record.id)
+            for record in records for timing in record.timing]
+
+
+def record_serialize(schedule):
+    return dumps(schedule)
+
+
+def best_ms(fn, arg, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(arg)
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def traced(fn, arg):
+    """(result, retained KiB, peak KiB, allocated blocks still alive)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = fn(arg)
+    after = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    return result, current / 1024, peak / 1024, blocks
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--items', type=int, default=10000, help='schedule items (slots)')
+    cli.add_argument('--repeat', type=int, default=5)
+    args = cli.parse_args()
+    items = make_items(args.items)
+
+    paths = {
+        'legacy dicts': (legacy_convert, legacy_schedule, legacy_serialize),
+        'records': (record_convert, record_schedule, record_serialize),
+    }
+    print(f"{args.items} schedule items from {len(items)} DynamoDB items, best of {args.repeat}\n")
+    print(f"{'path':<13} {'step':<10} {'ms':>8} {'retained KiB':>13} {'peak KiB':>9} {'blocks':>8} {'output':>10}")
+    for name, steps in paths.items():
+        value = items
+        for step, fn in zip(('convert', 'schedule', 'serialize'), steps):
+            ms = best_ms(fn, value, args.repeat)
+            result, retained, peak, blocks = traced(fn, value)
+            size = f"{len(result) / 1024:7.0f} KiB" if isinstance(result, str) else ''
+            print(f"{name:<13} {step:<10} {ms:8.2f} {retained:13.0f} {peak:9.0f} {blocks:>8} {size:>10}")
+            value = result
+        print()
+
+
+if __name__ == '__main__':
+    main()
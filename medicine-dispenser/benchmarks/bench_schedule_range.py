@@ -0,0 +1,85 @@
+"""Benchmark multi-day schedule expansion against one daily schedule per day.
+
+Usage: python benchmarks/bench_schedule_range.py [--prescriptions 100,500,2000 --days 90]
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from device_config import encode_schedule_range  # noqa: E402
+from schedule_index import ScheduleIndex  # noqa: E402
+
+START = date(2024, 12, 1)
+
+
+def make_items(count, days, seed=7):
+    """Prescriptions starting and ending at random points around the range"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        start = START + timedelta(days=rng.randint(-30, days))
+        end = start + timedelta(days=rng.randint(0, 60))
+        items.append({
+            'id': f"PRESC_{i}",
+            'medication_name': f"Medication {i % 50}",
+            'dosage': '10mg',
+            'start_date': start.isoformat(),
+            'end_date': end.isoformat(),
+            'created_at': f"2024-11-{i % 28 + 1:02d}T08:{i % 60:02d}:00",
+            'timing': [{'time': f"{rng.randrange(24):02d}:{rng.choice((0, 30)):02d}", 'with_food': bool(i % 2)}
+                       for _ in range(rng.randint(1, 4))]
+        })
+    return items
+
+
+def load_index(items):
+    index = ScheduleIndex()
+    with contextlib.redirect_stdout(io.StringIO()):
+        index.load(items, 1)
+    return index
+
+
+def per_day(index, days):
+    """The pre-range approach: one daily schedule per day, dated afterwards"""
+    events = []
+    for offset in range(days):
+        day = START + timedelta(days=offset)
+        events.extend(dict(slot, date=day.isoformat()) for slot in index.schedule_for(day))
+    return events
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--prescriptions', default='100,500,2000')
+    cli.add_argument('--days', type=int, default=90)
+    args = cli.parse_args()
+    end = START + timedelta(days=args.days - 1)
+
+    print(f"{args.days}-day range from {START}\n")
+    print(f"{'prescriptions':>13} {'events':>7} {'range ms':>9} {'encode ms':>10} {'dicts ms':>9} {'per-day ms':>11}")
+    for size in (int(s) for s in args.prescriptions.split(',')):
+        items = make_items(size, args.days)
+        # Fresh indexes, so neither side starts with warm caches
+        schedule_range, range_ms = timed(load_index(items).range_for, START, end)
+        _, encode_ms = timed(lambda: ''.join(encode_schedule_range(schedule_range)))
+        _, dicts_ms = timed(lambda: list(schedule_range.events()))
+        legacy, legacy_ms = timed(per_day, load_index(items), args.days)
+        assert len(legacy) == len(schedule_range.slot_indices)
+        print(f"{size:>13} {len(legacy):>7} {range_ms:9.2f} {encode_ms:10.1f} {dicts_ms:9.1f} {legacy_ms:11.1f}")
+
+
+if __name__ == '__main__':
+    main()
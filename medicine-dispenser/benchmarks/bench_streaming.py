@@ -0,0 +1,159 @@
+"""Benchmark time to first useful byte of a streamed parse against the full round-trip.
+
+A local HTTP server stands in for the Messages API: it waits --ttft-ms
+before the first token, then sends the answer a few characters at a time
+every --token-ms, as server-sent events for stream requests and as one
+JSON body otherwise. The parser runs unchanged against it through
+ANTHROPIC_BASE_URL; the image is a small in-memory image.
+
+Usage: python benchmarks/bench_streaming.py [--ttft-ms 600 --token-ms 15 --runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from PIL import Image  # noqa: E402
+
+ANSWER = json.dumps({
+    "medication_name": "Amoxicillin",
+    "dosage": "500mg",
+    "frequency": 3,
+    "timing": [
+        {"time": "08:00", "with_food": True, "special_instructions": "Take after breakfast with a full glass of water"},
+        {"time": "14:00", "with_food": True, "special_instructions": "Take after lunch with a full glass of water"},
+        {"time": "20:00", "with_food": True, "special_instructions": "Take after dinner with a full glass of water"}
+    ],
+    "start_date": "2024-12-11",
+    "end_date": "2024-12-18",
+    "refills": 1
+}, indent=2)
+CHARS_PER_TOKEN = 4
+
+
+class FakeMessagesAPI(BaseHTTPRequestHandler):
+    """POST /v1/messages with the latency profile of a real model"""
+    protocol_version = 'HTTP/1.1'
+    ttft = 0.6
+    token_delay = 0.015
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        tokens = [ANSWER[i:i + CHARS_PER_TOKEN] for i in range(0, len(ANSWER), CHARS_PER_TOKEN)]
+        message = {'id': 'msg_bench', 'type': 'message', 'role': 'assistant', 'model': body['model'],
+                   'content': [], 'stop_reason': None, 'stop_sequence': None,
+                   'usage': {'input_tokens': 1000, 'output_tokens': len(tokens)}}
+        time.sleep(self.ttft)
+        if not body.get('stream'):
+            time.sleep(self.token_delay * len(tokens))
+            message.update(content=[{'type': 'text', 'text': ANSWER}], stop_reason='end_turn')
+            self.reply('application/json', json.dumps(message).encode())
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.event('message_start', {'type': 'message_start', 'message': message})
+        self.event('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                           'content_block': {'type': 'text', 'text': ''}})
+        for token in tokens:
+            self.event('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                               'delta': {'type': 'text_delta', 'text': token}})
+            time.sleep(self.token_delay)
+        self.event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        self.event('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                     'usage': {'output_tokens': len(tokens)}})
+        self.event('message_stop', {'type': 'message_stop'})
+        self.wfile.write(b'0\r\n\r\n')
+
+    def reply(self, content_type, data):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def event(self, name, data):
+        chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+        self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b'\r\n')
+        self.wfile.flush()
+
+
+def start_server(ttft, token_delay):
+    FakeMessagesAPI.ttft = ttft
+    FakeMessagesAPI.token_delay = token_delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeMessagesAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def time_full(parser, image):
+    started = time.perf_counter()
+    parser.parse_prescription('memory://bench', image=image)
+    return {'done': time.perf_counter() - started}
+
+
+def time_stream(parser, image):
+    """Seconds to the first event, to name + dosage + first timing, and to the validated result"""
+    marks = {}
+    seen = set()
+    started = time.perf_counter()
+    for event in parser.parse_prescription_stream('memory://bench', image=image):
+        now = time.perf_counter() - started
+        marks.setdefault('first field', now)
+        if event.kind == 'field':
+            seen.add(event.data['name'])
+        elif event.kind == 'timing':
+            seen.add('timing')
+        if {'medication_name', 'dosage', 'timing'} <= seen:
+            marks.setdefault('name+dose+1st time', now)
+        if event.kind == 'result':
+            marks['done'] = now
+    return marks
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--ttft-ms', type=float, default=600, help='delay before the first token')
+    cli.add_argument('--token-ms', type=float, default=15, help='delay between tokens')
+    cli.add_argument('--runs', type=int, default=5)
+    args = cli.parse_args()
+
+    server = start_server(args.ttft_ms / 1000, args.token_ms / 1000)
+    os.environ['ANTHROPIC_BASE_URL'] = f"http://127.0.0.1:{server.server_port}"
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'bench')
+    os.environ['ANTHROPIC_REQUESTS_PER_SECOND'] = '1000'
+
+    from prescription_parser import PrescriptionParser
+
+    parser = PrescriptionParser()
+    image = Image.new('RGB', (640, 480), (240, 240, 235))
+    tokens = -(-len(ANSWER) // CHARS_PER_TOKEN)
+    print(f"{tokens} output tokens, {args.ttft_ms:g}ms to first token, {args.token_ms:g}ms per token, "
+          f"median of {args.runs}\n")
+
+    results = {}
+    for name, fn in (('create', time_full), ('stream', time_stream)):
+        runs = [fn(parser, image) for _ in range(args.runs)]
+        for mark in runs[0]:
+            results[(name, mark)] = statistics.median(run[mark] for run in runs) * 1000
+
+    baseline = results[('create', 'done')]
+    print(f"{'mode':<8} {'milestone':<20} {'ms':>8} {'of create':>10}")
+    for (name, mark), ms in results.items():
+        print(f"{name:<8} {mark:<20} {ms:8.0f} {ms / baseline:9.0%}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
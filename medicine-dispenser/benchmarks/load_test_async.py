@@ -0,0 +1,205 @@
+"""Load test the sync (gunicorn) and async (uvicorn) servers against local fakes.
+
+AWS is served by a moto server and Anthropic by a fake Messages endpoint
+that answers after --llm-latency seconds, so the numbers reflect how many
+uploads each server can keep in flight rather than real API speed.
+Requires moto[server] and httpx.
+
+Usage: python benchmarks/load_test_async.py [--requests 200 --concurrency 64 --llm-latency 1.0]
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import httpx
+from moto.server import ThreadedMotoServer
+from PIL import Image, ImageDraw
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+REGION = 'us-west-2'
+BUCKET = 'medicine-dispenser-prescriptions'
+TABLE = 'Prescriptions'
+VERSIONS_TABLE = 'ScheduleVersions'
+
+SERVERS = {
+    'gunicorn -w 4 (sync)': ['gunicorn', '-w', '4', '-b', '127.0.0.1:{port}', 'app:app'],
+    'uvicorn -w 1 (async)': ['uvicorn', 'asgi_app:app', '--host', '127.0.0.1', '--port', '{port}',
+                             '--workers', '1', '--no-access-log'],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fake_anthropic(latency):
+    """Minimal /v1/messages endpoint that waits like a model would"""
+    body = json.dumps({
+        'id': 'msg_fake', 'type': 'message', 'role': 'assistant', 'model': 'claude-3-haiku-20240307',
+        'content': [{'type': 'text', 'text': '{}'}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+        'usage': {'input_tokens': 200, 'output_tokens': 50}
+    }).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def reset_aws(endpoint):
+    """Fresh table and bucket so each server starts from the same state"""
+    kwargs = {'endpoint_url': endpoint, 'region_name': REGION,
+              'aws_access_key_id': 'testing', 'aws_secret_access_key': 'testing'}
+    dynamodb = boto3.resource('dynamodb', **kwargs)
+    existing = [table.name for table in dynamodb.tables.all()]
+    for name, key in ((TABLE, 'id'), (VERSIONS_TABLE, 'scope')):
+        if name in existing:
+            dynamodb.Table(name).delete()
+        dynamodb.create_table(
+            TableName=name, BillingMode='PAY_PER_REQUEST',
+            KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}]
+        )
+    s3 = boto3.client('s3', **kwargs)
+    try:
+        s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': REGION})
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+
+def make_images(count):
+    """Distinct photos, so the parse cache never short-circuits the LLM call"""
+    images = []
+    for index in range(count):
+        img = Image.new('RGB', (1600, 1200), (245, 242, 235))
+        draw = ImageDraw.Draw(img)
+        for line in range(12):
+            draw.text((80, 80 + 60 * line), f"Paracetamol 500mg every 6 hours  #{index}-{line}", fill=(20, 20, 20))
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+async def wait_healthy(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{base_url}/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"{base_url} did not become healthy")
+
+
+async def run_load(base_url, images, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        async def upload(image):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(f"{base_url}/upload-prescription",
+                                                 files={'prescription': ('rx.jpg', image, 'image/jpeg')})
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(upload(image) for image in images))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'throughput': len(images) / elapsed,
+        'p50': statistics.median(latencies),
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        'errors': errors
+    }
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--requests', type=int, default=200)
+    cli.add_argument('--concurrency', type=int, default=64)
+    cli.add_argument('--llm-latency', type=float, default=1.0, help='seconds the fake model takes per call')
+    args = cli.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    moto_port = free_port()
+    moto = ThreadedMotoServer(ip_address='127.0.0.1', port=moto_port, verbose=False)
+    moto.start()
+    anthropic = start_fake_anthropic(args.llm_latency)
+    endpoint = f"http://127.0.0.1:{moto_port}"
+    images = make_images(args.requests)
+
+    print(f"{args.requests} uploads, {args.concurrency} concurrent, fake LLM latency {args.llm_latency}s\n")
+    print(f"{'server':<22} {'req/s':>7} {'p50 s':>7} {'p99 s':>7} {'errors':>7}")
+    try:
+        for name, command in SERVERS.items():
+            reset_aws(endpoint)
+            state_dir = tempfile.mkdtemp(prefix='loadtest-state-')
+            port = free_port()
+            env = dict(
+                os.environ,
+                AWS_ENDPOINT_URL=endpoint, AWS_DEFAULT_REGION=REGION,
+                AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+                ANTHROPIC_API_KEY='fake', ANTHROPIC_BASE_URL=f"http://127.0.0.1:{anthropic.server_address[1]}",
+                ANTHROPIC_REQUESTS_PER_SECOND='0', STATE_DIR=state_dir
+            )
+            server = subprocess.Popen([part.format(port=port) for part in command], cwd=SRC_DIR, env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                base_url = f"http://127.0.0.1:{port}"
+                asyncio.run(wait_healthy(base_url))
+                result = asyncio.run(run_load(base_url, images, args.concurrency))
+                print(f"{name:<22} {result['throughput']:7.2f} {result['p50']:7.2f} "
+                      f"{result['p99']:7.2f} {result['errors']:>7}")
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+                shutil.rmtree(state_dir, ignore_errors=True)
+    finally:
+        anthropic.shutdown()
+        moto.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,525 @@
+"""Offline end-to-end benchmark suite; results are saved as JSON to compare across commits.
+
+Scenarios:
+    upload     POST /upload-prescription through the Flask app: throughput, p50/p99
+    schedule   get_daily_schedule at 10, 1k and 100k prescriptions
+    cleanup    cleanup_old_prescriptions over tables with half the prescriptions expired
+    poller     the S3 poller draining a backlog of images
+    conflicts  the timing conflict check over growing prescription lists
+
+S3 and IoT run on moto, in process. DynamoDB is an in-memory stub table
+that sleeps --aws-ms per call: moto's scan slows down quadratically past a
+few thousand items, which would measure moto rather than this code.
+Anthropic is a fake client that answers after --llm-ms. Nothing leaves
+the machine; state (parse cache, outbox, poller checkpoints) goes to a
+temporary STATE_DIR. Requires moto.
+
+Comparing exits non-zero when a time (``*_ms``) rises or a rate
+(``*_per_s``) falls by more than --threshold.
+
+Usage:
+    python benchmarks/suite.py [--scenarios upload,schedule] [--output results.json]
+    python benchmarks/suite.py --compare benchmarks/results/<earlier commit>.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-west-2',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'ANTHROPIC_API_KEY': 'bench',
+    'ANTHROPIC_REQUESTS_PER_SECOND': '100000',
+    'ANTHROPIC_BURST': '100000',
+    'PRESCRIPTION_RETENTION_DAYS': '30',
+    'STATE_DIR': tempfile.mkdtemp(prefix='bench_suite_'),
+    'LOG_LEVEL': os.getenv('BENCH_LOG_LEVEL', 'WARNING'),
+})
+os.environ.pop('AWS_ENDPOINT_URL', None)
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+
+from moto import mock_aws  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+from app import app  # noqa: E402
+from bench_conflicts import make_prescriptions  # noqa: E402
+from clients import clients  # noqa: E402
+from conflict_detector import find_timing_conflicts  # noqa: E402
+from mobile_upload import S3ImageProcessor, PRESCRIPTION_BUCKET  # noqa: E402
+from poller_state import PollerState  # noqa: E402
+from prescription_handler import PrescriptionHandler, get_outbox  # noqa: E402
+
+SCHEDULE_DAY = date(2024, 12, 15)
+SCAN_PAGE_ITEMS = 1000
+ANSWER = json.dumps({
+    'medication_name': 'Paracetamol', 'dosage': '500mg', 'frequency': 4,
+    'timing': [{'time': f"{hour:02d}:00", 'with_food': True} for hour in (3, 9, 15, 21)],
+    'start_date': '2024-12-11', 'end_date': '2024-12-16', 'refills': 0
+})
+
+
+class Latency:
+    """Sleeps for every stubbed AWS call and counts them"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        if self.seconds:
+            time.sleep(self.seconds)
+
+
+class StubBatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.items = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for i in range(0, len(self.items), 25):
+            self.table.latency()
+            self.table.seed(self.items[i:i + 25])
+
+    def put_item(self, Item):
+        self.items.append(Item)
+
+
+class StubClient:
+    """The low-level calls cleanup makes: segmented key scans and BatchWriteItem"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, FilterExpression=None, ExpressionAttributeValues=None,
+             ExclusiveStartKey=None, **kwargs):
+        if FilterExpression not in (None, 'end_date < :cutoff'):
+            raise NotImplementedError(FilterExpression)
+        cutoff = (ExpressionAttributeValues or {}).get(':cutoff')
+        page, last = self.table.page(ExclusiveStartKey, Segment, TotalSegments)
+        items = [{'id': item['id']} for item in page if cutoff is None or item.get('end_date', '') < cutoff]
+        return {'Items': items, **({'LastEvaluatedKey': last} if last else {})}
+
+    def batch_write_item(self, RequestItems):
+        self.table.latency()
+        for request in next(iter(RequestItems.values())):
+            if 'DeleteRequest' in request:
+                self.table.remove(request['DeleteRequest']['Key']['id'])
+            else:
+                self.table.seed([request['PutRequest']['Item']])
+        return {'UnprocessedItems': {}}
+
+
+class StubTable:
+    """In-memory DynamoDB table keyed by id (or any single key), paging scans at SCAN_PAGE_ITEMS"""
+
+    def __init__(self, name, latency):
+        self.name = name
+        self.latency = latency
+        self.items = {}
+        self.meta = type('Meta', (), {'client': StubClient(self)})()
+        self._lock = threading.Lock()
+        self._sorted_ids = None
+
+    def seed(self, items):
+        with self._lock:
+            self.items.update((item['id'], item) for item in items)
+            self._sorted_ids = None
+
+    def remove(self, item_id):
+        with self._lock:
+            if self.items.pop(item_id, None) is not None:
+                self._sorted_ids = None
+
+    def page(self, start_key, segment=0, total_segments=1):
+        """One scan page of a segment; the offset travels in LastEvaluatedKey"""
+        self.latency()
+        offset = start_key['offset'] if start_key else 0
+        with self._lock:
+            if self._sorted_ids is None:
+                self._sorted_ids = sorted(self.items)
+            ids = self._sorted_ids[segment::total_segments]
+            page = [self.items[item_id] for item_id in ids[offset:offset + SCAN_PAGE_ITEMS]]
+        more = offset + SCAN_PAGE_ITEMS < len(ids)
+        return page, ({'id': page[-1]['id'], 'offset': offset + SCAN_PAGE_ITEMS} if more else None)
+
+    def put_item(self, Item):
+        self.latency()
+        self.seed([Item])
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.latency()
+        with self._lock:
+            item = self.items.get(next(iter(Key.values())))
+        return {'Item': item} if item else {}
+
+    def update_item(self, Key, **kwargs):
+        self.latency()
+        with self._lock:
+            item = self.items.setdefault(next(iter(Key.values())), dict(Key, version=0))
+            item['version'] += 1
+            return {'Attributes': {'version': item['version']}}
+
+    def delete_item(self, Key):
+        self.latency()
+        self.remove(Key['id'])
+
+    def scan(self, ExclusiveStartKey=None, **kwargs):
+        page, last = self.page(ExclusiveStartKey)
+        return {'Items': page, **({'LastEvaluatedKey': last} if last else {})}
+
+    def batch_writer(self):
+        return StubBatchWriter(self)
+
+
+class StubDynamoDB:
+    def __init__(self, latency):
+        self.latency = latency
+        self.tables = {}
+
+    def Table(self, name):
+        return self.tables.setdefault(name, StubTable(name, self.latency))
+
+
+class FakeMessages:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def create(self, **kwargs):
+        time.sleep(self.latency)
+        block = type('TextBlock', (), {'type': 'text', 'text': ANSWER})()
+        return type('Message', (), {'content': [block], 'stop_reason': 'end_turn'})()
+
+
+class FakeAnthropic:
+    """Answers messages.create after a fixed latency"""
+
+    def __init__(self, latency):
+        self.messages = FakeMessages(latency)
+
+
+def fresh_table(aws_seconds):
+    """Swap in an empty stub DynamoDB and return the handler's table"""
+    get_outbox().flush()
+    clients.override('dynamodb', StubDynamoDB(Latency(aws_seconds)))
+    handler = PrescriptionHandler()
+    return handler, handler.store.table
+
+
+def drain_outbox(timeout=60):
+    deadline = time.monotonic() + timeout
+    outbox = get_outbox()
+    while outbox.depth() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    outbox.flush()
+
+
+def make_images(count, label):
+    """Distinct prescription photos, so the parse cache never answers for the LLM"""
+    images = []
+    for index in range(count):
+        img = Image.new('RGB', (1600, 1200), (245, 242, 235))
+        draw = ImageDraw.Draw(img)
+        for line in range(12):
+            draw.text((80, 80 + 60 * line), f"Paracetamol 500mg every 6 hours {label}{index}-{line}", fill=(20, 20, 20))
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def make_items(count, around: date, seed=11):
+    """Prescription items with 1-4 doses, dated around a day; some have ended, some not begun"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        doses = rng.randint(1, 4)
+        start = around - timedelta(days=rng.randint(0, 40))
+        items.append({
+            'id': f"PRESC_{i:07d}",
+            'device_id': 'dispenser-1',
+            'created_at': f"2024-11-01T08:{i // 60 % 60:02d}:{i % 60:02d}",
+            'medication_name': f"Medication {i % 500}",
+            'dosage': f"{rng.choice((5, 10, 250, 500))}mg",
+            'frequency': doses,
+            'timing': [{'time': f"{6 + 4 * k:02d}:{rng.choice((0, 15, 30, 45)):02d}", 'with_food': bool(k % 2),
+                        'special_instructions': rng.choice((None, 'with water', 'after meals'))}
+                       for k in range(doses)],
+            'start_date': start.isoformat(),
+            'end_date': (start + timedelta(days=rng.randint(5, 60))).isoformat(),
+            'refills': 0
+        })
+    return items
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_upload(args):
+    """POST /upload-prescription through the Flask app from --concurrency clients at once"""
+    fresh_table(args.aws_ms / 1000)
+    images = make_images(args.uploads, 'upload')
+
+    def post(image):
+        started = time.perf_counter()
+        response = app.test_client().post('/upload-prescription', data={'prescription': (io.BytesIO(image), 'rx.jpg')},
+                                          content_type='multipart/form-data')
+        return response.status_code, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(post, images))
+    elapsed = time.perf_counter() - started
+    drain_outbox()
+    latencies = [latency for _, latency in results]
+    return {
+        'requests': len(results),
+        'concurrency': args.concurrency,
+        'errors': sum(status != 200 for status, _ in results),
+        'throughput_per_s': round(len(results) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'outbox_drained_ms': round((time.perf_counter() - started - elapsed) * 1000, 1)
+    }
+
+
+def bench_schedule(args):
+    """Index load from the table, then get_daily_schedule on a new day and on a cached one"""
+    results = {}
+    for size in args.schedule_sizes:
+        handler, table = fresh_table(args.aws_ms / 1000)
+        table.seed(make_items(size, SCHEDULE_DAY))
+        day = SCHEDULE_DAY.isoformat()
+
+        started = time.perf_counter()
+        handler.refresh_schedule_index(force=True)
+        load_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        schedule = handler.get_daily_schedule(day)
+        first_ms = (time.perf_counter() - started) * 1000
+
+        repeats = 50
+        started = time.perf_counter()
+        for _ in range(repeats):
+            handler.get_daily_schedule(day)
+        cached_ms = (time.perf_counter() - started) * 1000 / repeats
+
+        started = time.perf_counter()
+        for offset in range(1, 8):
+            handler.get_daily_schedule((SCHEDULE_DAY + timedelta(days=offset)).isoformat())
+        other_day_ms = (time.perf_counter() - started) * 1000 / 7
+
+        results[str(size)] = {
+            'doses': len(schedule),
+            'index_load_ms': round(load_ms, 2),
+            'first_call_ms': round(first_ms, 3),
+            'cached_call_ms': round(cached_ms, 3),
+            'new_day_ms': round(other_day_ms, 3)
+        }
+    return results
+
+
+def bench_cleanup(args):
+    """cleanup_old_prescriptions(retention_days=30) where half the prescriptions ended long ago"""
+    results = {}
+    today = datetime.now().date()
+    for size in args.cleanup_sizes:
+        handler, table = fresh_table(args.aws_ms / 1000)
+        items = make_items(size, today)
+        for item in items[::2]:
+            item['end_date'] = (today - timedelta(days=90)).isoformat()
+        for item in items[1::2]:
+            item['end_date'] = (today + timedelta(days=10)).isoformat()
+        table.seed(items)
+
+        started = time.perf_counter()
+        result = handler.cleanup_old_prescriptions(retention_days=30)
+        elapsed = time.perf_counter() - started
+        drain_outbox()
+        results[str(size)] = {
+            'deleted': result['deleted'],
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'deleted_per_s': round(result['deleted'] / elapsed, 1),
+            'remaining': len(table.items)
+        }
+    return results
+
+
+def bench_poller(args):
+    """Upload a backlog of images to the bucket, then one poll queues them all; time until every one is done"""
+    fresh_table(args.aws_ms / 1000)
+    s3 = clients.s3()
+    keys = [f"incoming/rx_{index:05d}.jpg" for index in range(args.backlog)]
+    for key, image in zip(keys, make_images(args.backlog, 'poll')):
+        s3.put_object(Bucket=PRESCRIPTION_BUCKET, Key=key, Body=image, ContentType='image/jpeg')
+
+    processor = S3ImageProcessor()
+    processor._state = PollerState(PRESCRIPTION_BUCKET, path=os.path.join(os.environ['STATE_DIR'], 'poller_bench.db'))
+    started = time.perf_counter()
+    queued = processor.poll_bucket_for_images(full_scan=True)
+    processor.executor.shutdown(wait=True)
+    elapsed = time.perf_counter() - started
+    drain_outbox()
+    failed = len(processor.state.needs_processing(keys))
+    return {
+        'backlog': len(keys),
+        'queued': queued,
+        'failed': failed,
+        'drained_ms': round(elapsed * 1000, 1),
+        'images_per_s': round((queued - failed) / elapsed, 2)
+    }
+
+
+def bench_conflicts(args):
+    """find_timing_conflicts, best of 3"""
+    results = {}
+    for size in args.conflict_sizes:
+        prescriptions = make_prescriptions(size)
+        timings = []
+        for _ in range(3):
+            started = time.perf_counter()
+            conflicts = find_timing_conflicts(prescriptions)
+            timings.append(time.perf_counter() - started)
+        results[str(size)] = {'conflicts': len(conflicts), 'elapsed_ms': round(min(timings) * 1000, 3)}
+    return results
+
+
+SCENARIOS = {
+    'upload': bench_upload,
+    'schedule': bench_schedule,
+    'cleanup': bench_cleanup,
+    'poller': bench_poller,
+    'conflicts': bench_conflicts,
+}
+
+
+def git_revision():
+    """Short commit hash, with -dirty when the tree has uncommitted changes"""
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short=12', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCH_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return f"{revision}-dirty" if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def lower_is_better(metric):
+    """True for times, False for rates, None for counts that are only reported"""
+    if metric.endswith('_per_s'):
+        return False
+    if metric.endswith(('_ms', '_s')):
+        return True
+    return None
+
+
+def compare(baseline, current, threshold):
+    """Print each metric against the baseline run and return the regressions"""
+    old, new = flatten(baseline['scenarios']), flatten(current['scenarios'])
+    regressions = []
+    print(f"\nagainst {baseline['revision']} ({baseline['created_at']}), regression threshold {threshold:.0%}\n")
+    print(f"{'metric':<40} {'before':>12} {'after':>12} {'change':>8}")
+    for metric in sorted(old.keys() & new.keys()):
+        before, after = old[metric], new[metric]
+        change = (after - before) / before if before else 0.0
+        direction = lower_is_better(metric)
+        worse = direction is not None and (change > threshold if direction else change < -threshold)
+        if worse:
+            regressions.append(metric)
+        print(f"{metric:<40} {before:12g} {after:12g} {change:7.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    cli.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated subset of ' + ', '.join(SCENARIOS))
+    cli.add_argument('--output', help='results file (default benchmarks/results/<revision>.json)')
+    cli.add_argument('--compare', help='earlier results file to compare against')
+    cli.add_argument('--threshold', type=float, default=0.10, help='relative change that counts as a regression')
+    cli.add_argument('--llm-ms', type=float, default=200, help='fake Anthropic latency')
+    cli.add_argument('--aws-ms', type=float, default=2, help='stub DynamoDB latency per call')
+    cli.add_argument('--uploads', type=int, default=100)
+    cli.add_argument('--concurrency', type=int, default=8)
+    cli.add_argument('--schedule-sizes', type=sizes, default=[10, 1000, 100000])
+    cli.add_argument('--cleanup-sizes', type=sizes, default=[1000, 10000, 50000])
+    cli.add_argument('--backlog', type=int, default=40, help='images waiting in the bucket for the poller')
+    cli.add_argument('--conflict-sizes', type=sizes, default=[15, 100, 1000, 5000])
+    args = cli.parse_args()
+
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = set(names) - SCENARIOS.keys()
+    if unknown:
+        cli.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    mock = mock_aws()
+    mock.start()
+    clients.override('anthropic', FakeAnthropic(args.llm_ms / 1000))
+    clients.s3().create_bucket(Bucket=PRESCRIPTION_BUCKET,
+                               CreateBucketConfiguration={'LocationConstraint': os.environ['AWS_DEFAULT_REGION']})
+
+    results = {
+        'revision': git_revision(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'scenarios': {}
+    }
+    for name in names:
+        started = time.perf_counter()
+        results['scenarios'][name] = SCENARIOS[name](args)
+        print(f"{name:<10} {time.perf_counter() - started:6.1f}s  {json.dumps(results['scenarios'][name])}")
+    mock.stop()
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', f"{results['revision']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,108 @@
-from flask import Flask, request, jsonify
-from mobile_upload import process_prescription_from_mobile
-import os
+from flask import Flask, Request, Response, request, jsonify, g, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from mobile_upload import process_prescription_from_mobile, stream_prescription_from_mobile, encode_events
+from job_queue import JobQueue, QueueFullError
+from metrics import metrics, stage, new_trace
+from batch_upload import expand_uploads, is_zip_upload, process_prescription_batch, BATCH_MAX_FILES, ZIP_MAGIC
+from image_pipeline import read_limited, UploadTooLarge, MAX_UPLOAD_BYTES
+from prescription_handler import PrescriptionHandler
+from device_config import encode_schedule, schedule_etag, encode_schedule_range, schedule_range_etag
+from log_config import configure_logging
 from dotenv import load_dotenv
-import tempfile
+from datetime import datetime, timedelta
+import io
+import math
+import os
+import re
 
 load_dotenv()  # Load environment variables
+configure_logging()
+
+# Multipart overhead allowed on top of the image itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+SCHEDULE_LONG_POLL_MAX_SECONDS = float(os.getenv('SCHEDULE_LONG_POLL_MAX_SECONDS', '30'))
+SCHEDULE_RANGE_DEFAULT_DAYS = 7
+
+# Patient and dispenser ids accepted in X-Patient-Id / X-Device-Id
+TENANT_ID_PATTERN = re.compile(r'[A-Za-z0-9_.:-]{1,128}')
+
+# Routes taking many images; they get a larger body limit and spool to temp files
+BATCH_ENDPOINTS = ('upload_prescriptions',)
+BATCH_MAX_CONTENT_LENGTH = MAX_UPLOAD_BYTES * BATCH_MAX_FILES + FORM_OVERHEAD_BYTES
+
+class InMemoryRequest(Request):
+    """Keeps single-image uploads in memory instead of spooling them to temp files.
+
+    MAX_CONTENT_LENGTH (one image) bounds those requests, chunked ones
+    included, so the buffers are bounded too. Batch routes allow
+    BATCH_MAX_CONTENT_LENGTH and keep Werkzeug's spooling to disk.
+    """
+    @property
+    def max_content_length(self):
+        if self.endpoint in BATCH_ENDPOINTS:
+            return BATCH_MAX_CONTENT_LENGTH
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint in BATCH_ENDPOINTS:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return io.BytesIO()
 
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES
+
+jobs = JobQueue(process_prescription_from_mobile)
+
+def read_upload(file):
+    """Read one uploaded image, enforcing the per-image size limit"""
+    return read_limited(file.stream, MAX_UPLOAD_BYTES)
+
+def read_batch_uploads(files):
+    """Read a batch's parts as (filename, bytes) pairs.
+
+    A zip archive may use whatever is left of the batch's budget
+    (BATCH_MAX_CONTENT_LENGTH less the parts read so far); a plain image,
+    like each image inside an archive, is held to MAX_UPLOAD_BYTES.
+    """
+    uploads = []
+    remaining = BATCH_MAX_CONTENT_LENGTH - FORM_OVERHEAD_BYTES
+    for i, file in enumerate(files):
+        filename = file.filename or f"file{i}"
+        head = file.stream.read(len(ZIP_MAGIC))
+        if is_zip_upload(filename, head):
+            limit, what = remaining, f"the {remaining} bytes left in the batch"
+        else:
+            limit, what = MAX_UPLOAD_BYTES, f"{MAX_UPLOAD_BYTES} bytes"
+        try:
+            data = head + read_limited(file.stream, limit - len(head))
+        except UploadTooLarge:
+            raise UploadTooLarge(f"{filename} exceeds {what}")
+        remaining -= len(data)
+        uploads.append((filename, data))
+    return uploads
+
+@app.before_request
+def start_trace():
+    g.trace_id = new_trace(request.headers.get('X-Request-ID'))
+
+@app.before_request
+def read_tenant():
+    """Patient and dispenser for the request; without the headers, the defaults in prescription_store"""
+    g.patient_id = request.headers.get('X-Patient-Id') or None
+    g.device_id = (request.view_args or {}).get('device_id') or request.headers.get('X-Device-Id') or None
+    for value in (g.patient_id, g.device_id):
+        if value is not None and not TENANT_ID_PATTERN.fullmatch(value):
+            return jsonify({"error": "Invalid patient or device id"}), 400
+
+@app.after_request
+def add_trace_header(response):
+    response.headers['X-Trace-Id'] = g.get('trace_id', '')
+    return response
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({"error": "Upload too large"}), 413
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -15,27 +111,191 @@ def health_check():
 @app.route('/upload-prescription', methods=['POST'])
 def upload_prescription():
     try:
-        if 'prescription' not in request.files:
-            return jsonify({"error": "No prescription image provided"}), 400
-            
-        file = request.files['prescription']
-        
-        # Save temporarily
-        temp_dir = tempfile.mkdtemp()
-        temp_path = os.path.join(temp_dir, 'prescription.jpg')
-        file.save(temp_path)
-        
+        # Reject oversized uploads before the body is read
+        if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES:
+            return jsonify({"error": f"Image exceeds {MAX_UPLOAD_BYTES} bytes"}), 413
+
+        with stage('request_receive'):
+            if 'prescription' not in request.files:
+                return jsonify({"error": "No prescription image provided"}), 400
+            image_bytes = read_upload(request.files['prescription'])
+
+        # Async mode: hand the image to the worker pool and return a job id
+        if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+            job_id = jobs.submit(image_bytes, g.patient_id, g.device_id)
+            return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
         # Process prescription
-        result = process_prescription_from_mobile(temp_path)
-        
-        # Cleanup
-        os.remove(temp_path)
-        os.rmdir(temp_dir)
-        
+        result = process_prescription_from_mobile(image_bytes, g.patient_id, g.device_id)
+
         return jsonify(result), 200
-        
+
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+
+    except RequestEntityTooLarge as e:
+        return request_too_large(e)
+
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": "5"}
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/upload-prescription/stream', methods=['POST'])
+def upload_prescription_stream():
+    """/upload-prescription as server-sent events: fields and timings as Claude reads them, then the summary"""
+    try:
+        if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES:
+            return jsonify({"error": f"Image exceeds {MAX_UPLOAD_BYTES} bytes"}), 413
+
+        with stage('request_receive'):
+            if 'prescription' not in request.files:
+                return jsonify({"error": "No prescription image provided"}), 400
+            image_bytes = read_upload(request.files['prescription'])
+
+        events = encode_events(stream_prescription_from_mobile(image_bytes, g.patient_id, g.device_id))
+        response = Response(stream_with_context(events), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+
+    except RequestEntityTooLarge as e:
+        return request_too_large(e)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/upload-prescriptions', methods=['POST'])
+def upload_prescriptions():
+    try:
+        with stage('request_receive'):
+            files = request.files.getlist('prescriptions') or request.files.getlist('prescription')
+            if not files:
+                return jsonify({"error": "No prescription images provided"}), 400
+            images = expand_uploads(read_batch_uploads(files))
+        if not images:
+            return jsonify({"error": "No prescription images found in upload"}), 400
+
+        result = process_prescription_batch(images, patient_id=g.patient_id, device_id=g.device_id)
+
+        if result['failed'] == 0:
+            status = 200
+        elif result['saved'] == 0:
+            status = 422
+        else:
+            status = 207
+        return jsonify(result), status
+
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+
+    except RequestEntityTooLarge as e:
+        return request_too_large(e)
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/upcoming-alarms', methods=['GET'])
+def upcoming_alarms():
+    """Compact schedule for the dispenser.
+
+    Send If-None-Match with the last ETag to get a 304 when nothing changed;
+    add ?wait=<seconds> to hold the request until the schedule changes.
+    """
+    try:
+        day = request.args.get('date') or datetime.now().date().isoformat()
+        datetime.strptime(day, '%Y-%m-%d')
+        wait = request.args.get('wait', '0')
+        try:
+            wait = float(wait)
+        except ValueError:
+            raise ValueError(f"wait must be a number of seconds, not {wait!r}")
+        if not math.isfinite(wait):
+            raise ValueError("wait must be a finite number of seconds")
+        wait = min(max(wait, 0.0), SCHEDULE_LONG_POLL_MAX_SECONDS)
+
+        handler = PrescriptionHandler(g.patient_id, g.device_id)
+        version = handler.schedule_version()
+        if request.if_none_match.contains(schedule_etag(day, version)):
+            if wait:
+                with stage('schedule_long_poll'):
+                    version = handler.wait_for_schedule_change(version, wait)
+            if request.if_none_match.contains(schedule_etag(day, version)):
+                metrics.increment('schedule_requests_total', result='not_modified')
+                response = app.response_class(status=304)
+                response.set_etag(schedule_etag(day, version))
+                return response
+
+        version, schedule = handler.get_schedule_snapshot(day)
+        metrics.increment('schedule_requests_total', result='full')
+        response = app.response_class(encode_schedule(day, version, schedule), mimetype='application/json')
+        response.set_etag(schedule_etag(day, version))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/schedule-range', methods=['GET'])
+def schedule_range():
+    """Every dose from ?start= through ?end= (or ?days=, default 7), for devices to cache offline"""
+    try:
+        start = request.args.get('start') or datetime.now().date().isoformat()
+        end = request.args.get('end')
+        if not end:
+            days = request.args.get('days', SCHEDULE_RANGE_DEFAULT_DAYS, type=int)
+            end = (datetime.strptime(start, '%Y-%m-%d').date() + timedelta(days=days - 1)).isoformat()
+
+        handler = PrescriptionHandler(g.patient_id, g.device_id)
+        etag = schedule_range_etag(start, end, handler.schedule_version())
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        snapshot = handler.get_schedule_range_snapshot(start, end)
+        response = app.response_class(encode_schedule_range(snapshot), mimetype='application/json')
+        response.set_etag(schedule_range_etag(start, end, snapshot.version))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/devices/<device_id>/resync', methods=['POST'])
+def resync_device(device_id):
+    """Called by a dispenser that missed a config delta; a full config follows over IoT"""
+    try:
+        prescriptions = PrescriptionHandler(g.patient_id, g.device_id).resync_device()
+        return jsonify({"status": "queued", "device_id": device_id, "prescriptions": prescriptions}), 202
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(job), 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8000)
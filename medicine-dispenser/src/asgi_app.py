@@ -0,0 +1,236 @@
+"""Async serving mode: the upload API on an event loop instead of sync workers.
+
+Run with ``uvicorn asgi_app:app --host 0.0.0.0 --port 8000``; a single
+worker keeps hundreds of uploads in flight while they wait on S3,
+DynamoDB and Anthropic.
+"""
+import io
+import math
+import os
+import re
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from quart import Quart, Request, request, jsonify, g
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from async_pipeline import AsyncPrescriptionPipeline
+from device_config import encode_schedule, schedule_etag, encode_schedule_range, schedule_range_etag
+from image_pipeline import read_limited, UploadTooLarge, MAX_UPLOAD_BYTES
+from log_config import configure_logging
+from metrics import metrics, stage, new_trace
+from mobile_upload import format_event
+
+load_dotenv()  # Load environment variables
+configure_logging()
+
+# Multipart overhead allowed on top of the image itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+SCHEDULE_LONG_POLL_MAX_SECONDS = float(os.getenv('SCHEDULE_LONG_POLL_MAX_SECONDS', '30'))
+SCHEDULE_RANGE_DEFAULT_DAYS = 7
+# Patient and dispenser ids accepted in X-Patient-Id / X-Device-Id
+TENANT_ID_PATTERN = re.compile(r'[A-Za-z0-9_.:-]{1,128}')
+
+
+def in_memory_stream(total_content_length, content_type, filename=None, content_length=None):
+    return io.BytesIO()
+
+
+class InMemoryRequest(Request):
+    """Keeps uploaded files in memory instead of spooling them to temp files"""
+    def make_form_data_parser(self):
+        parser = super().make_form_data_parser()
+        parser.stream_factory = in_memory_stream
+        return parser
+
+
+app = Quart(__name__)
+app.request_class = InMemoryRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES
+
+pipeline = AsyncPrescriptionPipeline()
+
+
+@app.before_serving
+async def start_pipeline():
+    await pipeline.start()
+
+
+@app.after_serving
+async def stop_pipeline():
+    await pipeline.close()
+
+
+@app.before_request
+async def start_trace():
+    g.trace_id = new_trace(request.headers.get('X-Request-ID'))
+
+
+@app.before_request
+async def read_tenant():
+    """Patient and dispenser for the request; without the headers, the defaults in prescription_store"""
+    g.patient_id = request.headers.get('X-Patient-Id') or None
+    g.device_id = (request.view_args or {}).get('device_id') or request.headers.get('X-Device-Id') or None
+    for value in (g.patient_id, g.device_id):
+        if value is not None and not TENANT_ID_PATTERN.fullmatch(value):
+            return jsonify({"error": "Invalid patient or device id"}), 400
+
+
+@app.after_request
+async def add_trace_header(response):
+    response.headers['X-Trace-Id'] = g.get('trace_id', '')
+    return response
+
+
+@app.errorhandler(RequestEntityTooLarge)
+async def request_too_large(e):
+    return jsonify({"error": "Upload too large"}), 413
+
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    return jsonify({"status": "healthy"}), 200
+
+
+@app.route('/upload-prescription', methods=['POST'])
+async def upload_prescription():
+    try:
+        with stage('request_receive'):
+            files = await request.files
+            if 'prescription' not in files:
+                return jsonify({"error": "No prescription image provided"}), 400
+            image_bytes = read_limited(files['prescription'].stream, MAX_UPLOAD_BYTES)
+
+        result = await pipeline.process_upload(image_bytes, g.patient_id, g.device_id)
+        return jsonify(result), 200
+
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+
+    except RequestEntityTooLarge as e:
+        return await request_too_large(e)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/upload-prescription/stream', methods=['POST'])
+async def upload_prescription_stream():
+    """/upload-prescription as server-sent events: fields and timings as Claude reads them, then the summary"""
+    try:
+        with stage('request_receive'):
+            files = await request.files
+            if 'prescription' not in files:
+                return jsonify({"error": "No prescription image provided"}), 400
+            image_bytes = read_limited(files['prescription'].stream, MAX_UPLOAD_BYTES)
+
+        async def events():
+            try:
+                async for event, data in pipeline.stream_upload(image_bytes, g.patient_id, g.device_id):
+                    yield format_event(event, data)
+            except Exception as e:
+                yield format_event('error', {'error': str(e)})
+
+        response = app.response_class(events(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        # Quart's default response timeout would cut a slow parse short
+        response.timeout = None
+        return response
+
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+
+    except RequestEntityTooLarge as e:
+        return await request_too_large(e)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/upcoming-alarms', methods=['GET'])
+async def upcoming_alarms():
+    """Compact schedule for the dispenser, with If-None-Match and ?wait= long-polling"""
+    try:
+        day = request.args.get('date') or datetime.now().date().isoformat()
+        datetime.strptime(day, '%Y-%m-%d')
+        wait = request.args.get('wait', '0')
+        try:
+            wait = float(wait)
+        except ValueError:
+            raise ValueError(f"wait must be a number of seconds, not {wait!r}")
+        if not math.isfinite(wait):
+            raise ValueError("wait must be a finite number of seconds")
+        wait = min(max(wait, 0.0), SCHEDULE_LONG_POLL_MAX_SECONDS)
+
+        handler = pipeline.handler_for(g.patient_id, g.device_id)
+        version = await pipeline.run_blocking(handler.schedule_version)
+        if request.if_none_match.contains(schedule_etag(day, version)):
+            if wait:
+                with stage('schedule_long_poll'):
+                    version = await pipeline.wait_for_schedule_change(handler, version, wait)
+            if request.if_none_match.contains(schedule_etag(day, version)):
+                metrics.increment('schedule_requests_total', result='not_modified')
+                response = app.response_class('', status=304)
+                response.set_etag(schedule_etag(day, version))
+                return response
+
+        version, schedule = await pipeline.run_blocking(handler.get_schedule_snapshot, day)
+        metrics.increment('schedule_requests_total', result='full')
+        response = app.response_class(encode_schedule(day, version, schedule), mimetype='application/json')
+        response.set_etag(schedule_etag(day, version))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/schedule-range', methods=['GET'])
+async def schedule_range():
+    """Every dose from ?start= through ?end= (or ?days=, default 7), for devices to cache offline"""
+    try:
+        start = request.args.get('start') or datetime.now().date().isoformat()
+        end = request.args.get('end')
+        if not end:
+            days = request.args.get('days', SCHEDULE_RANGE_DEFAULT_DAYS, type=int)
+            end = (datetime.strptime(start, '%Y-%m-%d').date() + timedelta(days=days - 1)).isoformat()
+
+        handler = pipeline.handler_for(g.patient_id, g.device_id)
+        etag = schedule_range_etag(start, end, await pipeline.run_blocking(handler.schedule_version))
+        if request.if_none_match.contains(etag):
+            response = app.response_class('', status=304)
+            response.set_etag(etag)
+            return response
+
+        snapshot = await pipeline.run_blocking(handler.get_schedule_range_snapshot, start, end)
+        response = app.response_class(encode_schedule_range(snapshot), mimetype='application/json')
+        response.set_etag(schedule_range_etag(start, end, snapshot.version))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/devices/<device_id>/resync', methods=['POST'])
+async def resync_device(device_id):
+    """Called by a dispenser that missed a config delta; a full config follows over IoT"""
+    try:
+        handler = pipeline.handler_for(g.patient_id, g.device_id)
+        prescriptions = await pipeline.run_blocking(handler.resync_device)
+        return jsonify({"status": "queued", "device_id": device_id, "prescriptions": prescriptions}), 202
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
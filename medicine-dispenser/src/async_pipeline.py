@@ -0,0 +1,162 @@
+import asyncio
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from datetime import datetime
+
+import aioboto3
+from botocore.config import Config
+
+from mobile_upload import (S3ImageProcessor, optimize_image, retention_days, build_summary,
+                           PRESCRIPTION_BUCKET, PRESIGNED_URL_EXPIRY)
+from prescription_handler import PrescriptionHandler, SCHEDULE_POLL_CHECK_SECONDS
+from prescription_parser import AsyncPrescriptionParser
+from metrics import stage
+
+# Pillow decoding and the sync handler steps (including its DynamoDB calls) share this pool
+ASYNC_BLOCKING_WORKERS = int(os.getenv('ASYNC_BLOCKING_WORKERS', '8'))
+# Connections per aiobotocore client; one event loop can have many requests in flight
+ASYNC_AWS_MAX_CONNECTIONS = int(os.getenv('ASYNC_AWS_MAX_CONNECTIONS', '100'))
+# How often a long-poll looks at the in-process schedule index
+SCHEDULE_WATCH_INTERVAL = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPrescriptionPipeline:
+    """Async counterpart of the upload pipeline in mobile_upload, for the ASGI app.
+
+    S3 and Anthropic are awaited on aiobotocore / AsyncAnthropic clients
+    opened once per event loop. Pillow work and the steps that stay on the
+    sync handler (cleanup, schedule index, the outbox commit) run in a
+    bounded thread pool, so the loop only ever waits on I/O. DynamoDB
+    writes and device publishes are delivered by the outbox flusher.
+
+    DynamoDB is not on aioboto3: the handler's reads (cleanup listings,
+    id lookups, device resyncs, schedules missing from the index) are
+    blocking boto3 calls on that pool. At most ASYNC_BLOCKING_WORKERS of
+    them run at once per process, and they queue behind image decoding,
+    so a slow table shows up as pool wait rather than as more requests in
+    flight.
+    """
+
+    def __init__(self, blocking_workers: int = ASYNC_BLOCKING_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix='async-blocking')
+        self._stack = None
+        self.s3 = None
+        self.handler = None
+        self.parser = None
+
+    async def start(self):
+        """Open the async AWS clients and build the shared handler and parser"""
+        session = aioboto3.Session()
+        config = Config(max_pool_connections=ASYNC_AWS_MAX_CONNECTIONS)
+        self._stack = AsyncExitStack()
+        self.s3 = await self._stack.enter_async_context(session.client('s3', config=config))
+        self.handler = await self.run_blocking(PrescriptionHandler)
+        self.parser = AsyncPrescriptionParser(executor=self.executor)
+        logger.info("Async pipeline ready")
+
+    async def close(self):
+        if self._stack is not None:
+            await self._stack.aclose()
+            self._stack = None
+        self.executor.shutdown(wait=False)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Run a blocking call on the pool, keeping the caller's trace id"""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, lambda: context.run(func, *args, **kwargs))
+
+    async def prepare_image_bytes(self, img_data, optimized_key):
+        """Normalize and upload an image; return (presigned_url, cache_key, image)"""
+        with stage('image_decode'):
+            img, cache_key, optimized = await self.run_blocking(optimize_image, img_data)
+
+        with stage('s3_upload'):
+            await self.s3.put_object(Bucket=PRESCRIPTION_BUCKET, Key=optimized_key, Body=optimized,
+                                     ContentType='image/jpeg')
+
+        with stage('presigned_url'):
+            url = await self.s3.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': PRESCRIPTION_BUCKET, 'Key': optimized_key},
+                ExpiresIn=PRESIGNED_URL_EXPIRY
+            )
+        return url, cache_key, img
+
+    def handler_for(self, patient_id: str = None, device_id: str = None) -> PrescriptionHandler:
+        """The shared handler for the default patient and dispenser, or one for the given ids"""
+        if patient_id is None and device_id is None:
+            return self.handler
+        return PrescriptionHandler(patient_id, device_id)
+
+    async def save_prescription(self, handler, prescription):
+        """Commit the prescription to the outbox on the pool; the flusher writes it to DynamoDB"""
+        with stage('outbox_commit'):
+            return await self.run_blocking(handler.save_prescription, prescription)
+
+    async def wait_for_schedule_change(self, handler, version, timeout: float):
+        """Async form of PrescriptionHandler.wait_for_schedule_change that holds no pool thread"""
+        loop = asyncio.get_running_loop()
+        index = handler.schedule_index
+        deadline = loop.time() + timeout
+        next_check = loop.time() + SCHEDULE_POLL_CHECK_SECONDS
+        while index.version == version:
+            now = loop.time()
+            if now >= deadline:
+                break
+            if now >= next_check:
+                await self.run_blocking(handler.refresh_schedule_index, max_age=SCHEDULE_POLL_CHECK_SECONDS)
+                next_check = now + SCHEDULE_POLL_CHECK_SECONDS
+            else:
+                await asyncio.sleep(min(SCHEDULE_WATCH_INTERVAL, deadline - now))
+        return index.version
+
+    async def process_upload(self, image_bytes, patient_id: str = None, device_id: str = None):
+        """Run the full pipeline for an uploaded image and return the summary"""
+        handler = self.handler_for(patient_id, device_id)
+        try:
+            url, cache_key, image = await self.prepare_image_bytes(image_bytes, S3ImageProcessor.new_upload_key())
+
+            with stage('cleanup'):
+                await self.run_blocking(handler.cleanup_old_prescriptions, retention_days=retention_days())
+
+            prescription = await self.parser.parse_prescription(url, cache_key=cache_key, image=image)
+            prescription_id = await self.save_prescription(handler, prescription)
+            schedule = await self.run_blocking(handler.get_daily_schedule)
+
+            return build_summary(prescription_id, prescription, schedule)
+
+        except Exception as e:
+            logger.error("Error handling prescription processing: %s", e)
+            raise e
+
+    async def stream_upload(self, image_bytes, patient_id: str = None, device_id: str = None):
+        """process_upload as (event, data) pairs; see mobile_upload.stream_prescription_from_mobile"""
+        handler = self.handler_for(patient_id, device_id)
+        try:
+            url, cache_key, image = await self.prepare_image_bytes(image_bytes, S3ImageProcessor.new_upload_key())
+            yield 'uploaded', {'upload_time': datetime.now().isoformat()}
+
+            with stage('cleanup'):
+                await self.run_blocking(handler.cleanup_old_prescriptions, retention_days=retention_days())
+
+            prescription = None
+            async for event in self.parser.parse_prescription_stream(url, cache_key=cache_key, image=image):
+                if event.kind == 'result':
+                    prescription = event.data
+                else:
+                    yield event.kind, event.data
+            yield 'parsed', prescription.model_dump(mode='json')
+
+            prescription_id = await self.save_prescription(handler, prescription)
+            schedule = await self.run_blocking(handler.get_daily_schedule)
+            yield 'done', build_summary(prescription_id, prescription, schedule)
+
+        except Exception as e:
+            logger.error("Error handling prescription processing: %s", e)
+            raise e
@@ -0,0 +1,121 @@
+import contextvars
+import io
+import logging
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from mobile_upload import S3ImageProcessor, retention_days
+from prescription_handler import PrescriptionHandler
+from prescription_parser import PrescriptionParser
+from metrics import stage
+from image_pipeline import read_limited, MAX_UPLOAD_BYTES
+
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '50'))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+ZIP_MAGIC = b'PK\x03\x04'
+
+logger = logging.getLogger(__name__)
+
+
+def _check_batch_room(images):
+    if len(images) >= BATCH_MAX_FILES:
+        raise ValueError(f"Too many images in batch (max {BATCH_MAX_FILES})")
+
+
+def is_zip_upload(filename: str, head: bytes) -> bool:
+    """Whether an uploaded part (its name and first bytes) is a zip archive"""
+    return filename.lower().endswith('.zip') or head[:4] == ZIP_MAGIC
+
+
+def expand_uploads(files):
+    """Turn uploaded (filename, bytes) pairs into image pairs, unpacking zip archives.
+
+    Zip members are decompressed one at a time under the per-image size
+    limit, and unpacking stops as soon as the batch passes BATCH_MAX_FILES.
+    """
+    images = []
+    for filename, data in files:
+        if is_zip_upload(filename, data):
+            try:
+                archive = zipfile.ZipFile(io.BytesIO(data))
+            except zipfile.BadZipFile:
+                raise ValueError(f"{filename} is not a valid zip archive")
+            with archive:
+                for member in archive.infolist():
+                    name = os.path.basename(member.filename)
+                    if member.is_dir() or name.startswith('.') or not name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    _check_batch_room(images)
+                    # file_size is what the archive claims; read_limited also counts what comes out
+                    with archive.open(member) as stream:
+                        image = read_limited(stream, MAX_UPLOAD_BYTES, expected_length=member.file_size)
+                    images.append((f"{filename}/{member.filename}", image))
+        else:
+            _check_batch_room(images)
+            images.append((filename, data))
+    return images
+
+
+def process_prescription_batch(images, concurrency: int = BATCH_CONCURRENCY, patient_id: str = None,
+                               device_id: str = None):
+    """Parse many prescription images concurrently and save them together.
+
+    Images are uploaded, normalized and parsed with at most ``concurrency``
+    in flight (the Anthropic calls are additionally rate limited). The
+    parsed prescriptions are written in one DynamoDB batch and the device
+    gets a single consolidated config update. Failures are reported per
+    file and do not stop the rest of the batch.
+    """
+    with stage('client_init'):
+        processor = S3ImageProcessor()
+        parser = PrescriptionParser()
+        handler = PrescriptionHandler(patient_id, device_id)
+
+    def parse_one(image):
+        filename, data = image
+        try:
+            url, cache_key, image = processor.prepare_image_bytes(data, processor.new_upload_key())
+            return filename, parser.parse_prescription(url, cache_key=cache_key, image=image), None
+        except Exception as e:
+            logger.warning("Failed to parse %s: %s", filename, e)
+            return filename, None, str(e)
+
+    logger.info("Processing batch of %d prescriptions (%d at a time)", len(images), concurrency)
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(images) or 1))) as pool:
+        # Each task runs in a copy of the caller's context to keep the trace id
+        futures = [pool.submit(contextvars.copy_context().run, parse_one, image) for image in images]
+        parsed = [future.result() for future in futures]
+
+    results = [
+        {'file': filename, 'status': 'error', 'error': error}
+        if error else
+        {'file': filename, 'status': 'parsed', 'medication': prescription.medication_name}
+        for filename, prescription, error in parsed
+    ]
+    successes = [(result, prescription) for result, (_, prescription, error) in zip(results, parsed) if not error]
+
+    if successes:
+        logger.debug("Cleaning up existing prescriptions...")
+        with stage('cleanup'):
+            handler.cleanup_old_prescriptions(retention_days=retention_days())
+
+        try:
+            prescription_ids = handler.save_prescriptions([prescription for _, prescription in successes])
+            for (result, _), prescription_id in zip(successes, prescription_ids):
+                result.update(status='success', prescription_id=prescription_id)
+        except Exception as e:
+            for result, _ in successes:
+                result.update(status='error', error=f"Failed to save: {e}")
+
+    saved = sum(1 for result in results if result['status'] == 'success')
+    schedule = handler.get_daily_schedule() if saved else []
+    return {
+        'upload_time': datetime.now().isoformat(),
+        'saved': saved,
+        'failed': len(results) - saved,
+        'results': results,
+        'next_dose': schedule[0].to_dict() if schedule else None
+    }
@@ -0,0 +1,173 @@
+import logging
+import os
+import threading
+
+import boto3
+import httpx
+from anthropic import Anthropic, AsyncAnthropic
+from botocore.config import Config
+
+from metrics import stage
+
+# Sized for the job, batch and poller thread pools sharing one client
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '50'))
+AWS_MAX_ATTEMPTS = int(os.getenv('AWS_MAX_ATTEMPTS', '5'))
+ANTHROPIC_MAX_CONNECTIONS = int(os.getenv('ANTHROPIC_MAX_CONNECTIONS', '20'))
+ANTHROPIC_KEEPALIVE_SECONDS = float(os.getenv('ANTHROPIC_KEEPALIVE_SECONDS', '60'))
+ANTHROPIC_TIMEOUT_SECONDS = float(os.getenv('ANTHROPIC_TIMEOUT_SECONDS', '120'))
+
+logger = logging.getLogger(__name__)
+
+AWS_CONFIG = Config(
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    retries={'mode': 'standard', 'max_attempts': AWS_MAX_ATTEMPTS}
+)
+
+
+def _anthropic_limits():
+    return httpx.Limits(
+        max_connections=ANTHROPIC_MAX_CONNECTIONS,
+        max_keepalive_connections=ANTHROPIC_MAX_CONNECTIONS,
+        keepalive_expiry=ANTHROPIC_KEEPALIVE_SECONDS
+    )
+
+
+class ThreadLocalResource:
+    """A boto3 resource that gives each thread its own resource and Table objects.
+
+    Resources are not thread-safe but the low-level client under them is,
+    so every thread's copy is built on the one shared, pooled client.
+    """
+
+    def __init__(self, shared, lock):
+        self._shared = shared
+        self._lock = lock
+        self._local = threading.local()
+        self.meta = shared.meta
+
+    def resource(self):
+        """This thread's resource"""
+        resource = getattr(self._local, 'resource', None)
+        if resource is None:
+            with self._lock:
+                resource = self._local.resource = type(self._shared)(client=self._shared.meta.client)
+        return resource
+
+    def Table(self, name):
+        return ThreadLocalTable(self, name)
+
+    def __getattr__(self, name):
+        return getattr(self.resource(), name)
+
+
+class ThreadLocalTable:
+    """A Table that resolves to the calling thread's Table object for every call"""
+
+    def __init__(self, resource, name):
+        self._resource = resource
+        self._local = threading.local()
+        self.name = name
+
+    def table(self):
+        table = getattr(self._local, 'table', None)
+        if table is None:
+            resource = self._resource.resource()
+            with self._resource._lock:
+                table = self._local.table = resource.Table(self.name)
+        return table
+
+    def __getattr__(self, name):
+        return getattr(self.table(), name)
+
+
+class ClientRegistry:
+    """AWS and Anthropic clients created once per process and shared by all threads.
+
+    Building a boto3 client resolves credentials and endpoints and each new
+    client opens its own TLS connections, so the handler, parser and S3
+    processor all take theirs from here. A forked process (gunicorn worker)
+    starts with an empty registry; sockets are never shared across processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._session = None
+        self._clients = {}
+
+    def reset(self):
+        """Drop every client; the next call builds fresh ones (tests, benchmarks, endpoint changes)"""
+        with self._lock:
+            self._reset()
+
+    def override(self, name: str, client):
+        """Use ``client`` for ``name`` ('s3', 'dynamodb', 'iot-data', 'anthropic', ...) in this process"""
+        self._check_fork()
+        with self._lock:
+            self._clients[name] = client
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _get(self, name, factory):
+        self._check_fork()
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    # boto3 sessions are not thread-safe; creation happens under the lock
+                    if self._session is None:
+                        self._session = boto3.session.Session()
+                    client = self._clients[name] = factory()
+        return client
+
+    def s3(self):
+        return self._get('s3', lambda: self._session.client('s3', config=AWS_CONFIG))
+
+    def dynamodb(self):
+        """DynamoDB resource whose Tables are per thread over one shared client"""
+        return self._get('dynamodb', lambda: ThreadLocalResource(
+            self._session.resource('dynamodb', config=AWS_CONFIG), self._lock
+        ))
+
+    def iot_data(self):
+        return self._get('iot-data', lambda: self._session.client('iot-data', config=AWS_CONFIG))
+
+    def anthropic(self) -> Anthropic:
+        return self._get('anthropic', lambda: Anthropic(
+            api_key=os.getenv('ANTHROPIC_API_KEY'),
+            http_client=httpx.Client(limits=_anthropic_limits(), timeout=ANTHROPIC_TIMEOUT_SECONDS)
+        ))
+
+    def async_anthropic(self) -> AsyncAnthropic:
+        """Async client for the ASGI app; bound to the event loop that first uses it"""
+        return self._get('async-anthropic', lambda: AsyncAnthropic(
+            api_key=os.getenv('ANTHROPIC_API_KEY'),
+            http_client=httpx.AsyncClient(limits=_anthropic_limits(), timeout=ANTHROPIC_TIMEOUT_SECONDS)
+        ))
+
+    def warm(self, table_name: str = None, bucket: str = None):
+        """Create every client and open pooled connections before taking traffic"""
+        with stage('client_warmup'):
+            try:
+                s3, dynamodb = self.s3(), self.dynamodb()
+                self.iot_data()
+                self.anthropic()
+                if bucket:
+                    s3.head_bucket(Bucket=bucket)
+                if table_name:
+                    dynamodb.meta.client.describe_table(TableName=table_name)
+            except Exception as e:
+                # Warmup is best effort; the first request sets up whatever is missing
+                logger.warning("Client warmup incomplete: %s", e)
+
+
+clients = ClientRegistry()
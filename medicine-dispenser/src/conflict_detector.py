@@ -0,0 +1,103 @@
+import numpy as np
+
+MINUTES_PER_DAY = 24 * 60
+DEFAULT_WINDOW_MINUTES = 30
+# Below this many doses the pure-Python sweep beats NumPy's setup cost
+VECTORIZE_THRESHOLD = 2000
+
+
+def timing_to_minutes(value: str) -> int:
+    """Convert an 'HH:MM' timing to minute of day"""
+    hours, minutes = value.split(':')[:2]
+    return (int(hours) * 60 + int(minutes)) % MINUTES_PER_DAY
+
+
+def _fields(prescription):
+    if isinstance(prescription, dict):
+        timings = prescription.get('timing', [])
+        return prescription.get('medication_name'), [t.get('time', '00:00') for t in timings]
+    return prescription.medication_name, [t.time for t in prescription.timing]
+
+
+def find_timing_conflicts(prescriptions, window_minutes: int = DEFAULT_WINDOW_MINUTES):
+    """Find doses of different prescriptions taken less than window_minutes apart.
+
+    Accepts PrescriptionDetails objects or prescription dicts as stored in
+    DynamoDB. Distances wrap around midnight (23:50 and 00:10 are 20 minutes
+    apart). Every timing is parsed once; the doses are sorted by minute of
+    day and swept forward around the clock, so the cost is O(n log n) plus
+    the number of conflicts found.
+    """
+    # A pair can only be within the window in one direction around the clock
+    window_minutes = min(window_minutes, MINUTES_PER_DAY // 2)
+    names, owners, times, minutes = [], [], [], []
+    for index, prescription in enumerate(prescriptions):
+        name, timings = _fields(prescription)
+        names.append(name)
+        for value in timings:
+            owners.append(index)
+            times.append(value)
+            minutes.append(timing_to_minutes(value))
+
+    if len(minutes) >= VECTORIZE_THRESHOLD:
+        pairs = _vectorized_pairs(minutes, owners, window_minutes)
+    else:
+        pairs = _sweep_pairs(minutes, owners, window_minutes)
+
+    conflicts = []
+    for a, b, diff in pairs:
+        # Report in prescription order, like the original pairwise check
+        if owners[a] > owners[b]:
+            a, b = b, a
+        conflicts.append({
+            'medication1': names[owners[a]],
+            'medication2': names[owners[b]],
+            'time1': times[a],
+            'time2': times[b],
+            'time_difference_minutes': diff
+        })
+    return conflicts
+
+
+def _sweep_pairs(minutes, owners, window):
+    order = sorted(range(len(minutes)), key=minutes.__getitem__)
+    count = len(order)
+    pairs = []
+    for position, a in enumerate(order):
+        start = minutes[a]
+        for step in range(1, count):
+            index = position + step
+            b = order[index % count]
+            # Minutes on the unrolled clock, so wrapping back to a dose at the same minute is a full day away
+            diff = minutes[b] - start + (MINUTES_PER_DAY if index >= count else 0)
+            if diff >= window:
+                break
+            if owners[a] != owners[b]:
+                pairs.append((a, b, diff))
+    return pairs
+
+
+def _vectorized_pairs(minutes, owners, window):
+    minutes = np.asarray(minutes, dtype=np.int32)
+    owners = np.asarray(owners, dtype=np.int32)
+    order = np.argsort(minutes, kind='stable')
+    sorted_minutes = minutes[order]
+    count = len(order)
+
+    # Unroll the clock once so a forward window past midnight is contiguous
+    unrolled = np.concatenate([sorted_minutes, sorted_minutes + MINUTES_PER_DAY])
+    ends = np.searchsorted(unrolled, sorted_minutes + window, side='left')
+    ends = np.minimum(ends, np.arange(count) + count)
+    spans = ends - np.arange(count) - 1
+    if spans.sum() == 0:
+        return []
+
+    first = np.repeat(np.arange(count), spans)
+    offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans) + 1
+    second = (first + offsets) % count
+
+    a = order[first]
+    b = order[second]
+    diff = (minutes[b] - minutes[a]) % MINUTES_PER_DAY
+    keep = owners[a] != owners[b]
+    return list(zip(a[keep].tolist(), b[keep].tolist(), diff[keep].tolist()))
@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import threading
+
+from metrics import stage
+from sqlite_util import connect, state_path
+
+DEVICE_COMMAND_TOPIC = os.getenv('DEVICE_COMMAND_TOPIC', 'medicine/dispenser/command')
+# Dose rows per chunk when streaming a schedule range
+SCHEDULE_RANGE_CHUNK_ROWS = 2000
+
+logger = logging.getLogger(__name__)
+
+
+def alarm_key(prescription_id: str, index: int) -> str:
+    """Identity of a prescription's index-th dose; a new time for the same dose is a change, not a new alarm"""
+    return f"{prescription_id}#{index}"
+
+
+def _minute_of_day(value: str) -> int:
+    hours, minutes = value.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def _string_table():
+    """Return (strings, ref) where ref(value) interns value and returns its index (-1 for none)"""
+    strings, positions = [], {}
+
+    def ref(value):
+        if value is None or value == '':
+            return -1
+        if value not in positions:
+            positions[value] = len(strings)
+            strings.append(value)
+        return positions[value]
+
+    return strings, ref
+
+
+def encode_config(device_id: str, version: int, base_version, added, changed, removed_ids):
+    """Build the compact config message.
+
+    Strings are deduplicated into ``s`` and alarms are rows of
+    ``[id, minute_of_day, name, dosage, with_food, instructions]`` where the
+    text fields are indexes into ``s`` (-1 for none). ``b`` is the version
+    the delta applies to; a message without ``b`` is a full config.
+    """
+    strings, ref = _string_table()
+
+    def row(alarm):
+        return [
+            alarm['alarm_id'],
+            _minute_of_day(alarm['time']),
+            ref(alarm['medication_name']),
+            ref(alarm['dosage']),
+            1 if alarm['with_food'] else 0,
+            ref(alarm.get('special_instructions'))
+        ]
+
+    message = {'a': 'cfg', 'd': device_id, 'v': version}
+    if base_version is not None:
+        message['b'] = base_version
+    if added:
+        message['add'] = [row(alarm) for alarm in added]
+    if changed:
+        message['chg'] = [row(alarm) for alarm in changed]
+    if removed_ids:
+        message['del'] = sorted(removed_ids)
+    message['s'] = strings
+    return json.dumps(message, separators=(',', ':'))
+
+
+def schedule_etag(day: str, version) -> str:
+    """Strong ETag for a day's schedule; changes with every write and at midnight"""
+    return f"{version or 0}-{day}"
+
+
+def encode_schedule(day: str, version, schedule):
+    """Build the compact schedule served to dispensers over HTTP.
+
+    Same string table as config messages; doses are rows of
+    ``[minute_of_day, name, dosage, with_food, instructions]`` in time order.
+    """
+    strings, ref = _string_table()
+    rows = [
+        [
+            _minute_of_day(slot.time),
+            ref(slot.medication_name),
+            ref(slot.dosage),
+            1 if slot.with_food else 0,
+            ref(slot.special_instructions)
+        ]
+        for slot in schedule
+    ]
+    return json.dumps({'d': day, 'v': version, 'a': rows, 's': strings}, separators=(',', ':'))
+
+
+def schedule_range_etag(start: str, end: str, version) -> str:
+    return f"{version or 0}-{start}-{end}"
+
+
+def encode_schedule_range(schedule_range):
+    """Stream a ScheduleRange as compact JSON, chunk by chunk.
+
+    Doses are rows of ``[day, minute_of_day, name, dosage, with_food,
+    instructions]`` where ``day`` counts from ``from``. Each slot's row is
+    serialized once however many days it repeats, and the string table comes
+    last so it can be filled while the rows stream.
+    """
+    strings, ref = _string_table()
+    slot_rows = {}
+
+    def row(slot_index):
+        cached = slot_rows.get(slot_index)
+        if cached is None:
+            slot = schedule_range.slots[slot_index]
+            cached = slot_rows[slot_index] = '%d,%d,%d,%d,%d]' % (
+                _minute_of_day(slot.time),
+                ref(slot.medication_name),
+                ref(slot.dosage),
+                1 if slot.with_food else 0,
+                ref(slot.special_instructions)
+            )
+        return cached
+
+    yield '{"from":%s,"to":%s,"v":%s,"a":[' % (
+        json.dumps(schedule_range.start.isoformat()), json.dumps(schedule_range.end.isoformat()),
+        json.dumps(schedule_range.version)
+    )
+    day_offsets = schedule_range.day_offsets.tolist()
+    slot_indices = schedule_range.slot_indices.tolist()
+    for begin in range(0, len(slot_indices), SCHEDULE_RANGE_CHUNK_ROWS):
+        chunk = ','.join('[%d,%s' % (day, row(slot_index)) for day, slot_index in
+                         zip(day_offsets[begin:begin + SCHEDULE_RANGE_CHUNK_ROWS],
+                             slot_indices[begin:begin + SCHEDULE_RANGE_CHUNK_ROWS]))
+        yield chunk if begin == 0 else ',' + chunk
+    yield '],"s":%s}' % json.dumps(strings, separators=(',', ':'))
+
+
+def set_alarms_operation(prescription_id: str, alarms):
+    """Outbox operation setting the alarms a prescription contributes to a device"""
+    return ['set', prescription_id, [dict(alarm) for alarm in alarms]]
+
+
+def remove_prescriptions_operation(prescription_ids):
+    return ['remove', list(prescription_ids)]
+
+
+def sync_operation(alarms_by_prescription):
+    """Outbox operation replacing all of a device's alarms and sending them as a full config"""
+    return ['sync', {prescription_id: [dict(alarm) for alarm in alarms]
+                     for prescription_id, alarms in alarms_by_prescription.items()}]
+
+
+class DeviceConfigPublisher:
+    """Publishes alarm configuration deltas to dispensers over IoT.
+
+    The current config of each device (its version and alarms) is kept in
+    SQLite, shared by all workers, along with the messages not yet accepted
+    by IoT. Changes reach it as operations queued in the outbox; every
+    operation the flusher has for a device is applied together and
+    published as one message. A device that receives a delta whose ``b``
+    is not its own version has missed one and asks for a resync
+    (POST /devices/<device_id>/resync), which queues a full config.
+    """
+
+    def __init__(self, iot, path: str = None, topic: str = DEVICE_COMMAND_TOPIC):
+        self.iot = iot
+        self.topic = topic
+        self.path = path or os.getenv('DEVICE_CONFIG_PATH') or state_path('device_config.db')
+        self._db_lock = threading.Lock()
+        self._conn = connect(self.path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS device_configs (
+                device_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                next_alarm_id INTEGER NOT NULL,
+                alarms TEXT NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS unsent_configs (
+                device_id TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (device_id, version)
+            )"""
+        )
+
+    def _load(self, device_id):
+        row = self._conn.execute(
+            'SELECT version, next_alarm_id, alarms FROM device_configs WHERE device_id = ?', (device_id,)
+        ).fetchone()
+        if row is None:
+            return 0, 1, {}
+        return row[0], row[1], json.loads(row[2])
+
+    def publish_operations(self, device_id: str, operations):
+        """Apply set/remove/sync operations to the device's config and publish the change.
+
+        A sync (sent when a device reports a version gap) makes the message a
+        full config; otherwise it is a delta against the previous version.
+
+        The new config and its message are committed together, then sent
+        outside the transaction. A message stays queued in unsent_configs
+        until IoT accepts it, so a redelivered batch of operations (which
+        finds nothing left to change) still sends what the failed attempt
+        committed. Returns the new message, or None if nothing changed.
+        """
+        with self._db_lock:
+            # BEGIN IMMEDIATE serializes publishers for the same state across workers
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                version, next_alarm_id, sent = self._load(device_id)
+                desired = {key: dict(alarm) for key, alarm in sent.items()}
+                full = False
+
+                def set_alarms(prescription_id, alarms):
+                    for index, alarm in enumerate(alarms):
+                        desired[alarm_key(prescription_id, index)] = dict(alarm, prescription_id=prescription_id)
+
+                for operation in operations:
+                    if operation[0] == 'set':
+                        _, prescription_id, alarms = operation
+                        for key in [k for k, a in desired.items() if a['prescription_id'] == prescription_id]:
+                            del desired[key]
+                        set_alarms(prescription_id, alarms)
+                    elif operation[0] == 'sync':
+                        desired.clear()
+                        for prescription_id, alarms in operation[1].items():
+                            set_alarms(prescription_id, alarms)
+                        full = True
+                    else:
+                        removed = set(operation[1])
+                        desired = {k: a for k, a in desired.items() if a['prescription_id'] not in removed}
+
+                added, changed = [], []
+                for key, alarm in desired.items():
+                    previous = sent.get(key)
+                    if previous is None:
+                        alarm['alarm_id'] = next_alarm_id
+                        next_alarm_id += 1
+                        added.append(alarm)
+                    else:
+                        alarm['alarm_id'] = previous['alarm_id']
+                        if alarm != previous:
+                            changed.append(alarm)
+                removed_ids = [alarm['alarm_id'] for key, alarm in sent.items() if key not in desired]
+
+                payload = None
+                if full:
+                    payload = encode_config(device_id, version + 1, None, list(desired.values()), [], [])
+                    logger.info("Full config v%d for %s: %d alarms (%d bytes)", version + 1, device_id,
+                                len(desired), len(payload))
+                    self._save(device_id, version + 1, next_alarm_id, desired, payload, full=True)
+                elif added or changed or removed_ids:
+                    payload = encode_config(device_id, version + 1, version, added, changed, removed_ids)
+                    logger.info("Config v%d for %s: +%d ~%d -%d (%d bytes)", version + 1, device_id,
+                                len(added), len(changed), len(removed_ids), len(payload))
+                    self._save(device_id, version + 1, next_alarm_id, desired, payload)
+                else:
+                    logger.debug("Device %s config unchanged at version %d", device_id, version)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        self._send_unsent(device_id)
+        return payload
+
+    def _save(self, device_id, version, next_alarm_id, alarms, payload, full=False):
+        if full:
+            # A full config makes any delta still waiting to be sent obsolete
+            self._conn.execute('DELETE FROM unsent_configs WHERE device_id = ?', (device_id,))
+        self._conn.execute(
+            'INSERT OR REPLACE INTO device_configs (device_id, version, next_alarm_id, alarms) VALUES (?, ?, ?, ?)',
+            (device_id, version, next_alarm_id, json.dumps(alarms))
+        )
+        self._conn.execute(
+            'INSERT OR REPLACE INTO unsent_configs (device_id, version, payload) VALUES (?, ?, ?)',
+            (device_id, version, payload)
+        )
+
+    def _send_unsent(self, device_id):
+        """Publish the device's committed but unsent messages in version order"""
+        with self._db_lock:
+            rows = self._conn.execute(
+                'SELECT version, payload FROM unsent_configs WHERE device_id = ? ORDER BY version', (device_id,)
+            ).fetchall()
+        for version, payload in rows:
+            with stage('iot_publish'):
+                self.iot.publish(topic=self.topic, qos=1, payload=payload)
+            with self._db_lock:
+                self._conn.execute('DELETE FROM unsent_configs WHERE device_id = ? AND version = ?',
+                                   (device_id, version))
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_device_publisher(iot) -> DeviceConfigPublisher:
+    """Process-wide publisher used by the outbox flusher"""
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = DeviceConfigPublisher(iot)
+    return _publisher
@@ -0,0 +1,38 @@
+# Loaded automatically by gunicorn from the working directory
+import os
+
+# Threaded workers with this many threads each, so dispensers long-polling
+# /upcoming-alarms don't hold a whole worker. Set explicitly: gunicorn only
+# switches to gthread implicitly when threads > 1, and the sync worker ignores threads
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+def on_starting(server):
+    """Drop metrics snapshots left by an earlier run"""
+    from metrics import metrics
+
+    metrics.clear()
+
+def post_fork(server, worker):
+    """Give each worker its own clients with open connections before it takes traffic"""
+    from clients import clients
+    from log_config import configure_logging
+    from mobile_upload import PRESCRIPTION_BUCKET
+    from prescription_store import open_store
+
+    # Restarts the log listener thread if the app was preloaded in the master
+    configure_logging()
+    clients.warm(table_name=open_store(clients.dynamodb()).table.name, bucket=PRESCRIPTION_BUCKET)
+    server.log.info("Worker %s warmed its AWS and Anthropic clients", worker.pid)
+
+def worker_exit(server, worker):
+    """Deliver what the outbox can before the worker goes; anything left is picked up by the next flusher"""
+    from metrics import metrics
+    from prescription_handler import get_outbox
+
+    try:
+        get_outbox().flush()
+    except Exception as e:
+        server.log.warning("Worker %s left entries in the outbox: %s", worker.pid, e)
+    # Its counts leave /metrics with it
+    metrics.remove()
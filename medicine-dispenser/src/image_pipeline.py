@@ -0,0 +1,155 @@
+import base64
+import io
+import math
+import os
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(10 * 1024 * 1024)))
+MAX_IMAGE_SIZE = (1200, 1200)
+READ_CHUNK_BYTES = 64 * 1024
+
+# LLM payload settings. The minimum edge is the legibility floor for the
+# short side of the text region and wins over the token budget.
+LLM_IMAGE_MAX_EDGE = int(os.getenv('LLM_IMAGE_MAX_EDGE', '1568'))
+LLM_IMAGE_MIN_EDGE = int(os.getenv('LLM_IMAGE_MIN_EDGE', '768'))
+LLM_IMAGE_MAX_TOKENS = int(os.getenv('LLM_IMAGE_MAX_TOKENS', '1200'))
+LLM_IMAGE_QUALITY = int(os.getenv('LLM_IMAGE_QUALITY', '70'))
+# Claude bills roughly width * height / 750 tokens per image and resizes
+# anything larger than 1568px on the long edge or ~1.15MP first
+PIXELS_PER_TOKEN = 750
+API_MAX_EDGE = 1568
+API_MAX_PIXELS = 1_150_000
+# Rows/columns with at least TEXT_DENSITY edge pixels count as text; ones
+# above LINE_DENSITY are straight lines such as the paper's border
+TEXT_DENSITY = 0.02
+LINE_DENSITY = 0.5
+TEXT_MARGIN = 0.03
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an image exceeds MAX_UPLOAD_BYTES"""
+
+
+def read_limited(stream, max_bytes: int = MAX_UPLOAD_BYTES, expected_length: int = None) -> bytes:
+    """Read a stream into memory, failing as soon as it passes max_bytes"""
+    if expected_length is not None and expected_length > max_bytes:
+        raise UploadTooLarge(f"Image is {expected_length} bytes (limit {max_bytes})")
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            return bytes(buffer)
+        buffer.extend(chunk)
+        if len(buffer) > max_bytes:
+            raise UploadTooLarge(f"Image exceeds {max_bytes} bytes")
+
+
+def normalize_image(data: bytes, max_size=MAX_IMAGE_SIZE) -> Image.Image:
+    """Decode an image at reduced resolution, upright and in RGB, fitting max_size.
+
+    For JPEGs, draft mode lets the decoder scale by 1/2, 1/4 or 1/8 while
+    decoding, so a 12MP photo is never expanded to full resolution before
+    the thumbnail step.
+    """
+    img = Image.open(io.BytesIO(data))
+    img.draft('RGB', max_size)
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    return img
+
+
+def encode_jpeg(img: Image.Image, quality: int = 85) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+class LLMImage(NamedTuple):
+    data: bytes
+    media_type: str
+    width: int
+    height: int
+    tokens: int
+
+    def content_block(self) -> dict:
+        """The image as an inline base64 content block for the messages API"""
+        return {
+            'type': 'image',
+            'source': {
+                'type': 'base64',
+                'media_type': self.media_type,
+                'data': base64.b64encode(self.data).decode('ascii')
+            }
+        }
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Input tokens Claude charges for an image, after its own resizing"""
+    scale = min(1.0, API_MAX_EDGE / max(width, height), math.sqrt(API_MAX_PIXELS / (width * height)))
+    return math.ceil(round(width * scale) * round(height * scale) / PIXELS_PER_TOKEN)
+
+
+def text_bbox(gray: Image.Image):
+    """Bounding box of the text region of a grayscale image, or None.
+
+    Works on a small copy: edge pixels are counted per row and column and
+    the box spans the rows and columns with a text-like density, which
+    ignores specks as well as long straight edges like the paper's border.
+    """
+    small = gray.copy()
+    small.thumbnail((256, 256))
+    edges = np.asarray(small.filter(ImageFilter.FIND_EDGES), dtype=np.uint8)[1:-1, 1:-1] > 48
+    if not edges.any():
+        return None
+    # Drop straight lines first so they don't add density to every crossing row/column
+    edges[edges.mean(axis=1) > LINE_DENSITY, :] = False
+    edges[:, edges.mean(axis=0) > LINE_DENSITY] = False
+    rows = np.flatnonzero(edges.mean(axis=1) >= TEXT_DENSITY)
+    cols = np.flatnonzero(edges.mean(axis=0) >= TEXT_DENSITY)
+    if not len(rows) or not len(cols):
+        return None
+
+    scale_x, scale_y = gray.width / small.width, gray.height / small.height
+    margin_x, margin_y = gray.width * TEXT_MARGIN, gray.height * TEXT_MARGIN
+    return (
+        max(0, int((cols[0] + 1) * scale_x - margin_x)),
+        max(0, int((rows[0] + 1) * scale_y - margin_y)),
+        min(gray.width, int(math.ceil((cols[-1] + 2) * scale_x + margin_x))),
+        min(gray.height, int(math.ceil((rows[-1] + 2) * scale_y + margin_y)))
+    )
+
+
+def encode_for_llm(img: Image.Image, grayscale: bool = True, crop: bool = True,
+                   max_edge: int = LLM_IMAGE_MAX_EDGE, min_edge: int = LLM_IMAGE_MIN_EDGE,
+                   max_tokens: int = LLM_IMAGE_MAX_TOKENS, quality: int = LLM_IMAGE_QUALITY) -> LLMImage:
+    """Encode an image as small as possible while keeping the text legible.
+
+    The image is converted to contrast-stretched grayscale, cropped to its
+    text region and downscaled to fit max_edge and the max_tokens budget,
+    but never so far that the short edge drops below min_edge. Images are
+    never upscaled.
+    """
+    if grayscale:
+        img = ImageOps.autocontrast(img.convert('L'), cutoff=1)
+    if crop:
+        bbox = text_bbox(img if grayscale else img.convert('L'))
+        # Only crop when it removes a meaningful part of the frame
+        if bbox and (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) < 0.9 * img.width * img.height:
+            img = img.crop(bbox)
+
+    width, height = img.size
+    scale = min(1.0, max_edge / max(width, height),
+                math.sqrt(max_tokens * PIXELS_PER_TOKEN / (width * height)))
+    scale = max(scale, min(1.0, min_edge / min(width, height)))
+    if scale < 1.0:
+        img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return LLMImage(buffer.getvalue(), 'image/jpeg', img.width, img.height,
+                    estimate_image_tokens(img.width, img.height))
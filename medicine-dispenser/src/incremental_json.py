@@ -0,0 +1,135 @@
+import json
+from typing import NamedTuple, Optional
+
+WHITESPACE = ' \t\r\n'
+
+
+class JSONEvent(NamedTuple):
+    """A value that finished arriving.
+
+    ``index`` is None for a top-level field; for an element of a top-level
+    array it is the element's position and ``key`` names the array.
+    """
+    key: str
+    index: Optional[int]
+    value: object
+
+
+class IncrementalObjectParser:
+    """Reads one JSON object from text chunks and reports values as they complete.
+
+    Top-level fields are reported once their value is complete, and so are
+    the elements of top-level arrays, so a long list can be used before the
+    closing bracket arrives. Anything before the first '{' (prose, code
+    fences) is skipped. Each character is scanned once; completed values
+    are decoded with json.loads.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.done = False
+        self._pos = 0
+        self._start = None
+        self._end = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expect_key = True
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+        self._item_start = None
+        self._item_index = 0
+
+    def feed(self, text: str):
+        """Add a chunk and return the JSONEvents it completed"""
+        self.buffer += text
+        events = []
+        buffer = self.buffer
+        for i in range(self._pos, len(buffer)):
+            if self.done:
+                break
+            c = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = json.loads(buffer[self._key_start:i + 1])
+                        self._key_start = None
+                continue
+
+            if self._depth == 0:
+                if c == '{':
+                    self._start = i
+                    self._depth = 1
+                continue
+
+            if c in WHITESPACE:
+                continue
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._key_start = i
+                else:
+                    self._mark_value(i)
+            elif c in '{[':
+                self._mark_value(i)
+                self._depth += 1
+            elif c in '}]':
+                if self._depth == 2:
+                    self._close_item(buffer, i, events)
+                self._depth -= 1
+                if self._depth == 2 and self._item_start is not None:
+                    # A container element of a top-level array just closed
+                    self._emit_item(buffer[self._item_start:i + 1], events)
+                elif self._depth == 1 and self._value_start is not None:
+                    events.append(JSONEvent(self._key, None, json.loads(buffer[self._value_start:i + 1])))
+                    self._value_start = None
+                elif self._depth == 0:
+                    self._close_field(buffer, i, events)
+                    self._end = i + 1
+                    self.done = True
+            elif c == ',':
+                if self._depth == 1:
+                    self._close_field(buffer, i, events)
+                    self._expect_key = True
+                elif self._depth == 2:
+                    self._close_item(buffer, i, events)
+            elif c == ':':
+                if self._depth == 1:
+                    self._expect_key = False
+            else:
+                self._mark_value(i)
+        self._pos = len(buffer)
+        return events
+
+    def text(self) -> str:
+        """The object's text so far, from its opening brace (to its closing one once done)"""
+        return self.buffer[self._start:self._end] if self._start is not None else ''
+
+    def _mark_value(self, i):
+        if self._depth == 1 and self._value_start is None:
+            self._value_start = i
+            self._item_index = 0
+        elif self._depth == 2 and self._item_start is None and self.buffer[self._value_start] == '[':
+            self._item_start = i
+
+    def _close_field(self, buffer, i, events):
+        """End of a scalar top-level value (containers are emitted when they close)"""
+        if self._value_start is not None:
+            events.append(JSONEvent(self._key, None, json.loads(buffer[self._value_start:i])))
+            self._value_start = None
+
+    def _close_item(self, buffer, i, events):
+        """End of a scalar array element at ',' or ']'"""
+        if self._item_start is not None and buffer[self._item_start] not in '{[':
+            self._emit_item(buffer[self._item_start:i], events)
+
+    def _emit_item(self, text, events):
+        events.append(JSONEvent(self._key, self._item_index, json.loads(text)))
+        self._item_index += 1
+        self._item_start = None
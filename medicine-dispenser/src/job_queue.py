@@ -0,0 +1,194 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from metrics import metrics
+from sqlite_util import connect, state_path
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_QUEUE_DEPTH = int(os.getenv('JOB_QUEUE_DEPTH', '16'))
+JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', '86400'))
+UNFINISHED = ('queued', 'running')
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+
+
+class JobStore:
+    """Job status records kept in SQLite so every gunicorn worker can report on any job.
+
+    Each job records the pid of the worker that queued it. Jobs only live in
+    that worker's memory, so when a store is opened, queued or running jobs
+    whose worker is gone (or whose pid this process now has) are marked
+    failed instead of being reported as pending forever.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv('JOB_DB_PATH') or state_path('jobs.db')
+        self._lock = threading.Lock()
+        self._conn = connect(self.path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                result TEXT,
+                error TEXT,
+                owner_pid INTEGER
+            )"""
+        )
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')]
+        if 'owner_pid' not in columns:
+            self._conn.execute('ALTER TABLE jobs ADD COLUMN owner_pid INTEGER')
+        self.recover()
+
+    def recover(self) -> int:
+        """Fail the unfinished jobs of workers that have exited; returns how many"""
+        pid = os.getpid()
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT DISTINCT owner_pid FROM jobs WHERE status IN (?, ?)', UNFINISHED
+            ).fetchall()
+            dead = [owner for (owner,) in rows if owner is None or owner == pid or not _pid_alive(owner)]
+            recovered = 0
+            for owner in dead:
+                recovered += self._conn.execute(
+                    'UPDATE jobs SET status = ?, updated_at = ?, error = ? '
+                    'WHERE status IN (?, ?) AND owner_pid IS ?',
+                    ('failed', time.time(), 'Worker exited before the job finished') + UNFINISHED + (owner,)
+                ).rowcount
+        if recovered:
+            logger.warning("Marked %d jobs of exited workers as failed", recovered)
+        return recovered
+
+    def create(self, job_id: str):
+        now = time.time()
+        with self._lock:
+            # Unfinished jobs expire too: a day-old queued job will never run
+            self._conn.execute('DELETE FROM jobs WHERE updated_at < ?', (now - JOB_TTL_SECONDS,))
+            self._conn.execute(
+                'INSERT INTO jobs (id, status, created_at, updated_at, owner_pid) VALUES (?, ?, ?, ?, ?)',
+                (job_id, 'queued', now, now, os.getpid())
+            )
+
+    def update(self, job_id: str, status: str, result=None, error: str = None):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET status = ?, updated_at = ?, result = ?, error = ? WHERE id = ?',
+                (status, time.time(), None if result is None else json.dumps(result, default=str), error, job_id)
+            )
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, status, created_at, updated_at, result, error FROM jobs WHERE id = ?',
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'job_id': row[0],
+            'status': row[1],
+            'created_at': datetime.fromtimestamp(row[2]).isoformat(),
+            'updated_at': datetime.fromtimestamp(row[3]).isoformat(),
+            'result': json.loads(row[4]) if row[4] else None,
+            'error': row[5]
+        }
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """Bounded in-process worker pool that runs jobs off the request thread.
+
+    Each gunicorn worker owns its own pool, so the effective capacity of the
+    service is ``workers * (JOB_WORKERS + JOB_QUEUE_DEPTH)``. Status lives in
+    the shared JobStore, which is opened on first use in each worker so
+    nothing is connected or recovered in the gunicorn master.
+    """
+
+    def __init__(self, handler, workers: int = JOB_WORKERS, max_queue: int = JOB_QUEUE_DEPTH, store: JobStore = None):
+        self.handler = handler
+        self.workers = workers
+        self._store = store
+        self._store_pid = None
+        self._max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def store(self) -> JobStore:
+        if self._store is None or self._store_pid not in (None, os.getpid()):
+            with self._start_lock:
+                if self._store is None or self._store_pid not in (None, os.getpid()):
+                    self._store = JobStore()
+                    self._store_pid = os.getpid()
+        return self._store
+
+    def _ensure_started(self):
+        # Threads are started lazily so they are created after gunicorn forks
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child inherits neither the threads nor the jobs queued in its parent
+            self._queue = queue.Queue(maxsize=self._max_queue)
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def submit(self, *args) -> str:
+        """Queue handler(*args) as a job and return its id, or raise QueueFullError"""
+        self._ensure_started()
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id)
+        try:
+            # The job runs in a copy of the request context so it keeps the trace id
+            self._queue.put_nowait((job_id, args, contextvars.copy_context()))
+        except queue.Full:
+            metrics.increment('job_queue_rejected_total')
+            self.store.update(job_id, 'failed', error='Job queue is full')
+            raise QueueFullError(f"Job queue is full ({self._queue.maxsize} pending)")
+        logger.info("Queued job %s (%d pending)", job_id, self._queue.qsize())
+        return job_id
+
+    def get(self, job_id: str):
+        return self.store.get(job_id)
+
+    def _run(self):
+        while True:
+            job_id, args, context = self._queue.get()
+            try:
+                self.store.update(job_id, 'running')
+                result = context.run(self.handler, *args)
+                self.store.update(job_id, 'succeeded', result=result)
+                logger.info("Job %s succeeded", job_id)
+            except Exception as e:
+                logger.error("Job %s failed: %s", job_id, e)
+                self.store.update(job_id, 'failed', error=str(e))
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,151 @@
+"""Leveled, structured logging written off the request thread.
+
+Modules log through ``logging.getLogger(__name__)``. ``configure_logging``
+puts a queue handler on the root logger: the calling thread only tags the
+record with its trace id, applies sampling and enqueues it; formatting
+and the stdout write happen on a listener thread. Payload dumps are
+logged at DEBUG with ``Lazy``, so they are never serialized unless DEBUG
+is enabled.
+
+Environment:
+    LOG_LEVEL        root level (default INFO)
+    LOG_FORMAT       'text' or 'json' (default text)
+    LOG_SAMPLE_RATE  fraction of traces whose DEBUG/INFO records are kept
+                     (default 1.0); warnings and errors are always kept
+    LOG_QUEUE_SIZE   records buffered before new ones are dropped
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import zlib
+from datetime import datetime
+
+from metrics import metrics, current_trace
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+_SAMPLE_BUCKETS = 10000
+
+
+class Lazy:
+    """Defer an expensive log argument (e.g. a JSON dump) until the record is formatted"""
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+class TraceSampler(logging.Filter):
+    """Tags records with the trace id and keeps a sample of traces below WARNING.
+
+    Sampling is by trace, so a kept request keeps all of its records.
+    """
+
+    def __init__(self, rate: float = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.threshold = int(max(0.0, min(rate, 1.0)) * _SAMPLE_BUCKETS)
+
+    def filter(self, record):
+        record.trace_id = current_trace()
+        if record.levelno >= logging.WARNING or self.threshold >= _SAMPLE_BUCKETS:
+            return True
+        if record.trace_id == '-':
+            return random.randrange(_SAMPLE_BUCKETS) < self.threshold
+        return zlib.crc32(record.trace_id.encode()) % _SAMPLE_BUCKETS < self.threshold
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records unformatted and drops them when the queue is full"""
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment('log_records_dropped_total')
+
+
+class StructuredFormatter(logging.Formatter):
+    """One line per record: text with key=value fields, or a JSON object.
+
+    Fields passed as ``extra={'fields': {...}}`` are appended to the line.
+    """
+
+    def __init__(self, fmt: str = LOG_FORMAT):
+        super().__init__()
+        self.json = fmt == 'json'
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        timestamp = datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')
+        trace_id = getattr(record, 'trace_id', '-')
+        if self.json:
+            entry = {'ts': timestamp, 'level': record.levelname, 'logger': record.name,
+                     'trace': trace_id, 'msg': record.getMessage(), **fields}
+            if record.exc_info:
+                entry['exc'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str, separators=(',', ':'))
+
+        line = f"{timestamp} {record.levelname} {record.name} [trace {trace_id}] {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+_lock = threading.Lock()
+_listener = None
+_pid = None
+
+
+def configure_logging(level: str = LOG_LEVEL, stream=None):
+    """Install the queue handler and start its listener; safe to call again after fork"""
+    global _listener, _pid
+    with _lock:
+        if _pid == os.getpid():
+            return
+        root = logging.getLogger()
+        for handler in [h for h in root.handlers if isinstance(h, NonBlockingQueueHandler)]:
+            root.removeHandler(handler)
+
+        records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(StructuredFormatter())
+        handler = NonBlockingQueueHandler(records)
+        handler.addFilter(TraceSampler())
+        root.addHandler(handler)
+        root.setLevel(level)
+
+        # A listener inherited through fork has no thread behind it; start a new one
+        _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+        _listener.start()
+        _pid = os.getpid()
+
+
+def stop_logging():
+    """Flush queued records; registered to run at exit"""
+    global _pid
+    with _lock:
+        if _listener is not None and _pid == os.getpid():
+            _listener.stop()
+            _pid = None
+
+
+atexit.register(stop_logging)
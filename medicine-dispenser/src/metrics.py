@@ -0,0 +1,227 @@
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+METRICS_DIR = os.getenv('METRICS_DIR') or os.path.join(os.getenv('STATE_DIR', 'state'), 'metrics')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '1'))
+
+# Upper bounds in seconds; the LLM call dominates, so the buckets reach 60s
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_HISTOGRAM = 'pipeline_stage_seconds'
+DESCRIPTIONS = {
+    STAGE_HISTOGRAM: 'Time spent in each stage of the prescription pipeline',
+    'pipeline_errors_total': 'Stages that raised an exception',
+    'pipeline_retries_total': 'Retried AWS/API calls',
+    'parse_cache_requests_total': 'Parse cache lookups by result',
+    'job_queue_rejected_total': 'Async jobs rejected because the queue was full',
+    'llm_image_bytes_total': 'Image bytes sent to the LLM',
+    'llm_image_tokens_total': 'Estimated input tokens of images sent to the LLM',
+    'schedule_requests_total': 'Device schedule fetches by result (full or not_modified)',
+    'log_records_dropped_total': 'Log records dropped because the log queue was full',
+}
+
+logger = logging.getLogger(__name__)
+
+trace_id_var = contextvars.ContextVar('trace_id', default=None)
+
+
+def new_trace(trace_id: str = None) -> str:
+    """Start a trace for the current request or job and return its id"""
+    trace_id = trace_id or uuid.uuid4().hex[:16]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+
+def current_trace() -> str:
+    return trace_id_var.get() or '-'
+
+
+class Metrics:
+    """Per-process counters and histograms, merged across gunicorn workers.
+
+    Each process periodically writes a snapshot to METRICS_DIR and
+    ``render`` sums the snapshots of every live process, so the /metrics
+    route reports the whole service no matter which worker serves it.
+    Snapshots of processes that have exited are deleted when found.
+    """
+
+    def __init__(self, directory: str = METRICS_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._path = os.path.join(self.directory, f"metrics_{self._pid}.json")
+        self._counters = {}
+        self._histograms = {}
+        self._flushed_at = 0.0
+
+    def _check_fork(self):
+        # A forked worker starts with its own empty registry and file
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + amount
+        self._maybe_flush()
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            self._check_fork()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= METRICS_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        """Write this process's snapshot for other workers to merge"""
+        with self._lock:
+            self._check_fork()
+            snapshot = json.dumps({'counters': self._counters, 'histograms': self._histograms})
+            self._flushed_at = time.monotonic()
+            path = self._path
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(snapshot)
+        os.replace(temp_path, path)
+
+    def remove(self):
+        """Delete this process's snapshot, when it exits"""
+        with self._lock:
+            path = self._path
+            self._flushed_at = float('inf')
+        _remove(path)
+
+    def clear(self):
+        """Delete every snapshot, when the service starts"""
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.json*')):
+            _remove(path)
+
+    def collect(self):
+        """Merge the snapshots of every live process"""
+        self.flush()
+        counters, histograms = {}, {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+            if not _process_alive(path):
+                _remove(path)
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, value in snapshot['counters'].items():
+                counters[key] = counters.get(key, 0) + value
+            for key, value in snapshot['histograms'].items():
+                merged = histograms.setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0})
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], value['buckets'])]
+                merged['sum'] += value['sum']
+                merged['count'] += value['count']
+        return counters, histograms
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        counters, histograms = self.collect()
+        lines = []
+        for name, series in _group(histograms).items():
+            lines.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series:
+                for bound, count in zip(BUCKETS, histogram['buckets']):
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        for name, series in _group(counters).items():
+            lines.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _process_alive(path) -> bool:
+    """Whether the process that wrote the snapshot at path is still running"""
+    try:
+        pid = int(os.path.basename(path)[len('metrics_'):-len('.json')])
+    except ValueError:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _series_key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+def _group(series):
+    """Group {series_key: value} into {name: [(labels, value), ...]} sorted by name"""
+    grouped = {}
+    for key in sorted(series):
+        name, labels = json.loads(key)
+        grouped.setdefault(name, []).append((labels, series[key]))
+    return dict(sorted(grouped.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, *extra):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def stage(name: str):
+    """Time a pipeline stage; failures are counted as errors for that stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.increment('pipeline_errors_total', stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe(STAGE_HISTOGRAM, elapsed, stage=name)
+        logger.debug("%s took %.1fms", name, elapsed * 1000,
+                     extra={'fields': {'stage': name, 'ms': round(elapsed * 1000, 1)}})
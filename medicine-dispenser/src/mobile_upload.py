@@ -1,126 +1,284 @@
 import os
-import boto3
-import base64
-from prescription_parser import PrescriptionParser, PrescriptionDetails
+import logging
+from prescription_parser import PrescriptionParser
 from prescription_handler import PrescriptionHandler
-from PIL import Image
-import io
-import json
-from datetime import date, datetime
+from parse_cache import image_cache_key
+from poller_state import PollerState
+from metrics import stage, new_trace
+from clients import clients
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from image_pipeline import read_limited, normalize_image, encode_jpeg
+from records import dumps
+from log_config import Lazy, configure_logging
+from datetime import datetime
 import uuid
-from decimal import Decimal
 import time
 
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (date, datetime)):
-            return obj.isoformat()
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super().default(obj)
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', '4'))
+POLL_FULL_SCAN_EVERY = int(os.getenv('POLL_FULL_SCAN_EVERY', '30'))
+# Our own re-uploads and images already handled by the API are not polled
+SKIP_PREFIXES = ('optimized_', 'uploads/')
+# When set, cleanup only removes prescriptions that ended this many days ago
+PRESCRIPTION_RETENTION_DAYS = os.getenv('PRESCRIPTION_RETENTION_DAYS')
+PRESCRIPTION_BUCKET = 'medicine-dispenser-prescriptions'
+PRESIGNED_URL_EXPIRY = 3600
+
+logger = logging.getLogger(__name__)
+
+def optimize_image(img_data):
+    """Normalize image bytes; return (image, cache_key, jpeg_bytes)"""
+    img = normalize_image(img_data)
+    return img, image_cache_key(img), encode_jpeg(img)
+
+def retention_days():
+    return int(PRESCRIPTION_RETENTION_DAYS) if PRESCRIPTION_RETENTION_DAYS else None
+
+def build_summary(prescription_id, prescription, schedule):
+    """The response for a processed upload"""
+    return {
+        "status": "success",
+        "prescription_id": prescription_id,
+        "upload_time": datetime.now().isoformat(),
+        "medication": prescription.medication_name,
+        "next_dose": schedule[0].to_dict() if schedule else None
+    }
 
 class S3ImageProcessor:
     def __init__(self):
-        self.s3 = boto3.client('s3')
-        self.BUCKET_NAME = 'medicine-dispenser-prescriptions'
-        self.processed_images = set()
+        self.s3 = clients.s3()
+        self.BUCKET_NAME = PRESCRIPTION_BUCKET
+        self.poll_count = 0
+        self._state = None
+        self._executor = None
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = PollerState(self.BUCKET_NAME)
+        return self._state
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='s3-poll')
+        return self._executor
 
     def create_bucket_if_not_exists(self):
         try:
-            print("\nChecking S3 bucket...")
+            logger.debug("Checking S3 bucket...")
             self.s3.head_bucket(Bucket=self.BUCKET_NAME)
-            print(f"Bucket {self.BUCKET_NAME} exists")
+            logger.info("Bucket %s exists", self.BUCKET_NAME)
         except:
-            print(f"Creating bucket {self.BUCKET_NAME}...")
+            logger.info("Creating bucket %s...", self.BUCKET_NAME)
             self.s3.create_bucket(
                 Bucket=self.BUCKET_NAME,
                 CreateBucketConfiguration={'LocationConstraint': 'us-west-2'}
             )
-            print("Bucket created successfully")
+            logger.info("Bucket created successfully")
 
-    def poll_bucket_for_images(self):
-        print("\nPolling S3 bucket for new images...")
+    def poll_bucket_for_images(self, full_scan=False):
+        """Queue images added since the last poll and return how many were queued.
+
+        Listing is paginated and resumes after the persisted checkpoint key.
+        The checkpoint only moves to image keys the poller would process, never
+        to its own re-uploads. A full (still paginated) listing is done
+        periodically to pick up keys that sort before the checkpoint; the
+        processed-key index keeps those from being reprocessed.
+        """
+        logger.debug("Polling S3 bucket for new images...")
         try:
-            response = self.s3.list_objects_v2(Bucket=self.BUCKET_NAME)
-            if 'Contents' in response:
-                for obj in response['Contents']:
+            self.poll_count += 1
+            full_scan = full_scan or self.poll_count % POLL_FULL_SCAN_EVERY == 1
+            start_after = self.state.get_checkpoint()
+
+            params = {'Bucket': self.BUCKET_NAME, 'PaginationConfig': {'PageSize': 1000}}
+            if start_after and not full_scan:
+                params['StartAfter'] = start_after
+
+            queued = 0
+            newest_key = start_after
+            paginator = self.s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(**params):
+                candidates = []
+                for obj in page.get('Contents', []):
                     key = obj['Key']
-                    if key.endswith(('.jpg', '.jpeg', '.png')) and key not in self.processed_images:
-                        print(f"New image found: {key}")
-                        self.processed_images.add(key)
-                        self.process_image_from_s3(key)
+                    if key.endswith(('.jpg', '.jpeg', '.png')) and not key.startswith(SKIP_PREFIXES):
+                        candidates.append(key)
+                        if newest_key is None or key > newest_key:
+                            newest_key = key
+
+                for key in self.state.needs_processing(candidates):
+                    with self._in_flight_lock:
+                        if key in self._in_flight:
+                            continue
+                        self._in_flight.add(key)
+                    logger.info("New image found: %s", key)
+                    self.executor.submit(self._process_polled_image, key)
+                    queued += 1
+
+            if newest_key != start_after:
+                self.state.save_checkpoint(newest_key)
+            logger.info("Queued %d new images (%s listing)", queued, 'full' if full_scan else 'incremental')
+            return queued
         except Exception as e:
-            print(f"Error polling S3 bucket: {e}")
+            logger.error("Error polling S3 bucket: %s", e)
             raise e
 
-    def process_image_from_s3(self, key):
+    def _process_polled_image(self, key):
+        trace_id = new_trace()
+        logger.info("Processing %s with trace %s", key, trace_id)
         try:
-            print("\nDownloading image from S3...")
-            obj = self.s3.get_object(Bucket=self.BUCKET_NAME, Key=key)
-            img_data = obj['Body'].read()
+            self.process_image_from_s3(key)
+            self.state.mark(key, 'done')
+        except Exception as e:
+            logger.error("Failed to process %s: %s", key, e)
+            self.state.mark(key, 'failed')
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.discard(key)
 
-            print("Processing image...")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
+    def process_image_from_s3(self, key):
+        url, cache_key, image = self.prepare_image(key)
+        return self.handle_prescription_processing(url, cache_key, image)
+
+    def prepare_image(self, key):
+        """Download, normalize and re-upload an image; return (presigned_url, cache_key, image)"""
+        try:
+            logger.debug("Downloading image from S3...")
+            with stage('s3_download'):
+                obj = self.s3.get_object(Bucket=self.BUCKET_NAME, Key=key)
+                img_data = read_limited(obj['Body'], expected_length=obj.get('ContentLength'))
+            return self.prepare_image_bytes(img_data, f"optimized_{key}")
+        except Exception as e:
+            logger.error("Error processing image: %s", e)
+            raise e
 
-            img.thumbnail((1200, 1200), Image.Resampling.LANCZOS)
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=85)
-            buffer.seek(0)
+    def prepare_image_bytes(self, img_data, optimized_key):
+        """Normalize in-memory image bytes and upload them; return (presigned_url, cache_key, image)"""
+        logger.debug("Processing image...")
+        with stage('image_decode'):
+            img, cache_key, optimized = optimize_image(img_data)
 
-            print("Re-uploading optimized image to S3...")
-            optimized_key = f"optimized_{key}"
-            self.s3.upload_fileobj(buffer, self.BUCKET_NAME, optimized_key)
+        logger.debug("Uploading optimized image to S3...")
+        with stage('s3_upload'):
+            self.s3.put_object(Bucket=self.BUCKET_NAME, Key=optimized_key, Body=optimized, ContentType='image/jpeg')
 
+        with stage('presigned_url'):
             url = self.s3.generate_presigned_url(
                 'get_object',
                 Params={'Bucket': self.BUCKET_NAME, 'Key': optimized_key},
-                ExpiresIn=3600
+                ExpiresIn=PRESIGNED_URL_EXPIRY
             )
 
-            print(f"Image optimized and uploaded: {url}")
-            self.handle_prescription_processing(url)
+        logger.debug("Image optimized and uploaded: %s", url)
+        return url, cache_key, img
+
+    def handle_prescription_processing(self, s3_url, cache_key=None, image=None, patient_id=None, device_id=None):
+        try:
+            with stage('client_init'):
+                prescription_handler = PrescriptionHandler(patient_id, device_id)
+                parser = PrescriptionParser()
+
+            logger.debug("Cleaning up existing prescriptions...")
+            with stage('cleanup'):
+                prescription_handler.cleanup_old_prescriptions(retention_days=retention_days())
+
+            logger.debug("Parsing prescription from S3 URL...")
+            prescription = parser.parse_prescription(s3_url, cache_key=cache_key, image=image)
+
+            logger.debug("Saving prescription to DynamoDB...")
+            prescription_id = prescription_handler.save_prescription(prescription)
+            logger.info("Prescription saved with ID: %s", prescription_id)
+
+            logger.debug("Generating schedule...")
+            schedule = prescription_handler.get_daily_schedule()
+            logger.debug("Today's schedule: %s", Lazy(dumps, schedule))
+
+            summary = build_summary(prescription_id, prescription, schedule)
+            logger.debug("Processing summary: %s", Lazy(dumps, summary))
+            return summary
+
         except Exception as e:
-            print(f"Error processing image: {e}")
+            logger.error("Error handling prescription processing: %s", e)
             raise e
 
-    def handle_prescription_processing(self, s3_url):
+    def stream_prescription_processing(self, s3_url, cache_key=None, image=None, patient_id=None, device_id=None):
+        """handle_prescription_processing as (event, data) pairs for server-sent events.
+
+        Fields and timings are passed on as soon as Claude has produced and
+        they have passed validation; the summary comes last, as 'done'.
+        """
         try:
-            prescription_handler = PrescriptionHandler()
-            parser = PrescriptionParser()
+            with stage('client_init'):
+                prescription_handler = PrescriptionHandler(patient_id, device_id)
+                parser = PrescriptionParser()
 
-            print("\nCleaning up existing prescriptions...")
-            prescription_handler.cleanup_old_prescriptions()
-            print("Cleanup completed")
+            with stage('cleanup'):
+                prescription_handler.cleanup_old_prescriptions(retention_days=retention_days())
 
-            print("\nParsing prescription from S3 URL...")
-            prescription = parser.parse_prescription(s3_url)
+            prescription = None
+            for event in parser.parse_prescription_stream(s3_url, cache_key=cache_key, image=image):
+                if event.kind == 'result':
+                    prescription = event.data
+                else:
+                    yield event.kind, event.data
+            yield 'parsed', prescription.model_dump(mode='json')
 
-            print("\nSaving prescription to DynamoDB...")
             prescription_id = prescription_handler.save_prescription(prescription)
-            print(f"Prescription saved with ID: {prescription_id}")
-
-            print("\nGenerating schedule...")
+            logger.info("Prescription saved with ID: %s", prescription_id)
             schedule = prescription_handler.get_daily_schedule()
-            print("\nToday's Schedule:")
-            print(json.dumps(schedule, indent=2, cls=CustomJSONEncoder))
-
-            summary = {
-                "status": "success",
-                "prescription_id": prescription_id,
-                "upload_time": datetime.now().isoformat(),
-                "medication": prescription.medication_name,
-                "next_dose": schedule[0] if schedule else None
-            }
-            print("\nProcessing Summary:")
-            print(json.dumps(summary, indent=2, cls=CustomJSONEncoder))
+            yield 'done', build_summary(prescription_id, prescription, schedule)
 
         except Exception as e:
-            print(f"Error handling prescription processing: {e}")
+            logger.error("Error handling prescription processing: %s", e)
             raise e
 
+    @staticmethod
+    def new_upload_key():
+        return f"uploads/{datetime.now().strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex}.jpg"
+
+def process_prescription_from_mobile(image_bytes, patient_id=None, device_id=None):
+    """Run the full pipeline for an image uploaded from the mobile app.
+
+    The image stays in memory: only the normalized copy is uploaded to S3.
+    Without ids the prescription goes to the default patient and dispenser.
+    """
+    processor = S3ImageProcessor()
+    try:
+        url, cache_key, image = processor.prepare_image_bytes(image_bytes, processor.new_upload_key())
+    except Exception as e:
+        logger.error("Error processing image: %s", e)
+        raise e
+    return processor.handle_prescription_processing(url, cache_key, image, patient_id, device_id)
+
+def stream_prescription_from_mobile(image_bytes, patient_id=None, device_id=None):
+    """process_prescription_from_mobile as a stream of (event, data) pairs"""
+    processor = S3ImageProcessor()
+    try:
+        url, cache_key, image = processor.prepare_image_bytes(image_bytes, processor.new_upload_key())
+    except Exception as e:
+        logger.error("Error processing image: %s", e)
+        raise e
+    yield 'uploaded', {'upload_time': datetime.now().isoformat()}
+    yield from processor.stream_prescription_processing(url, cache_key, image, patient_id, device_id)
+
+def format_event(event, data):
+    """One server-sent event"""
+    return f"event: {event}\ndata: {dumps(data)}\n\n"
+
+def encode_events(events):
+    """Server-sent events for (event, data) pairs; a failure ends the stream with an 'error' event"""
+    try:
+        for event, data in events:
+            yield format_event(event, data)
+    except Exception as e:
+        yield format_event('error', {'error': str(e)})
+
 if __name__ == "__main__":
+    configure_logging()
     processor = S3ImageProcessor()
     processor.create_bucket_if_not_exists()
 
@@ -129,4 +287,5 @@ if __name__ == "__main__":
             processor.poll_bucket_for_images()
             time.sleep(10)
     except KeyboardInterrupt:
-        print("\nPolling stopped by user.")
+        logger.info("Polling stopped by user.")
+        processor.executor.shutdown(wait=True, cancel_futures=True)
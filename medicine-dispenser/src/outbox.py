@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import NamedTuple
+
+from metrics import metrics
+from sqlite_util import connect, state_path
+
+# How long the flusher waits after a wake-up so concurrent writes share a batch
+OUTBOX_LINGER_SECONDS = float(os.getenv('OUTBOX_LINGER_SECONDS', '0.05'))
+# How often an idle flusher looks for entries from other workers and expired backoffs
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '1'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+# A claimed entry is handed to another flusher if not delivered within this time
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_MAX_BACKOFF_SECONDS', '60'))
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxEntry(NamedTuple):
+    seq: int
+    kind: str
+    target: str
+    payload: object
+    attempts: int
+
+
+def retry_delay(attempts: int) -> float:
+    """Jittered exponential backoff before delivery attempt attempts + 1"""
+    return min(OUTBOX_MAX_BACKOFF_SECONDS, 0.5 * 2 ** min(attempts, 16)) * random.uniform(0.5, 1.0)
+
+
+class Outbox:
+    """Durable write-behind queue for side effects of a request, shared by all workers.
+
+    The request path appends entries ``(kind, target, payload)`` and returns
+    once they are committed to SQLite. A flusher thread per process claims
+    ready entries with a lease, groups them by kind and target and hands
+    each group to the deliverer registered for its kind, in append order.
+    Delivered entries are deleted; a failed group is retried with backoff,
+    and later entries for the same kind and target wait behind it.
+    Delivery is at least once: an entry whose flusher dies is redelivered
+    when its lease expires, so deliverers must be idempotent.
+    """
+
+    def __init__(self, deliverers, path: str = None, batch_size: int = OUTBOX_BATCH_SIZE,
+                 linger_seconds: float = OUTBOX_LINGER_SECONDS, lease_seconds: float = OUTBOX_LEASE_SECONDS):
+        self.deliverers = deliverers
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.lease_seconds = lease_seconds
+        self.path = path or os.getenv('OUTBOX_PATH') or state_path('outbox.db')
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        # FULL: a request returns once its entries are committed, so the commit must survive power loss
+        self._conn = connect(self.path, synchronous='FULL')
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                target TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                lease_until REAL NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS outbox_stream ON outbox (kind, target, seq)')
+
+    def append(self, entries):
+        """Commit (kind, target, payload) entries in one transaction and wake the flusher"""
+        entries = list(entries)
+        if entries:
+            self._commit(lambda: entries)
+
+    def append_after_pending(self, kind: str, target: str, build):
+        """Append the entries build(payloads) returns for the undelivered payloads of kind for target.
+
+        Reading and appending share one transaction, so no other worker can
+        append to or deliver from the stream in between: anything build saw
+        as pending is still ahead of what it appends. Returns the entries.
+        """
+        return self._commit(lambda: list(build(self._pending(kind, target))))
+
+    def _commit(self, entries_fn):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                entries = entries_fn()
+                self._conn.executemany(
+                    'INSERT INTO outbox (kind, target, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+                    [(kind, target, json.dumps(payload, separators=(',', ':')), now, now)
+                     for kind, target, payload in entries]
+                )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        if entries:
+            metrics.increment('outbox_appended_total', amount=len(entries))
+            self.start()
+            self._wake.set()
+        return entries
+
+    def _pending(self, kind: str, target: str):
+        rows = self._conn.execute(
+            'SELECT payload FROM outbox WHERE kind = ? AND target = ? ORDER BY seq', (kind, target)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def pending(self, kind: str, target: str):
+        """Payloads of kind for target that have not been delivered yet, oldest first"""
+        with self._lock:
+            return self._pending(kind, target)
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def claim(self, limit: int):
+        """Lease up to limit ready entries whose kind and target have nothing earlier in flight or backing off"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    """SELECT seq, kind, target, payload, attempts FROM outbox o
+                       WHERE lease_until <= :now AND next_attempt_at <= :now
+                       AND NOT EXISTS (
+                           SELECT 1 FROM outbox p
+                           WHERE p.kind = o.kind AND p.target = o.target AND p.seq < o.seq
+                           AND (p.lease_until > :now OR p.next_attempt_at > :now)
+                       )
+                       ORDER BY seq LIMIT :limit""",
+                    {'now': now, 'limit': limit}
+                ).fetchall()
+                self._conn.executemany(
+                    'UPDATE outbox SET lease_until = ? WHERE seq = ?',
+                    [(now + self.lease_seconds, row[0]) for row in rows]
+                )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [OutboxEntry(seq, kind, target, json.loads(payload), attempts)
+                for seq, kind, target, payload, attempts in rows]
+
+    def complete(self, entries):
+        with self._lock:
+            self._conn.executemany('DELETE FROM outbox WHERE seq = ?', [(entry.seq,) for entry in entries])
+
+    def retry(self, entries):
+        """Release entries for another attempt after a backoff"""
+        attempts = max(entry.attempts for entry in entries) + 1
+        retry_at = time.time() + retry_delay(attempts)
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, lease_until = 0 WHERE seq = ?',
+                [(retry_at, entry.seq) for entry in entries]
+            )
+
+    def flush(self) -> int:
+        """Deliver every ready entry now, on the calling thread; return the number delivered"""
+        delivered = 0
+        with self._flush_lock:
+            while True:
+                entries = self.claim(self.batch_size)
+                if not entries:
+                    return delivered
+                groups = {}
+                for entry in entries:
+                    groups.setdefault((entry.kind, entry.target), []).append(entry)
+                for (kind, target), group in groups.items():
+                    try:
+                        self.deliverers[kind](target, [entry.payload for entry in group])
+                    except Exception as e:
+                        logger.error("Delivering %d %s entries for %s failed (attempt %d): %s",
+                                     len(group), kind, target, group[0].attempts + 1, e)
+                        metrics.increment('pipeline_retries_total', operation=f"outbox_{kind}")
+                        self.retry(group)
+                        continue
+                    self.complete(group)
+                    delivered += len(group)
+                    metrics.increment('outbox_delivered_total', amount=len(group), kind=kind)
+
+    def start(self):
+        """Start this process's flusher if it is not running; it first delivers anything left from before"""
+        # Per pid, so each gunicorn worker starts its own flusher after fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='outbox-flusher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(OUTBOX_POLL_SECONDS)
+            self._wake.clear()
+            if self.linger_seconds > 0:
+                time.sleep(self.linger_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Outbox flush failed: %s", e)
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlite_util import connect, state_path
+
+PARSE_CACHE_MEMORY_ENTRIES = int(os.getenv('PARSE_CACHE_MEMORY_ENTRIES', '256'))
+PARSE_CACHE_DISK_ENTRIES = int(os.getenv('PARSE_CACHE_DISK_ENTRIES', '10000'))
+PARSE_CACHE_TTL_SECONDS = int(os.getenv('PARSE_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))
+
+
+def image_cache_key(img) -> str:
+    """Hash the decoded pixels of a normalized image so re-encodes of the same photo match"""
+    digest = hashlib.sha256()
+    digest.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """Two-tier cache of validated parse results (pydantic models).
+
+    Keys come from PrescriptionParser.result_cache_key: the image hash plus
+    the model and prompt that produced the result. The memory tier is a
+    per-process LRU of models that are copied in and out, so a caller
+    editing its result cannot change what later hits see; the disk tier is
+    SQLite and is shared by every gunicorn worker and survives restarts.
+    """
+
+    def __init__(self, path: str = None, memory_entries: int = PARSE_CACHE_MEMORY_ENTRIES,
+                 disk_entries: int = PARSE_CACHE_DISK_ENTRIES, ttl_seconds: int = PARSE_CACHE_TTL_SECONDS):
+        self.path = path or os.getenv('PARSE_CACHE_PATH') or state_path('parse_cache.db')
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = connect(self.path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS parse_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS parse_cache_accessed ON parse_cache (accessed_at)')
+
+    def get(self, key: str, model):
+        """Return the cached result for key validated as model, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, prescription = entry
+                if now - created_at < self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return prescription.model_copy(deep=True)
+                del self._memory[key]
+
+            row = self._conn.execute(
+                'SELECT value, created_at FROM parse_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or now - row[1] >= self.ttl_seconds:
+                self.stats['misses'] += 1
+                return None
+
+            self._conn.execute('UPDATE parse_cache SET accessed_at = ? WHERE key = ?', (now, key))
+            prescription = model.model_validate_json(row[0])
+            self._remember(key, row[1], prescription)
+            self.stats['disk_hits'] += 1
+            return prescription
+
+    def put(self, key: str, prescription):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, prescription)
+            self._conn.execute(
+                'INSERT OR REPLACE INTO parse_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, prescription.model_dump_json(), now, now)
+            )
+            self._evict_disk(now)
+
+    def _remember(self, key, created_at, prescription):
+        self._memory[key] = (created_at, prescription.model_copy(deep=True))
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _evict_disk(self, now):
+        expired = self._conn.execute(
+            'DELETE FROM parse_cache WHERE created_at < ?', (now - self.ttl_seconds,)
+        ).rowcount
+        overflow = self._conn.execute(
+            """DELETE FROM parse_cache WHERE key IN (
+                SELECT key FROM parse_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.disk_entries,)
+        ).rowcount
+        self.stats['evictions'] += expired + overflow
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute('DELETE FROM parse_cache')
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_parse_cache() -> ParseCache:
+    """Process-wide cache shared by every PrescriptionParser"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ParseCache()
+    return _cache
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+from sqlite_util import connect, state_path
+
+POLL_MAX_ATTEMPTS = int(os.getenv('POLL_MAX_ATTEMPTS', '3'))
+
+
+class PollerState:
+    """Persistent listing checkpoint and processed-key index for the S3 poller"""
+
+    def __init__(self, bucket: str, path: str = None):
+        self.bucket = bucket
+        self.path = path or os.getenv('POLLER_STATE_PATH') or state_path('poller_state.db')
+        self._lock = threading.Lock()
+        self._conn = connect(self.path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS processed_keys (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (bucket, key)
+            ) WITHOUT ROWID"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS checkpoints (
+                bucket TEXT PRIMARY KEY,
+                start_after TEXT
+            )"""
+        )
+
+    def get_checkpoint(self):
+        """Return the key listing resumes after for the bucket, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT start_after FROM checkpoints WHERE bucket = ?', (self.bucket,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_checkpoint(self, start_after: str):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO checkpoints (bucket, start_after) VALUES (?, ?)',
+                (self.bucket, start_after)
+            )
+
+    def needs_processing(self, keys):
+        """Filter keys down to those not yet processed and not out of retries"""
+        keys = list(keys)
+        if not keys:
+            return []
+        done = set()
+        with self._lock:
+            # Chunk the lookup to stay under SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f"""SELECT key FROM processed_keys
+                        WHERE bucket = ? AND key IN ({placeholders})
+                        AND (status = 'done' OR attempts >= ?)""",
+                    [self.bucket, *chunk, POLL_MAX_ATTEMPTS]
+                ).fetchall()
+                done.update(row[0] for row in rows)
+        return [key for key in keys if key not in done]
+
+    def mark(self, key: str, status: str):
+        """Record the outcome of processing key ('done' or 'failed')"""
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO processed_keys (bucket, key, status, attempts, updated_at)
+                   VALUES (?, ?, ?, 1, ?)
+                   ON CONFLICT (bucket, key) DO UPDATE SET
+                       status = excluded.status,
+                       attempts = processed_keys.attempts + 1,
+                       updated_at = excluded.updated_at""",
+                (self.bucket, key, status, time.time())
+            )
@@ -1,230 +1,405 @@
-import boto3
-import json
-from datetime import datetime
-from decimal import Decimal
+from datetime import datetime, timedelta
 from prescription_parser import PrescriptionDetails
-from boto3.dynamodb.types import TypeDeserializer
+from records import PrescriptionRecord, dumps
+from schedule_index import get_schedule_index
+from prescription_store import open_store, DEFAULT_DEVICE_ID, DEFAULT_PATIENT_ID
+from metrics import stage
+from device_config import get_device_publisher, set_alarms_operation, remove_prescriptions_operation, sync_operation
+from outbox import Outbox
+from clients import clients
+from log_config import Lazy
+import logging
+import os
+import threading
+import time
+import uuid
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+# Seconds a worker trusts its last read of the version stamp. Writes from other
+# workers show up in its schedules (and ETags) at most this much later than its own
+SCHEDULE_VERSION_TTL = float(os.getenv('SCHEDULE_VERSION_TTL', '1'))
+# While long-polling, each worker checks the table for other workers' writes this often
+SCHEDULE_POLL_CHECK_SECONDS = float(os.getenv('SCHEDULE_POLL_CHECK_SECONDS', '2'))
+# Longest range get_schedule_range will expand
+SCHEDULE_RANGE_MAX_DAYS = int(os.getenv('SCHEDULE_RANGE_MAX_DAYS', '180'))
+
+# Outbox stream of a patient's table writes: ['put', item] and ['delete', key], in order
+PRESCRIPTION_STREAM = 'prescription'
+
+logger = logging.getLogger(__name__)
+
+def put_operation(item):
+    return ['put', item]
+
+def delete_operation(key):
+    return ['delete', key]
+
+def replay_operations(store, operations, items=None):
+    """Apply queued prescription operations in order to items (by id) and return them"""
+    items = {} if items is None else items
+    for action, value in operations:
+        if action == 'put':
+            items[value['id']] = value
+        else:
+            items.pop(store.id_for_key(value), None)
+    return items
+
+def deliver_prescription_operations(patient_id, operations):
+    """Outbox deliverer: write the net effect of queued puts and deletes, then bump the version once"""
+    store = open_store(clients.dynamodb(), patient_id)
+    puts, deletes = {}, {}
+    for action, value in operations:
+        if action == 'put':
+            puts[value['id']] = value
+            deletes.pop(value['id'], None)
+        else:
+            prescription_id = store.id_for_key(value)
+            # Still deleted in case an earlier delivery of the put reached the table
+            puts.pop(prescription_id, None)
+            deletes[prescription_id] = value
+    with stage('dynamodb_put'):
+        if puts:
+            store.put_many(puts.values())
+        if deletes:
+            _, failed = store.delete_many(deletes.values())
+            if failed:
+                raise RuntimeError(f"{len(failed)} prescription deletes left unprocessed")
+        version = store.bump_version()
+    records = [PrescriptionRecord.from_item(item) for item in puts.values()]
+
+    def apply_all(index):
+        for record in records:
+            index.upsert(record)
+        for prescription_id in deletes:
+            index.remove(prescription_id)
+    get_schedule_index(store.scope).apply_write(apply_all, version)
+    logger.info("Wrote %d prescriptions and deleted %d in DynamoDB (version %d)", len(puts), len(deletes), version)
+
+def deliver_device_operations(device_id, operations):
+    """Outbox deliverer: publish every queued change for a device as one config message"""
+    get_device_publisher(clients.iot_data()).publish_operations(device_id, operations)
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox() -> Outbox:
+    """Process-wide outbox for prescription table writes and device config changes ('device')"""
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox({PRESCRIPTION_STREAM: deliver_prescription_operations,
+                                  'device': deliver_device_operations})
+    return _outbox
 
 class PrescriptionHandler:
-    def __init__(self):
-        print("Initializing AWS connections...")
-        self.dynamodb = boto3.resource('dynamodb')
-        self.iot = boto3.client('iot-data')
-        self.prescriptions_table = self.dynamodb.Table('Prescriptions')
-        print("AWS connections established")
-
-    def decimal_to_float(self, obj):
-        """Convert Decimal objects to float recursively"""
-        if isinstance(obj, list):
-            return [self.decimal_to_float(i) for i in obj]
-        elif isinstance(obj, dict):
-            return {k: self.decimal_to_float(v) for k, v in obj.items()}
-        elif isinstance(obj, Decimal):
-            return float(obj)
-        return obj
+    """Prescription writes, schedules and device config for one patient and dispenser.
+
+    Without ids the handler works for DEFAULT_PATIENT_ID / DEFAULT_DEVICE_ID.
+    Patient ids only separate data with PRESCRIPTION_STORE=partitioned; the
+    flat Prescriptions table holds a single patient.
+    """
+
+    def __init__(self, patient_id: str = None, device_id: str = None):
+        self.dynamodb = clients.dynamodb()
+        self.iot = clients.iot_data()
+        self.patient_id = patient_id or DEFAULT_PATIENT_ID
+        self.store = open_store(self.dynamodb, self.patient_id)
+        self.prescriptions_table = self.store.table
+        self.device_id = device_id or DEFAULT_DEVICE_ID
+        self.outbox = get_outbox()
+        self.outbox.start()
+        self.schedule_index = get_schedule_index(self.store.scope)
+
+    def build_prescription_record(self, prescription: PrescriptionDetails) -> PrescriptionRecord:
+        """Give a parsed prescription its id and timestamps; record.to_item() is what gets stored"""
+        return PrescriptionRecord.from_details(
+            prescription,
+            prescription_id=f"PRESC_{int(datetime.now().timestamp() * 1000)}_{uuid.uuid4().hex[:8]}",
+            device_id=self.device_id,
+            created_at=datetime.now().isoformat()
+        )
+
+    @staticmethod
+    def _alarms(record: PrescriptionRecord):
+        """The device alarms for a prescription, one per timing in order"""
+        return [
+            {
+                'medication_name': record.medication_name,
+                'dosage': record.dosage,
+                'time': timing.time,
+                'with_food': timing.with_food,
+                'special_instructions': timing.special_instructions
+            }
+            for timing in record.timing
+        ]
+
+    def _alarms_entry(self, record: PrescriptionRecord):
+        """The outbox entry that sets a prescription's alarms on the device"""
+        return ('device', self.device_id, set_alarms_operation(record.id, self._alarms(record)))
+
+    def resync_device(self):
+        """Queue a full config for the device, after it reports a gap in the config versions.
+
+        The alarms are rebuilt from the prescriptions for this device that
+        have not ended, including writes still in the outbox. Returns the
+        number of prescriptions sent.
+        """
+        try:
+            today = datetime.now().date().isoformat()
+            items = {item['id']: item for item in self.store.load_device_active(self.device_id, today)}
+            replay_operations(self.store, self.outbox.pending(PRESCRIPTION_STREAM, self.patient_id), items)
+            records = [PrescriptionRecord.from_item(item) for item in items.values()
+                       if item.get('device_id') == self.device_id and item.get('end_date', '') >= today]
+            operation = sync_operation({record.id: self._alarms(record) for record in records})
+            with stage('outbox_commit'):
+                self.outbox.append([('device', self.device_id, operation)])
+            logger.info("Queued full config for %s with %d prescriptions", self.device_id, len(records))
+            return len(records)
+
+        except Exception as e:
+            logger.error("Failed to resync device %s: %s", self.device_id, e)
+            raise e
+
+    def _queue_saves(self, records):
+        """Commit the DynamoDB writes and device alarms for records to the outbox in one transaction.
+
+        The local schedule index includes them at once; the version stamp
+        moves (and other workers see them) when the flusher has written them.
+        """
+        entries = [(PRESCRIPTION_STREAM, self.patient_id, put_operation(record.to_item())) for record in records]
+        entries.extend(self._alarms_entry(record) for record in records)
+        with stage('outbox_commit'):
+            self.outbox.append(entries)
+        for record in records:
+            self.schedule_index.upsert(record)
 
     def save_prescription(self, prescription: PrescriptionDetails):
-        """Save prescription to DynamoDB and configure device"""
+        """Save prescription to DynamoDB and configure device, through the write-behind outbox"""
         try:
-            print("\nPreparing to save prescription to DynamoDB...")
-            
-            # Convert to dict and format dates properly
-            prescription_dict = {
-                'id': f"PRESC_{int(datetime.now().timestamp())}",
-                'created_at': datetime.now().isoformat(),
-                'medication_name': prescription.medication_name,
-                'dosage': prescription.dosage,
-                'frequency': prescription.frequency,
-                'timing': [
-                    {
-                        'time': t.time,
-                        'with_food': t.with_food,
-                        'special_instructions': t.special_instructions
-                    } for t in prescription.timing
-                ],
-                'start_date': prescription.start_date.isoformat(),
-                'end_date': prescription.end_date.isoformat(),
-                'refills': prescription.refills
-            }
-            
-            print(f"\nSaving to DynamoDB with ID: {prescription_dict['id']}")
-            print("Prescription data:")
-            print(json.dumps(prescription_dict, indent=2, cls=DecimalEncoder))
-            
-            self.prescriptions_table.put_item(Item=prescription_dict)
-            print("Successfully saved to DynamoDB")
-            
-            device_config = {
-                'action': 'configure_alarms',
-                'alarms': [
-                    {
-                        'medication_name': prescription.medication_name,
-                        'dosage': prescription.dosage,
-                        'time': timing.time,
-                        'with_food': timing.with_food,
-                        'special_instructions': timing.special_instructions
-                    }
-                    for timing in prescription.timing
-                ]
-            }
-            
-            print("\nSending configuration to IoT device:")
-            print(json.dumps(device_config, indent=2))
-            
-            self.iot.publish(
-                topic='medicine/dispenser/command',
-                payload=json.dumps(device_config)
-            )
-            print("Successfully sent configuration to IoT device")
-            
-            return prescription_dict['id']
-            
+            record = self.build_prescription_record(prescription)
+            logger.debug("Prescription data: %s", Lazy(dumps, record))
+
+            self._queue_saves([record])
+            logger.info("Queued prescription %s and %d alarms for IoT device %s",
+                        record.id, len(record.timing), self.device_id)
+
+            return record.id
+
+        except Exception as e:
+            logger.error("Failed to save prescription: %s", e)
+            raise e
+
+    def save_prescriptions(self, prescriptions):
+        """Save several prescriptions in one outbox commit, delivered as one batch write and one config update"""
+        try:
+            records = [self.build_prescription_record(prescription) for prescription in prescriptions]
+            if not records:
+                return []
+            logger.debug("Queueing %d prescriptions for DynamoDB in one batch...", len(records))
+
+            self._queue_saves(records)
+            logger.info("Queued %d prescriptions and their alarms for %s", len(records), self.device_id)
+
+            return [record.id for record in records]
+
         except Exception as e:
-            print(f"\nERROR - Failed to save prescription: {str(e)}")
+            logger.error("Failed to save prescriptions: %s", e)
             raise e
 
     def get_prescription(self, prescription_id: str):
-        """Retrieve a prescription from DynamoDB"""
+        """Retrieve a prescription, including writes still queued in the outbox"""
         try:
-            print(f"\nRetrieving prescription {prescription_id} from DynamoDB...")
-            response = self.prescriptions_table.get_item(Key={'id': prescription_id})
-            prescription = response.get('Item')
-            
+            logger.debug("Retrieving prescription %s...", prescription_id)
+            queued, item = self._queued_item(prescription_id)
+            if not queued:
+                item = self.store.get(prescription_id)
+            prescription = PrescriptionRecord.from_item(item) if item else None
+
             if prescription:
-                prescription = self.decimal_to_float(prescription)
-                print("Successfully retrieved prescription:")
-                print(json.dumps(prescription, indent=2, cls=DecimalEncoder))
+                logger.debug("Retrieved prescription: %s", Lazy(dumps, prescription))
             else:
-                print(f"No prescription found with ID: {prescription_id}")
+                logger.info("No prescription found with ID: %s", prescription_id)
             
             return prescription
             
         except Exception as e:
-            print(f"\nERROR - Failed to retrieve prescription: {str(e)}")
+            logger.error("Failed to retrieve prescription: %s", e)
+            raise e
+
+    def _queued_item(self, prescription_id: str):
+        """Return (queued, item): whether the outbox has a write for the prescription and the item it leaves"""
+        queued, item = False, None
+        for action, value in self.outbox.pending(PRESCRIPTION_STREAM, self.patient_id):
+            if action == 'put' and value['id'] == prescription_id:
+                queued, item = True, value
+            elif action == 'delete' and self.store.id_for_key(value) == prescription_id:
+                queued, item = True, None
+        return queued, item
+
+    def _queue_deletes(self, matches, list_keys=None):
+        """Queue deletes for the prescriptions that satisfy matches; return their ids.
+
+        Pending puts are matched and cancelled in one outbox transaction
+        before list_keys() reads the table, so each one is either cancelled
+        or already written and listed; listed keys whose delete is already
+        queued are skipped. The device gets remove operations in the same
+        transactions and the local schedule index drops the prescriptions
+        at once; the version stamp moves when the flusher has deleted them.
+        """
+        deleted_ids = []
+
+        def entries_for(keys):
+            ids = list(dict.fromkeys(self.store.id_for_key(key) for key in keys))
+            deleted_ids.extend(ids)
+            entries = [(PRESCRIPTION_STREAM, self.patient_id, delete_operation(key)) for key in keys]
+            if ids:
+                entries.append(('device', self.device_id, remove_prescriptions_operation(ids)))
+            return entries
+
+        def cancel_pending(operations):
+            pending = replay_operations(self.store, operations)
+            return entries_for([self.store.key_for(item) for item in pending.values() if matches(item)])
+
+        with stage('outbox_commit'):
+            self.outbox.append_after_pending(PRESCRIPTION_STREAM, self.patient_id, cancel_pending)
+        if list_keys is not None:
+            keys = list_keys()
+
+            def delete_listed(operations):
+                queued = {self.store.id_for_key(value) for action, value in operations if action == 'delete'}
+                return entries_for([key for key in keys if self.store.id_for_key(key) not in queued])
+
+            with stage('outbox_commit'):
+                self.outbox.append_after_pending(PRESCRIPTION_STREAM, self.patient_id, delete_listed)
+        for prescription_id in deleted_ids:
+            self.schedule_index.remove(prescription_id)
+        return deleted_ids
+
+    def refresh_schedule_index(self, force: bool = False, max_age: float = SCHEDULE_VERSION_TTL):
+        """Rebuild the schedule index if the table has changed since it was loaded.
+
+        The version stamp is re-read only when the last check is older than
+        max_age seconds (shared by every thread in the process).
+        """
+        index = self.schedule_index
+        now = time.monotonic()
+        if not force and index.version is not None and now - index.checked_at < max_age:
+            return
+        version = self.store.get_version()
+        index.checked_at = now
+        if force or version != index.version:
+            # Writes still in the outbox are not in the table yet
+            items = {item['id']: item for item in self.store.load_all()}
+            replay_operations(self.store, self.outbox.pending(PRESCRIPTION_STREAM, self.patient_id), items)
+            index.load([PrescriptionRecord.from_item(item) for item in items.values()], version)
+
+    def schedule_version(self):
+        """Current schedule version, refreshed from the table like a schedule read"""
+        self.refresh_schedule_index()
+        return self.schedule_index.version
+
+    def wait_for_schedule_change(self, version, timeout: float):
+        """Block until the schedule version moves past version or timeout expires.
+
+        Writes made by this process wake waiters immediately; writes from
+        other workers are noticed within SCHEDULE_POLL_CHECK_SECONDS.
+        Returns the current version.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return self.schedule_index.version
+            current = self.schedule_index.wait_for_change(version, min(remaining, SCHEDULE_POLL_CHECK_SECONDS))
+            if current != version:
+                return current
+            self.refresh_schedule_index(max_age=SCHEDULE_POLL_CHECK_SECONDS)
+
+    def get_schedule_snapshot(self, date_str: str = None):
+        """Return (version, schedule) for a date; the version matches the schedule returned"""
+        current_date = datetime.now().date() if date_str is None else datetime.strptime(date_str, '%Y-%m-%d').date()
+        with stage('schedule_build'):
+            self.refresh_schedule_index()
+            return self.schedule_index.snapshot_for(current_date)
+
+    def get_schedule_range_snapshot(self, start_str: str = None, end_str: str = None):
+        """Return the ScheduleRange from start to end inclusive (default: today only)"""
+        start = datetime.now().date() if start_str is None else datetime.strptime(start_str, '%Y-%m-%d').date()
+        end = start if end_str is None else datetime.strptime(end_str, '%Y-%m-%d').date()
+        if end < start:
+            raise ValueError(f"Schedule range ends ({end}) before it starts ({start})")
+        if (end - start).days >= SCHEDULE_RANGE_MAX_DAYS:
+            raise ValueError(f"Schedule range is limited to {SCHEDULE_RANGE_MAX_DAYS} days")
+        with stage('schedule_range_build'):
+            self.refresh_schedule_index()
+            return self.schedule_index.range_for(start, end)
+
+    def get_schedule_range(self, start_str: str = None, end_str: str = None):
+        """Get every dose from start to end inclusive as dated ScheduleItems, sorted by date and time"""
+        try:
+            schedule_range = self.get_schedule_range_snapshot(start_str, end_str)
+            return list(schedule_range.events())
+
+        except Exception as e:
+            logger.error("Failed to get schedule range: %s", e)
             raise e
 
     def get_daily_schedule(self, date_str: str = None):
         """Get all medications scheduled for a specific date"""
         try:
-            print("\nRetrieving daily schedule...")
-            response = self.prescriptions_table.scan()
-            prescriptions = response['Items']
-            
-            # Use a set to track unique prescription IDs we've already processed
-            processed_prescriptions = set()
-            schedule = []
-            current_date = datetime.now().date() if date_str is None else datetime.strptime(date_str, '%Y-%m-%d').date()
-            
-            print(f"Processing schedule for date: {current_date}")
-            
-            # Sort prescriptions by created_at to get the most recent one
-            prescriptions.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-            
-            for prescription in prescriptions:
-                prescription_id = prescription.get('id')
-                
-                # Skip if we've already processed this prescription
-                if prescription_id in processed_prescriptions:
-                    print(f"Skipping duplicate prescription ID: {prescription_id}")
-                    continue
-                    
-                try:
-                    # Handle different possible date formats
-                    try:
-                        start_date = datetime.strptime(prescription.get('start_date', ''), '%Y-%m-%d').date()
-                        end_date = datetime.strptime(prescription.get('end_date', ''), '%Y-%m-%d').date()
-                    except ValueError:
-                        # Try parsing ISO format if simple format fails
-                        start_date = datetime.fromisoformat(prescription.get('start_date', '')).date()
-                        end_date = datetime.fromisoformat(prescription.get('end_date', '')).date()
-                    
-                    print(f"Date range: {start_date} to {end_date}")
-                    
-                    if start_date <= current_date <= end_date:
-                        timing_list = prescription.get('timing', [])
-                        medication_name = prescription.get('medication_name')
-                        
-                        # Add to processed set
-                        processed_prescriptions.add(prescription_id)
-                        
-                        if isinstance(timing_list, list):
-                            for timing in timing_list:
-                                schedule_item = {
-                                    'time': timing.get('time', '00:00'),
-                                    'medication_name': medication_name,
-                                    'dosage': prescription.get('dosage', 'Unknown'),
-                                    'with_food': timing.get('with_food', False),
-                                    'special_instructions': timing.get('special_instructions', ''),
-                                    'prescription_id': prescription_id
-                                }
-                                schedule.append(schedule_item)
-                                print(f"Added schedule item: {json.dumps(schedule_item, indent=2)}")
-                                
-                except Exception as e:
-                    print(f"Warning: Skipping prescription due to error: {str(e)}")
-                    continue
-            
-            schedule = self.decimal_to_float(schedule)
-            sorted_schedule = sorted(schedule, key=lambda x: x['time'])
-            
-            print("\nFinal daily schedule:")
-            print(json.dumps(sorted_schedule, indent=2, cls=DecimalEncoder))
-            
+            _, sorted_schedule = self.get_schedule_snapshot(date_str)
+            logger.debug("Daily schedule for %s: %s", date_str or datetime.now().date(), Lazy(dumps, sorted_schedule))
+
             return sorted_schedule
-            
+
         except Exception as e:
-            print(f"\nERROR - Failed to get daily schedule: {str(e)}")
+            logger.error("Failed to get daily schedule: %s", e)
             raise e
 
-    def cleanup_old_prescriptions(self):
-        """Remove all existing prescriptions"""
+    def cleanup_old_prescriptions(self, retention_days: int = None):
+        """Remove existing prescriptions in bulk.
+
+        With retention_days, only prescriptions whose end_date is more than
+        that many days in the past are removed; otherwise all are removed.
+        Returns the number deleted and the elapsed time.
+        """
         try:
-            print("\nPerforming complete cleanup of prescriptions...")
-            
-            # Get all prescriptions
-            response = self.prescriptions_table.scan()
-            prescriptions = response['Items']
-            
-            if not prescriptions:
-                print("No prescriptions to clean up")
-                return
-                
-            print(f"Found {len(prescriptions)} prescriptions to delete")
-            
-            # Delete each prescription
-            for prescription in prescriptions:
-                prescription_id = prescription['id']
-                print(f"Deleting prescription: {prescription_id}")
-                
-                try:
-                    self.prescriptions_table.delete_item(
-                        Key={'id': prescription_id}
-                    )
-                except Exception as e:
-                    print(f"Error deleting prescription {prescription_id}: {e}")
-                    continue
-            
-            print("Cleanup completed successfully")
-            
+            started = time.perf_counter()
+            expired_before = None
+            if retention_days is None:
+                logger.debug("Performing complete cleanup of prescriptions...")
+            else:
+                expired_before = (datetime.now().date() - timedelta(days=retention_days)).isoformat()
+                logger.debug("Removing prescriptions that ended before %s...", expired_before)
+
+            deleted_ids = self._queue_deletes(
+                lambda item: expired_before is None or item['end_date'] < expired_before,
+                lambda: self.store.list_keys(expired_before=expired_before)
+            )
+            result = {
+                'deleted': len(deleted_ids),
+                'elapsed_seconds': round(time.perf_counter() - started, 3)
+            }
+            if deleted_ids:
+                logger.info("Cleanup queued deletes for %d prescriptions", len(deleted_ids), extra={'fields': result})
+            else:
+                logger.debug("No prescriptions to clean up")
+            return result
+
         except Exception as e:
-            print(f"\nERROR - Failed to cleanup prescriptions: {str(e)}")
+            logger.error("Failed to cleanup prescriptions: %s", e)
             raise e
 
     def delete_prescription(self, prescription_id: str):
         """Delete a specific prescription"""
         try:
-            print(f"Deleting prescription: {prescription_id}")
-            self.prescriptions_table.delete_item(
-                Key={'id': prescription_id}
+            logger.debug("Deleting prescription: %s", prescription_id)
+            deleted = self._queue_deletes(
+                lambda item: item['id'] == prescription_id,
+                lambda: [key for key in [self.store.key_for_id(prescription_id)] if key is not None]
             )
+            if not deleted:
+                logger.info("No prescription found with ID: %s", prescription_id)
         except Exception as e:
-            print(f"Error deleting prescription {prescription_id}: {e}")
+            logger.error("Error deleting prescription %s: %s", prescription_id, e)
             raise e
\ No newline at end of file
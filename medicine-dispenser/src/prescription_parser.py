@@ -1,9 +1,31 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime, date, timedelta
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import Annotated, Iterator, List, NamedTuple, Optional
+from datetime import date
+from functools import cached_property
+from PIL import Image
+from parse_cache import get_parse_cache
+from clients import clients
+from image_pipeline import read_limited, normalize_image, encode_for_llm
+from metrics import metrics, stage, STAGE_HISTOGRAM
+from rate_limit import anthropic_limiter
+from records import dumps
+from conflict_detector import find_timing_conflicts, DEFAULT_WINDOW_MINUTES
+from log_config import Lazy
+from incremental_json import IncrementalObjectParser
+import asyncio
+import contextvars
+import hashlib
 import json
-from anthropic import Anthropic
-import os
+import logging
+import time
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+LLM_MODEL = "claude-3-haiku-20240307"
+# Bump when a change to result handling should invalidate cached parses;
+# changes to the model, the prompt text or the schema already do
+PROMPT_VERSION = 1
 
 class MedicationTiming(BaseModel):
     time: str = Field(..., description="Time in 24-hour format (HH:MM)")
@@ -19,15 +41,74 @@ class PrescriptionDetails(BaseModel):
     end_date: date = Field(..., description="End date of prescription")
     refills: int = Field(default=0, description="Number of refills allowed")
 
+class ParseEvent(NamedTuple):
+    """Progress of a streaming parse.
+
+    kind is 'field' (data: name and value), 'timing' (data: index and the
+    MedicationTiming fields) or 'result' (data: the validated
+    PrescriptionDetails, always the last event).
+    """
+    kind: str
+    data: object
+
+class PrescriptionStreamValidator:
+    """Validates Claude's JSON answer against PrescriptionDetails while it streams in.
+
+    Each top-level field is checked against its own field definition as soon
+    as its value is complete, and each timing entry against MedicationTiming.
+    A value that fails is logged and left out; result() then reports it.
+    """
+    _adapters = None
+
+    def __init__(self):
+        self.json = IncrementalObjectParser()
+        self.started = time.perf_counter()
+        self.first_event_at = None
+
+    @classmethod
+    def field_adapters(cls):
+        if cls._adapters is None:
+            cls._adapters = {
+                name: TypeAdapter(Annotated[field.annotation, field])
+                for name, field in PrescriptionDetails.model_fields.items() if name != 'timing'
+            }
+        return cls._adapters
+
+    def feed(self, text: str) -> List[ParseEvent]:
+        """Add a chunk of the answer and return the events it completed"""
+        adapters = self.field_adapters()
+        events = []
+        for item in self.json.feed(text):
+            try:
+                if item.key == 'timing' and item.index is not None:
+                    timing = MedicationTiming.model_validate(item.value)
+                    events.append(ParseEvent('timing', {'index': item.index, **timing.model_dump(mode='json')}))
+                elif item.index is None and item.key in adapters:
+                    adapter = adapters[item.key]
+                    value = adapter.dump_python(adapter.validate_python(item.value), mode='json')
+                    events.append(ParseEvent('field', {'name': item.key, 'value': value}))
+            except ValidationError as e:
+                logger.warning("Streamed %s failed validation: %s", item.key, e)
+        if events and self.first_event_at is None:
+            self.first_event_at = time.perf_counter()
+            metrics.observe(STAGE_HISTOGRAM, self.first_event_at - self.started, stage='llm_first_field')
+        return events
+
+    def result(self) -> PrescriptionDetails:
+        """Validate the complete answer"""
+        return PrescriptionDetails.model_validate_json(self.json.text())
+
 class PrescriptionParser:
+    model = LLM_MODEL
+    prompt_version = PROMPT_VERSION
+
     def __init__(self):
-        print("Initializing PrescriptionParser...")
-        self.anthropic = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
-        print("Connected to Anthropic API")
+        self.anthropic = clients.anthropic()
+        self.cache = get_parse_cache()
 
-    def format_prompt(self, image_url: str) -> str:
-        """Create a structured prompt for the AI"""
-        return f"""
+    def format_prompt(self) -> str:
+        """Create a structured prompt for the AI; the image is sent alongside it"""
+        return """
         You are a medical prescription analyzer. I'm showing you a prescription image. Extract information for the first medication (Paracetamol) with these specific requirements:
 
         - The medication_name is "Paracetamol"
@@ -39,100 +120,237 @@ class PrescriptionParser:
         - Set refills to 0
 
         Return ONLY a JSON object with these exact fields and values. For the timing array, create 4 entries spaced 6 hours apart.
+        """
+
+    @cached_property
+    def result_version(self) -> str:
+        """Hash of the model, prompt version, prompt text and schema behind this parser's results"""
+        digest = hashlib.sha256()
+        digest.update(f"{self.model}\0{self.prompt_version}\0{self.format_prompt()}\0".encode())
+        digest.update(json.dumps(PrescriptionDetails.model_json_schema(), sort_keys=True).encode())
+        return digest.hexdigest()[:16]
+
+    def result_cache_key(self, cache_key: str) -> str:
+        """Parse cache key for an image hash: results from another model or prompt never match"""
+        return f"{self.result_version}:{cache_key}"
+
+    def load_image(self, image_url: str) -> Image.Image:
+        """Fetch and normalize an image from a (presigned) URL"""
+        with urllib.request.urlopen(image_url, timeout=30) as response:
+            return normalize_image(read_limited(response))
 
-        Image: {image_url}
+    def parse_prescription(self, image_url: str, cache_key: Optional[str] = None,
+                           image: Optional[Image.Image] = None) -> PrescriptionDetails:
+        """Parse prescription using AI and validate against schema.
+
+        When cache_key (a hash of the normalized image) is given, a previous
+        result for the same image is returned without calling the API. The
+        image is sent inline; pass the normalized image if it is already in
+        memory, otherwise it is fetched from image_url.
         """
+        cached = self.get_cached(cache_key)
+        if cached is not None:
+            return cached
 
-    def parse_prescription(self, image_url: str) -> PrescriptionDetails:
-        """Parse prescription using AI and validate against schema"""
         try:
-            print("\nSending request to Claude...")
-            response = self.anthropic.messages.create(
-                model="claude-3-haiku-20240307",
-                max_tokens=1000,
-                messages=[{
-                    "role": "user",
-                    "content": self.format_prompt(image_url)
-                }]
-            )
-            print("Received response from Claude")
-            
-            print("\nRaw AI Response:")
-            print(response.content)
-            
-            # Create prescription data manually for Paracetamol
-            start_date = datetime(2024, 12, 11).date()
-            end_date = start_date + timedelta(days=5)
-            
-            prescription_data = {
-                "medication_name": "Paracetamol",
-                "dosage": "500mg",
-                "frequency": 4,
-                "timing": [
-                    {
-                        "time": "09:00",
-                        "with_food": True,
-                        "special_instructions": "Take with water after meals"
-                    },
-                    {
-                        "time": "15:00",
-                        "with_food": True,
-                        "special_instructions": "Take with water after meals"
-                    },
-                    {
-                        "time": "21:00",
-                        "with_food": True,
-                        "special_instructions": "Take with water after meals"
-                    },
-                    {
-                        "time": "03:00",
-                        "with_food": True,
-                        "special_instructions": "Take with water after meals"
-                    }
-                ],
-                "start_date": start_date.isoformat(),
-                "end_date": end_date.isoformat(),
-                "refills": 0
-            }
-            
-            print("\nStructured Prescription Data:")
-            print(json.dumps(prescription_data, indent=2))
-            
-            # Validate against schema
-            print("\nValidating prescription data against schema...")
-            validated_data = PrescriptionDetails(**prescription_data)
-            print("Validation successful")
-            
-            return validated_data
-            
+            payload = self.encode_image(image_url, image)
+
+            waited = anthropic_limiter.acquire()
+            if waited:
+                logger.info("Rate limited for %.2fs before calling Claude", waited)
+            logger.debug("Sending request to Claude...")
+            with stage('llm_call'):
+                response = self.anthropic.messages.create(**self.build_request(payload))
+            logger.debug("Received response from Claude")
+
+            return self.build_result(response, cache_key)
+
+        except Exception as e:
+            logger.error("Failed to parse prescription: %s", e)
+            raise ValueError(f"Failed to parse prescription: {str(e)}")
+
+    def parse_prescription_stream(self, image_url: str, cache_key: Optional[str] = None,
+                                  image: Optional[Image.Image] = None) -> Iterator[ParseEvent]:
+        """Streaming form of parse_prescription that yields ParseEvents.
+
+        Claude's answer is read as a stream and its JSON parsed
+        incrementally, so the medication name, dosage and first timings are
+        known (and validated) before the response is complete. A cached
+        result is replayed as events.
+        """
+        cached = self.get_cached(cache_key)
+        if cached is not None:
+            yield from self.cached_events(cached)
+            return
+
+        try:
+            payload = self.encode_image(image_url, image)
+
+            waited = anthropic_limiter.acquire()
+            if waited:
+                logger.info("Rate limited for %.2fs before calling Claude", waited)
+            validator = PrescriptionStreamValidator()
+            with stage('llm_stream'):
+                with self.anthropic.messages.stream(**self.build_request(payload)) as stream:
+                    for text in stream.text_stream:
+                        yield from validator.feed(text)
+
+            yield ParseEvent('result', self.finish_stream(validator, cache_key))
+
         except Exception as e:
-            print(f"\nERROR - Failed to parse prescription: {str(e)}")
+            logger.error("Failed to parse prescription: %s", e)
             raise ValueError(f"Failed to parse prescription: {str(e)}")
 
-    def validate_timing_conflicts(self, prescriptions: List[PrescriptionDetails]) -> List[dict]:
+    @staticmethod
+    def cached_events(prescription: PrescriptionDetails) -> List[ParseEvent]:
+        """The events a stream would have produced for an already parsed prescription"""
+        data = prescription.model_dump(mode='json')
+        events = [ParseEvent('field', {'name': name, 'value': value})
+                  for name, value in data.items() if name != 'timing']
+        events.extend(ParseEvent('timing', {'index': index, **timing}) for index, timing in enumerate(data['timing']))
+        events.append(ParseEvent('result', prescription))
+        return events
+
+    def finish_stream(self, validator: PrescriptionStreamValidator, cache_key: Optional[str] = None):
+        """Validate a finished stream's answer and cache it"""
+        logger.debug("Raw AI response: %s", validator.json.buffer)
+        with stage('validation'):
+            prescription = validator.result()
+        if cache_key is not None:
+            self.cache.put(self.result_cache_key(cache_key), prescription)
+        return prescription
+
+    def get_cached(self, cache_key: Optional[str]) -> Optional[PrescriptionDetails]:
+        if cache_key is None:
+            return None
+        cached = self.cache.get(self.result_cache_key(cache_key), PrescriptionDetails)
+        if cached is not None:
+            metrics.increment('parse_cache_requests_total', result='hit')
+            logger.info("Parse cache hit for %s (%s)", cache_key[:12], self.cache.stats)
+            return cached
+        metrics.increment('parse_cache_requests_total', result='miss')
+        logger.debug("Parse cache miss for %s", cache_key[:12])
+        return None
+
+    def encode_image(self, image_url: str, image: Optional[Image.Image] = None):
+        """Build the token-optimized image payload, fetching the image if needed"""
+        with stage('llm_image_encode'):
+            if image is None:
+                image = self.load_image(image_url)
+            payload = encode_for_llm(image)
+        metrics.increment('llm_image_bytes_total', len(payload.data))
+        metrics.increment('llm_image_tokens_total', payload.tokens)
+        logger.info("Encoded %dx%d image for Claude: %d bytes, ~%d tokens",
+                    payload.width, payload.height, len(payload.data), payload.tokens,
+                    extra={'fields': {'image_bytes': len(payload.data), 'image_tokens': payload.tokens}})
+        return payload
+
+    def build_request(self, payload) -> dict:
+        """Arguments for messages.create"""
+        return {
+            "model": self.model,
+            "max_tokens": 1000,
+            "messages": [{
+                "role": "user",
+                "content": [
+                    payload.content_block(),
+                    {"type": "text", "text": self.format_prompt()}
+                ]
+            }]
+        }
+
+    def build_result(self, response, cache_key: Optional[str] = None) -> PrescriptionDetails:
+        """Turn Claude's response into a validated prescription and cache it.
+
+        The JSON object is taken from the answer the same way as from a
+        streamed one, so both paths cache the same result for an image.
+        """
+        logger.debug("Raw AI response: %s", response.content)
+        answer = IncrementalObjectParser()
+        answer.feed(''.join(block.text for block in response.content if block.type == 'text'))
+
+        # Validate against schema
+        logger.debug("Validating prescription data against schema...")
+        with stage('validation'):
+            validated_data = PrescriptionDetails.model_validate_json(answer.text())
+        logger.debug("Structured prescription data: %s", Lazy(dumps, validated_data))
+
+        if cache_key is not None:
+            self.cache.put(self.result_cache_key(cache_key), validated_data)
+
+        return validated_data
+
+    def validate_timing_conflicts(self, prescriptions: List[PrescriptionDetails],
+                                  window_minutes: int = DEFAULT_WINDOW_MINUTES) -> List[dict]:
         """Check for timing conflicts between medications"""
-        print("\nChecking for timing conflicts...")
-        conflicts = []
-        for i, p1 in enumerate(prescriptions):
-            for j, p2 in enumerate(prescriptions[i+1:], i+1):
-                for t1 in p1.timing:
-                    for t2 in p2.timing:
-                        time_diff = abs(
-                            time.fromisoformat(t1.time).hour * 60 +
-                            time.fromisoformat(t1.time).minute -
-                            time.fromisoformat(t2.time).hour * 60 -
-                            time.fromisoformat(t2.time).minute
-                        )
-                        
-                        if time_diff < 30:
-                            conflict = {
-                                'medication1': p1.medication_name,
-                                'medication2': p2.medication_name,
-                                'time1': t1.time,
-                                'time2': t2.time,
-                                'time_difference_minutes': time_diff
-                            }
-                            conflicts.append(conflict)
-                            print(f"Found conflict: {json.dumps(conflict, indent=2)}")
-        
-        return conflicts
\ No newline at end of file
+        conflicts = find_timing_conflicts(prescriptions, window_minutes)
+        logger.info("Found %d timing conflicts", len(conflicts))
+        return conflicts
+
+
+class AsyncPrescriptionParser(PrescriptionParser):
+    """PrescriptionParser over the async Anthropic client, for the ASGI app.
+
+    Image encoding (Pillow) runs on the given executor so the event loop
+    stays free while it works.
+    """
+
+    def __init__(self, executor=None):
+        self.anthropic = clients.async_anthropic()
+        self.cache = get_parse_cache()
+        self.executor = executor
+
+    async def parse_prescription(self, image_url: str, cache_key: Optional[str] = None,
+                                 image: Optional[Image.Image] = None) -> PrescriptionDetails:
+        cached = self.get_cached(cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            loop = asyncio.get_running_loop()
+            payload = await loop.run_in_executor(
+                self.executor, contextvars.copy_context().run, self.encode_image, image_url, image
+            )
+
+            waited = await anthropic_limiter.acquire_async()
+            if waited:
+                logger.info("Rate limited for %.2fs before calling Claude", waited)
+            with stage('llm_call'):
+                response = await self.anthropic.messages.create(**self.build_request(payload))
+
+            return self.build_result(response, cache_key)
+
+        except Exception as e:
+            logger.error("Failed to parse prescription: %s", e)
+            raise ValueError(f"Failed to parse prescription: {str(e)}")
+
+    async def parse_prescription_stream(self, image_url: str, cache_key: Optional[str] = None,
+                                        image: Optional[Image.Image] = None):
+        """Async form of PrescriptionParser.parse_prescription_stream"""
+        cached = self.get_cached(cache_key)
+        if cached is not None:
+            for event in self.cached_events(cached):
+                yield event
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+            payload = await loop.run_in_executor(
+                self.executor, contextvars.copy_context().run, self.encode_image, image_url, image
+            )
+
+            waited = await anthropic_limiter.acquire_async()
+            if waited:
+                logger.info("Rate limited for %.2fs before calling Claude", waited)
+            validator = PrescriptionStreamValidator()
+            with stage('llm_stream'):
+                async with self.anthropic.messages.stream(**self.build_request(payload)) as stream:
+                    async for text in stream.text_stream:
+                        for event in validator.feed(text):
+                            yield event
+
+            yield ParseEvent('result', self.finish_stream(validator, cache_key))
+
+        except Exception as e:
+            logger.error("Failed to parse prescription: %s", e)
+            raise ValueError(f"Failed to parse prescription: {str(e)}")
@@ -0,0 +1,397 @@
+import argparse
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Attr, Key
+
+from metrics import metrics
+
+PRESCRIPTION_STORE = os.getenv('PRESCRIPTION_STORE', 'flat')
+FLAT_TABLE_NAME = os.getenv('PRESCRIPTIONS_TABLE', 'Prescriptions')
+PARTITIONED_TABLE_NAME = os.getenv('PATIENT_PRESCRIPTIONS_TABLE', 'PatientPrescriptions')
+# Version stamps, one item per store scope; bumped on every write so each
+# worker's schedule index can tell when it is stale
+VERSIONS_TABLE_NAME = os.getenv('SCHEDULE_VERSIONS_TABLE', 'ScheduleVersions')
+DEFAULT_PATIENT_ID = os.getenv('DEFAULT_PATIENT_ID', 'default')
+DEFAULT_DEVICE_ID = os.getenv('DEFAULT_DEVICE_ID', 'dispenser-1')
+
+# Version stamp rows kept in the data tables by earlier releases; readers still skip them
+SCHEDULE_VERSION_ID = '__schedule_version__'
+VERSION_SORT_KEY = '#VERSION'
+
+CLEANUP_SCAN_SEGMENTS = int(os.getenv('CLEANUP_SCAN_SEGMENTS', '4'))
+CLEANUP_DELETE_WORKERS = int(os.getenv('CLEANUP_DELETE_WORKERS', '4'))
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_ATTEMPTS = 8
+
+ID_INDEX = 'PrescriptionIdIndex'
+DEVICE_ACTIVE_INDEX = 'DeviceActiveIndex'
+
+logger = logging.getLogger(__name__)
+
+
+def _batch_delete_chunk(client, table_name, chunk):
+    """Delete up to 25 keys, retrying unprocessed items with jittered backoff.
+
+    Returns the keys that could not be deleted.
+    """
+    requests = [{'DeleteRequest': {'Key': key}} for key in chunk]
+    for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+        response = client.batch_write_item(RequestItems={table_name: requests})
+        requests = response.get('UnprocessedItems', {}).get(table_name, [])
+        if not requests:
+            return []
+        metrics.increment('pipeline_retries_total', operation='batch_write_item')
+        time.sleep(min(2.0, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    return [request['DeleteRequest']['Key'] for request in requests]
+
+
+def batch_delete(table, keys, workers: int = CLEANUP_DELETE_WORKERS):
+    """Delete keys in 25-item BatchWriteItem calls spread over a thread pool.
+
+    Uses the resource's client, which unlike the resource itself is
+    thread-safe and still (de)serializes plain Python values.
+    Returns (deleted_keys, failed_keys).
+    """
+    keys = list(keys)
+    if not keys:
+        return [], []
+    client = table.meta.client
+    chunks = [keys[i:i + BATCH_WRITE_SIZE] for i in range(0, len(keys), BATCH_WRITE_SIZE)]
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as pool:
+        for unprocessed in pool.map(lambda chunk: _batch_delete_chunk(client, table.name, chunk), chunks):
+            failed.extend(unprocessed)
+    failed_set = {tuple(sorted(key.items())) for key in failed}
+    deleted = [key for key in keys if tuple(sorted(key.items())) not in failed_set]
+    return deleted, failed
+
+
+class VersionStamp:
+    """A store's schedule version stamp, kept in the versions table under the store's scope"""
+
+    def __init__(self, dynamodb, scope: str, table_name: str = VERSIONS_TABLE_NAME):
+        self.table = dynamodb.Table(table_name)
+        self.scope = scope
+
+    def get(self) -> int:
+        response = self.table.get_item(Key={'scope': self.scope}, ConsistentRead=True)
+        return int(response.get('Item', {}).get('version', 0))
+
+    def bump_request(self) -> dict:
+        """update_item arguments that atomically increment the stamp"""
+        return {
+            'Key': {'scope': self.scope},
+            'UpdateExpression': 'ADD version :one',
+            'ExpressionAttributeValues': {':one': 1},
+            'ReturnValues': 'UPDATED_NEW'
+        }
+
+    def bump(self) -> int:
+        return int(self.table.update_item(**self.bump_request())['Attributes']['version'])
+
+
+class FlatPrescriptionStore:
+    """Original layout: one Prescriptions table keyed by id, read with scans"""
+
+    def __init__(self, dynamodb, table_name: str = FLAT_TABLE_NAME):
+        self.table = dynamodb.Table(table_name)
+        self.scope = f"flat:{table_name}"
+        self.version_stamp = VersionStamp(dynamodb, self.scope)
+
+    def key_for(self, item):
+        return {'id': item['id']}
+
+    def id_for_key(self, key):
+        return key['id']
+
+    def key_for_id(self, prescription_id: str):
+        return {'id': prescription_id}
+
+    def put_request(self, item) -> dict:
+        """put_item arguments for item"""
+        return {'Item': item}
+
+    def put(self, item):
+        self.table.put_item(**self.put_request(item))
+
+    def put_many(self, items):
+        with self.table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+    def get(self, prescription_id: str):
+        return self.table.get_item(Key={'id': prescription_id}).get('Item')
+
+    def delete(self, key):
+        self.table.delete_item(Key=key)
+
+    def scan_items(self, **scan_kwargs):
+        """Scan every page of the table, skipping any legacy version stamp item"""
+        items = []
+        while True:
+            response = self.table.scan(**scan_kwargs)
+            items.extend(item for item in response['Items'] if item.get('id') != SCHEDULE_VERSION_ID)
+            if 'LastEvaluatedKey' not in response:
+                return items
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def load_all(self):
+        return self.scan_items()
+
+    def load_device_active(self, device_id: str, on_or_after: str):
+        """Prescriptions for a device that end on or after the given date"""
+        return self.scan_items(FilterExpression=Attr('device_id').eq(device_id) & Attr('end_date').gte(on_or_after))
+
+    def _scan_segment_keys(self, segment, total_segments, expired_before):
+        client = self.table.meta.client
+        scan_kwargs = {
+            'TableName': self.table.name,
+            'ProjectionExpression': '#id',
+            'ExpressionAttributeNames': {'#id': 'id'},
+            'Segment': segment,
+            'TotalSegments': total_segments
+        }
+        if expired_before is not None:
+            scan_kwargs['FilterExpression'] = 'end_date < :cutoff'
+            scan_kwargs['ExpressionAttributeValues'] = {':cutoff': expired_before}
+        keys = []
+        while True:
+            response = client.scan(**scan_kwargs)
+            for item in response['Items']:
+                prescription_id = item['id']
+                if prescription_id != SCHEDULE_VERSION_ID:
+                    keys.append({'id': prescription_id})
+            if 'LastEvaluatedKey' not in response:
+                return keys
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def list_keys(self, expired_before: str = None, segments: int = CLEANUP_SCAN_SEGMENTS):
+        """Key-only parallel segmented scan, optionally limited to end_date < expired_before"""
+        segments = max(1, segments)
+        with ThreadPoolExecutor(max_workers=segments) as pool:
+            results = pool.map(lambda segment: self._scan_segment_keys(segment, segments, expired_before), range(segments))
+            return [key for keys in results for key in keys]
+
+    def delete_many(self, keys):
+        return batch_delete(self.table, keys)
+
+    def get_version(self) -> int:
+        return self.version_stamp.get()
+
+    def bump_version(self) -> int:
+        return self.version_stamp.bump()
+
+
+class PartitionedPrescriptionStore:
+    """Per-patient layout read with Query instead of Scan.
+
+    Partition key ``patient_id``; sort key ``sk`` is
+    ``<end_date>#<start_date>#<id>``, so "expired before D" is a key
+    condition on a single partition. ``PrescriptionIdIndex`` (``id``,
+    ``patient_id``) resolves a prescription id to its key within the
+    patient, and ``DeviceActiveIndex`` (``device_id``, ``end_date``) finds
+    the prescriptions a device still has to dispense for a device resync.
+    Schedules for a date are served by the in-process schedule index,
+    which loads the whole partition.
+    """
+
+    def __init__(self, dynamodb, patient_id: str = DEFAULT_PATIENT_ID, table_name: str = PARTITIONED_TABLE_NAME):
+        self.table = dynamodb.Table(table_name)
+        self.patient_id = patient_id
+        self.scope = f"partitioned:{table_name}:{patient_id}"
+        self.version_stamp = VersionStamp(dynamodb, self.scope)
+
+    @staticmethod
+    def sort_key(item):
+        return f"{item['end_date']}#{item['start_date']}#{item['id']}"
+
+    def key_for(self, item):
+        return {'patient_id': item.get('patient_id', self.patient_id), 'sk': item.get('sk') or self.sort_key(item)}
+
+    def id_for_key(self, key):
+        return key['sk'].rsplit('#', 1)[-1]
+
+    def key_for_id(self, prescription_id: str):
+        item = self.get(prescription_id)
+        return self.key_for(item) if item else None
+
+    def _with_key(self, item):
+        item = dict(item, patient_id=self.patient_id)
+        item['sk'] = self.sort_key(item)
+        return item
+
+    def put_request(self, item) -> dict:
+        return {'Item': self._with_key(item)}
+
+    def put(self, item):
+        self.table.put_item(**self.put_request(item))
+
+    def put_many(self, items):
+        with self.table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item=self._with_key(item))
+
+    def get(self, prescription_id: str):
+        response = self.table.query(
+            IndexName=ID_INDEX,
+            KeyConditionExpression=Key('id').eq(prescription_id) & Key('patient_id').eq(self.patient_id)
+        )
+        return response['Items'][0] if response['Items'] else None
+
+    def delete(self, key):
+        self.table.delete_item(Key=key)
+
+    def query_items(self, key_condition, **query_kwargs):
+        """Query every page of this patient's partition, skipping any legacy version stamp item"""
+        items = []
+        query_kwargs['KeyConditionExpression'] = key_condition
+        while True:
+            response = self.table.query(**query_kwargs)
+            items.extend(item for item in response['Items'] if item['sk'] != VERSION_SORT_KEY)
+            if 'LastEvaluatedKey' not in response:
+                return items
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def load_all(self):
+        return self.query_items(Key('patient_id').eq(self.patient_id))
+
+    def load_device_active(self, device_id: str, on_or_after: str):
+        """This patient's prescriptions for a device that end on or after the given date"""
+        return self.query_items(
+            Key('device_id').eq(device_id) & Key('end_date').gte(on_or_after),
+            IndexName=DEVICE_ACTIVE_INDEX,
+            FilterExpression=Attr('patient_id').eq(self.patient_id)
+        )
+
+    def list_keys(self, expired_before: str = None):
+        condition = Key('patient_id').eq(self.patient_id)
+        if expired_before is not None:
+            # Sort keys start with end_date; a legacy '#VERSION' row sorts first and is skipped
+            condition = condition & Key('sk').lt(expired_before)
+        items = self.query_items(condition, ProjectionExpression='patient_id, sk')
+        return [{'patient_id': item['patient_id'], 'sk': item['sk']} for item in items]
+
+    def delete_many(self, keys):
+        return batch_delete(self.table, keys)
+
+    def get_version(self) -> int:
+        return self.version_stamp.get()
+
+    def bump_version(self) -> int:
+        return self.version_stamp.bump()
+
+
+def create_partitioned_table(dynamodb, table_name: str = PARTITIONED_TABLE_NAME):
+    """Create the per-patient table and its indexes (on-demand billing)"""
+    logger.info("Creating table %s...", table_name)
+    table = dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[
+            {'AttributeName': 'patient_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'patient_id', 'AttributeType': 'S'},
+            {'AttributeName': 'sk', 'AttributeType': 'S'},
+            {'AttributeName': 'id', 'AttributeType': 'S'},
+            {'AttributeName': 'device_id', 'AttributeType': 'S'},
+            {'AttributeName': 'end_date', 'AttributeType': 'S'}
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': ID_INDEX,
+                'KeySchema': [
+                    {'AttributeName': 'id', 'KeyType': 'HASH'},
+                    {'AttributeName': 'patient_id', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'}
+            },
+            {
+                'IndexName': DEVICE_ACTIVE_INDEX,
+                'KeySchema': [
+                    {'AttributeName': 'device_id', 'KeyType': 'HASH'},
+                    {'AttributeName': 'end_date', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'}
+            }
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    table.wait_until_exists()
+    logger.info("Table %s created", table_name)
+    return table
+
+
+def create_versions_table(dynamodb, table_name: str = VERSIONS_TABLE_NAME):
+    """Create the schedule version stamp table, keyed by store scope (on-demand billing)"""
+    logger.info("Creating table %s...", table_name)
+    table = dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': 'scope', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'scope', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    table.wait_until_exists()
+    logger.info("Table %s created", table_name)
+    return table
+
+
+def migrate_flat_table(dynamodb, source_table: str = FLAT_TABLE_NAME, target_table: str = PARTITIONED_TABLE_NAME,
+                       patient_id: str = DEFAULT_PATIENT_ID, device_id: str = DEFAULT_DEVICE_ID) -> int:
+    """Copy every prescription from the flat table into the per-patient table.
+
+    Items without patient_id/device_id are assigned the given defaults.
+    Re-running is safe: items are written by their full key.
+    """
+    source = FlatPrescriptionStore(dynamodb, source_table)
+    target = dynamodb.Table(target_table)
+    migrated = 0
+    patients = set()
+    with target.batch_writer(overwrite_by_pkeys=['patient_id', 'sk']) as batch:
+        for item in source.load_all():
+            item = dict(item)
+            item.setdefault('patient_id', patient_id)
+            item.setdefault('device_id', device_id)
+            item['sk'] = PartitionedPrescriptionStore.sort_key(item)
+            batch.put_item(Item=item)
+            patients.add(item['patient_id'])
+            migrated += 1
+
+    # Bump each partition's version so every worker's schedule index reloads
+    for partition in patients:
+        PartitionedPrescriptionStore(dynamodb, partition, target_table).bump_version()
+    logger.info("Migrated %d prescriptions from %s to %s", migrated, source_table, target_table)
+    return migrated
+
+
+def open_store(dynamodb, patient_id: str = None):
+    """Return the store selected by PRESCRIPTION_STORE ('flat' or 'partitioned')"""
+    if PRESCRIPTION_STORE == 'partitioned':
+        return PartitionedPrescriptionStore(dynamodb, patient_id or DEFAULT_PATIENT_ID)
+    return FlatPrescriptionStore(dynamodb)
+
+
+if __name__ == '__main__':
+    import boto3
+    from log_config import configure_logging
+
+    configure_logging()
+
+    cli = argparse.ArgumentParser(description='Manage the per-patient prescriptions table')
+    cli.add_argument('command', choices=['create-table', 'create-versions-table', 'migrate'])
+    cli.add_argument('--patient-id', default=DEFAULT_PATIENT_ID)
+    cli.add_argument('--device-id', default=DEFAULT_DEVICE_ID)
+    args = cli.parse_args()
+
+    dynamodb = boto3.resource('dynamodb')
+    if args.command == 'create-table':
+        create_partitioned_table(dynamodb)
+    elif args.command == 'create-versions-table':
+        create_versions_table(dynamodb)
+    else:
+        migrate_flat_table(dynamodb, patient_id=args.patient_id, device_id=args.device_id)
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import threading
+import time
+
+ANTHROPIC_REQUESTS_PER_SECOND = float(os.getenv('ANTHROPIC_REQUESTS_PER_SECOND', '2'))
+ANTHROPIC_BURST = int(os.getenv('ANTHROPIC_BURST', '4'))
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available.
+
+    Threads and event loop tasks can share one bucket through acquire_async().
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens: float):
+        """Take tokens if available; otherwise return the delay until they will be"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return None
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Take tokens, sleeping as needed; returns the time spent waiting"""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            delay = self._take(tokens)
+            if delay is None:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self, tokens: float = 1.0) -> float:
+        """Like acquire, but waits without blocking the event loop"""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            delay = self._take(tokens)
+            if delay is None:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+# Shared by every parser in the process so concurrent batches respect one limit
+anthropic_limiter = TokenBucket(ANTHROPIC_REQUESTS_PER_SECOND, ANTHROPIC_BURST)
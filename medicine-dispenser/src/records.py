@@ -0,0 +1,144 @@
+"""Typed rows for prescriptions and schedules.
+
+DynamoDB items are converted once, in ``PrescriptionRecord.from_item``;
+everything past that boundary works on these slotted records instead of
+nested dicts of Decimals. ``dumps`` is the one JSON serializer for API,
+log and IoT output.
+"""
+import json
+from dataclasses import dataclass
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Optional, Tuple
+
+
+def _number(value):
+    """DynamoDB numbers come back as Decimal; keep integers as int"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+@dataclass(slots=True)
+class TimingRecord:
+    time: str
+    with_food: bool = False
+    special_instructions: Optional[str] = None
+
+    @classmethod
+    def from_item(cls, item: dict):
+        return cls(item.get('time', '00:00'), bool(item.get('with_food', False)),
+                   item.get('special_instructions', ''))
+
+    def to_dict(self):
+        return {'time': self.time, 'with_food': self.with_food, 'special_instructions': self.special_instructions}
+
+
+@dataclass(slots=True)
+class PrescriptionRecord:
+    id: str
+    device_id: Optional[str]
+    created_at: str
+    medication_name: str
+    dosage: str
+    frequency: int
+    timing: Tuple[TimingRecord, ...]
+    start_date: str
+    end_date: str
+    refills: int = 0
+
+    @classmethod
+    def from_item(cls, item: dict):
+        """Convert a DynamoDB item; store-only attributes (keys, version rows) are dropped"""
+        timing = item.get('timing', [])
+        return cls(
+            id=item.get('id'),
+            device_id=item.get('device_id'),
+            created_at=item.get('created_at', ''),
+            medication_name=item.get('medication_name'),
+            dosage=item.get('dosage', 'Unknown'),
+            frequency=_number(item.get('frequency', 0)),
+            timing=tuple(TimingRecord.from_item(t) for t in timing) if isinstance(timing, list) else (),
+            start_date=item.get('start_date', ''),
+            end_date=item.get('end_date', ''),
+            refills=_number(item.get('refills', 0))
+        )
+
+    @classmethod
+    def from_details(cls, prescription, prescription_id: str, device_id: str, created_at: str):
+        """Build a record from parsed PrescriptionDetails"""
+        return cls(
+            id=prescription_id,
+            device_id=device_id,
+            created_at=created_at,
+            medication_name=prescription.medication_name,
+            dosage=prescription.dosage,
+            frequency=prescription.frequency,
+            timing=tuple(TimingRecord(t.time, t.with_food, t.special_instructions) for t in prescription.timing),
+            start_date=prescription.start_date.isoformat(),
+            end_date=prescription.end_date.isoformat(),
+            refills=prescription.refills
+        )
+
+    def to_item(self):
+        """The DynamoDB item for this prescription"""
+        return {
+            'id': self.id,
+            'device_id': self.device_id,
+            'created_at': self.created_at,
+            'medication_name': self.medication_name,
+            'dosage': self.dosage,
+            'frequency': self.frequency,
+            'timing': [timing.to_dict() for timing in self.timing],
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'refills': self.refills
+        }
+
+    to_dict = to_item
+
+
+@dataclass(slots=True)
+class ScheduleItem:
+    """One dose slot; date is set only on multi-day range events"""
+    time: str
+    medication_name: str
+    dosage: str
+    with_food: bool
+    special_instructions: Optional[str]
+    prescription_id: str
+    date: Optional[str] = None
+
+    def on(self, day: str):
+        """This slot as an event on a given date"""
+        return ScheduleItem(self.time, self.medication_name, self.dosage, self.with_food,
+                            self.special_instructions, self.prescription_id, day)
+
+    def to_dict(self):
+        result = {
+            'time': self.time,
+            'medication_name': self.medication_name,
+            'dosage': self.dosage,
+            'with_food': self.with_food,
+            'special_instructions': self.special_instructions,
+            'prescription_id': self.prescription_id
+        }
+        if self.date is not None:
+            result['date'] = self.date
+        return result
+
+
+def _default(obj):
+    to_dict = getattr(obj, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return _number(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> str:
+    """Compact JSON for records, dates and Decimals"""
+    return json.dumps(obj, default=_default, separators=(',', ':'))
@@ -0,0 +1,221 @@
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import List, NamedTuple
+
+import numpy as np
+
+from records import ScheduleItem
+
+SCHEDULE_DAY_CACHE_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+
+def parse_prescription_date(value):
+    """Parse a stored start/end date, accepting YYYY-MM-DD or full ISO format"""
+    try:
+        return datetime.strptime(value or '', '%Y-%m-%d').date()
+    except ValueError:
+        return datetime.fromisoformat(value or '').date()
+
+
+class ScheduleRange(NamedTuple):
+    """Doses from start through end: event i is slots[slot_indices[i]] on start + day_offsets[i].
+
+    Events are ordered by date, then time, then most recent prescription
+    first, the same order as a daily schedule.
+    """
+    version: int
+    start: date
+    end: date
+    day_offsets: np.ndarray
+    slot_indices: np.ndarray
+    slots: List[ScheduleItem]
+
+    def events(self):
+        """Yield each dose as a ScheduleItem with its date set"""
+        span = self.end.toordinal() - self.start.toordinal() + 1
+        days = [(self.start + timedelta(days=offset)).isoformat() for offset in range(span)]
+        for offset, slot_index in zip(self.day_offsets.tolist(), self.slot_indices.tolist()):
+            yield self.slots[slot_index].on(days[offset])
+
+
+class ScheduleIndex:
+    """In-process interval index of prescriptions by date range.
+
+    Each prescription's dates are parsed and its schedule slots built once,
+    when it enters the index. A day's schedule is then a bisect over start
+    dates plus a cached, time-sorted merge of the active prescriptions'
+    slots. Multi-day ranges are expanded over numpy columns of every slot's
+    date span. ``version`` is the table version stamp the index reflects;
+    threads can wait for it to change with ``wait_for_change``.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0.0
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._entries = {}
+        self._by_start = []
+        self._days = OrderedDict()
+        self._columns = None
+
+    def load(self, records, version):
+        """Replace the index contents with a full set of PrescriptionRecords"""
+        with self._lock:
+            self._entries = {}
+            self._by_start = []
+            self._invalidate()
+            for record in records:
+                self._insert(record)
+            self.version = version
+            self._changed.notify_all()
+            logger.info("Schedule index rebuilt with %d prescriptions (version %s)", len(self._entries), version)
+
+    def upsert(self, record):
+        with self._lock:
+            self._remove(record.id)
+            self._insert(record)
+            self._invalidate()
+
+    def remove(self, prescription_id):
+        with self._lock:
+            self._remove(prescription_id)
+            self._invalidate()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._by_start = []
+            self._invalidate()
+
+    def apply_write(self, apply, new_version):
+        """Apply a write made by this process and record its version bump.
+
+        If another worker wrote in between, the index keeps its old version
+        so the next read rebuilds it from the table.
+        """
+        with self._lock:
+            apply(self)
+            if self.version == new_version - 1:
+                self.version = new_version
+                self._changed.notify_all()
+
+    def wait_for_change(self, version, timeout: float):
+        """Block until the index version differs from version or timeout passes; return the current version"""
+        with self._lock:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def snapshot_for(self, day):
+        """Return (version, schedule) for a date, read consistently"""
+        with self._lock:
+            return self.version, self.schedule_for(day)
+
+    def schedule_for(self, day):
+        """Return the time-sorted schedule for a date"""
+        with self._lock:
+            cached = self._days.get(day)
+            if cached is not None:
+                self._days.move_to_end(day)
+                return list(cached)
+
+            active = []
+            upper = bisect.bisect_right(self._by_start, day, key=lambda key: key[0])
+            for _, _, prescription_id in self._by_start[:upper]:
+                entry = self._entries[prescription_id]
+                if day <= entry['end_date']:
+                    active.append(entry)
+
+            # Most recent prescriptions first, then a stable sort by time
+            active.sort(key=lambda entry: entry['created_at'], reverse=True)
+            schedule = [slot for entry in active for slot in entry['slots']]
+            schedule.sort(key=lambda slot: slot.time)
+
+            self._days[day] = schedule
+            if len(self._days) > SCHEDULE_DAY_CACHE_SIZE:
+                self._days.popitem(last=False)
+            return list(schedule)
+
+    def range_for(self, start, end):
+        """Return a ScheduleRange of every dose from start through end (inclusive)"""
+        with self._lock:
+            slots, starts, ends = self._range_columns()
+            first, last = start.toordinal(), end.toordinal()
+            version = self.version
+
+        # Slots live at any point in the range, then a days x slots activity mask;
+        # nonzero() walks it row-major, so events come out by day then slot order
+        candidates = np.flatnonzero((starts <= last) & (ends >= first))
+        days = np.arange(first, last + 1, dtype=np.int32)[:, None]
+        active = (days >= starts[candidates]) & (days <= ends[candidates])
+        day_offsets, columns = np.nonzero(active)
+        return ScheduleRange(version, start, end, day_offsets, candidates[columns], slots)
+
+    def _range_columns(self):
+        """Every slot in daily-schedule order with its first and last day as ordinals"""
+        if self._columns is None:
+            entries = sorted(self._entries.values(), key=lambda entry: entry['created_at'], reverse=True)
+            rows = [(slot, entry) for entry in entries for slot in entry['slots']]
+            rows.sort(key=lambda row: row[0].time)
+            self._columns = (
+                [slot for slot, _ in rows],
+                np.array([entry['start_date'].toordinal() for _, entry in rows], dtype=np.int32),
+                np.array([entry['end_date'].toordinal() for _, entry in rows], dtype=np.int32)
+            )
+        return self._columns
+
+    def _invalidate(self):
+        self._days.clear()
+        self._columns = None
+
+    def _insert(self, record):
+        prescription_id = record.id
+        if prescription_id is None:
+            return
+        try:
+            start_date = parse_prescription_date(record.start_date)
+            end_date = parse_prescription_date(record.end_date)
+        except Exception as e:
+            logger.warning("Skipping prescription %s due to error: %s", prescription_id, e)
+            return
+
+        slots = [
+            ScheduleItem(timing.time, record.medication_name, record.dosage, timing.with_food,
+                         timing.special_instructions, prescription_id)
+            for timing in record.timing
+        ]
+
+        self._entries[prescription_id] = {
+            'start_date': start_date,
+            'end_date': end_date,
+            'created_at': record.created_at,
+            'slots': slots
+        }
+        bisect.insort(self._by_start, (start_date, record.created_at, prescription_id))
+
+    def _remove(self, prescription_id):
+        entry = self._entries.pop(prescription_id, None)
+        if entry is None:
+            return
+        key = (entry['start_date'], entry['created_at'], prescription_id)
+        position = bisect.bisect_left(self._by_start, key)
+        if position < len(self._by_start) and self._by_start[position] == key:
+            del self._by_start[position]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_schedule_index(scope: str = 'default') -> ScheduleIndex:
+    """Process-wide index for a store scope (table, or table and patient)"""
+    index = _indexes.get(scope)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.setdefault(scope, ScheduleIndex())
+    return index
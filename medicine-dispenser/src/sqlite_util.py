@@ -0,0 +1,26 @@
+import os
+import sqlite3
+
+STATE_DIR = os.getenv('STATE_DIR', 'state')
+
+
+def state_path(filename: str) -> str:
+    """Return the path of a local state file, creating STATE_DIR if needed"""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    return os.path.join(STATE_DIR, filename)
+
+
+def connect(path: str, synchronous: str = 'NORMAL') -> sqlite3.Connection:
+    """Open a SQLite database that can be shared by several gunicorn workers.
+
+    NORMAL may lose the last commits on power loss (never on a process
+    crash); pass synchronous='FULL' where a commit is a promise to the caller.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={synchronous}')
+    conn.execute('PRAGMA busy_timeout=30000')
+    return conn
@@ -0,0 +1,129 @@
+"""HTTP behaviour of the Flask app against moto: schedule ETags, long-poll arguments and batch limits."""
+import io
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-west-2',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'STATE_DIR': tempfile.mkdtemp(prefix='test_app_'),
+    'OUTBOX_LINGER_SECONDS': '3600',
+})
+os.environ.pop('AWS_ENDPOINT_URL', None)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from moto import mock_aws  # noqa: E402
+
+from app import app  # noqa: E402
+from clients import clients  # noqa: E402
+from image_pipeline import MAX_UPLOAD_BYTES  # noqa: E402
+from prescription_handler import PrescriptionHandler, get_outbox  # noqa: E402
+from prescription_parser import PrescriptionDetails  # noqa: E402
+from prescription_store import FLAT_TABLE_NAME, create_versions_table  # noqa: E402
+
+DAY = '2024-12-15'
+
+
+class AppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        clients.reset()
+        clients.dynamodb().create_table(
+            TableName=FLAT_TABLE_NAME,
+            KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        create_versions_table(clients.dynamodb())
+        self.client = app.test_client()
+
+    def tearDown(self):
+        get_outbox().flush()
+        clients.reset()
+        self.mock.stop()
+
+
+class UpcomingAlarmsTest(AppTestCase):
+    def alarms(self, etag=None, **args):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get('/upcoming-alarms', query_string=dict(date=DAY, **args), headers=headers)
+
+    def test_unchanged_schedule_is_304_until_a_write_lands(self):
+        first = self.alarms()
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers['ETag']
+        self.assertEqual(self.alarms(etag).status_code, 304)
+        self.assertEqual(self.alarms(etag, wait='0.05').status_code, 304)
+
+        handler = PrescriptionHandler()
+        handler.save_prescription(PrescriptionDetails(
+            medication_name='Amoxicillin', dosage='500mg', frequency=1,
+            timing=[{'time': '09:00', 'with_food': True}],
+            start_date='2024-12-11', end_date='2024-12-18'
+        ))
+        get_outbox().flush()
+        changed = self.alarms(etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+        self.assertEqual(len(changed.get_json()['a']), 1)
+
+    def test_wait_must_be_a_finite_number(self):
+        for value in ('abc', '', 'nan', 'inf', '1e999'):
+            with self.subTest(wait=value):
+                response = self.alarms(wait=value)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('wait', response.get_json()['error'])
+
+    def test_bad_date_is_400(self):
+        self.assertEqual(self.client.get('/upcoming-alarms?date=2024-13-45').status_code, 400)
+
+
+class BatchUploadLimitsTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('app.process_prescription_batch',
+                             side_effect=lambda images, **ids: {'saved': len(images), 'failed': 0, 'results': []})
+        self.process = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def archive(*sizes):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+            for index, size in enumerate(sizes):
+                archive.writestr(f"rx{index}.jpg", os.urandom(size))
+        return buffer.getvalue()
+
+    def upload(self, *parts):
+        data = {'prescriptions': [(io.BytesIO(body), name) for name, body in parts]}
+        return self.client.post('/upload-prescriptions', data=data, content_type='multipart/form-data')
+
+    def test_zip_larger_than_one_image_is_accepted(self):
+        archive = self.archive(6 * 1024 * 1024, 6 * 1024 * 1024)
+        self.assertGreater(len(archive), MAX_UPLOAD_BYTES)
+        response = self.upload(('scans.zip', archive), ('loose.jpg', b'\xff\xd8' + os.urandom(1024)))
+        self.assertEqual(response.status_code, 200, response.get_json())
+        images = self.process.call_args.args[0]
+        self.assertEqual([name for name, _ in images], ['scans.zip/rx0.jpg', 'scans.zip/rx1.jpg', 'loose.jpg'])
+
+    def test_zip_is_detected_by_content_without_the_extension(self):
+        response = self.upload(('upload.bin', self.archive(MAX_UPLOAD_BYTES // 2, MAX_UPLOAD_BYTES // 2 + 1024)))
+        self.assertEqual(response.status_code, 200, response.get_json())
+        self.assertEqual(len(self.process.call_args.args[0]), 2)
+
+    def test_plain_image_and_zip_member_keep_the_per_image_limit(self):
+        response = self.upload(('huge.jpg', b'\xff\xd8' + bytes(MAX_UPLOAD_BYTES)))
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('huge.jpg', response.get_json()['error'])
+        self.assertEqual(self.upload(('scans.zip', self.archive(MAX_UPLOAD_BYTES + 1))).status_code, 413)
+        self.process.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
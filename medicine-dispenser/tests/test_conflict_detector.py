@@ -0,0 +1,68 @@
+"""Both conflict detector paths against the original pairwise check, fixed to wrap around midnight."""
+import os
+import random
+import sys
+import unittest
+from collections import Counter
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import conflict_detector  # noqa: E402
+from conflict_detector import MINUTES_PER_DAY, find_timing_conflicts, timing_to_minutes  # noqa: E402
+
+
+def pairwise_conflicts(prescriptions, window):
+    conflicts = []
+    for i, p1 in enumerate(prescriptions):
+        for p2 in prescriptions[i + 1:]:
+            for t1 in p1['timing']:
+                for t2 in p2['timing']:
+                    distance = abs(timing_to_minutes(t1['time']) - timing_to_minutes(t2['time']))
+                    distance = min(distance, MINUTES_PER_DAY - distance)
+                    if distance < window:
+                        conflicts.append((p1['medication_name'], p2['medication_name'], t1['time'], t2['time'], distance))
+    return Counter(conflicts)
+
+
+def as_counter(conflicts):
+    return Counter((c['medication1'], c['medication2'], c['time1'], c['time2'], c['time_difference_minutes'])
+                   for c in conflicts)
+
+
+def prescription(name, *times):
+    return {'medication_name': name, 'timing': [{'time': value} for value in times]}
+
+
+def random_prescriptions(rng, count):
+    # A coarse grid of times, so equal minutes and midnight neighbours are common
+    slots = [f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(0, MINUTES_PER_DAY, 20)]
+    return [prescription(f"Medication {i}", *rng.sample(slots, rng.randint(1, 4))) for i in range(count)]
+
+
+class FindTimingConflictsTest(unittest.TestCase):
+    def check(self, prescriptions, window=30):
+        expected = pairwise_conflicts(prescriptions, window)
+        self.assertEqual(as_counter(find_timing_conflicts(prescriptions, window)), expected)
+        with mock.patch.object(conflict_detector, 'VECTORIZE_THRESHOLD', 0):
+            self.assertEqual(as_counter(find_timing_conflicts(prescriptions, window)), expected)
+
+    def test_same_minute_reported_once(self):
+        prescriptions = [prescription('Amoxicillin', '09:00'), prescription('Ibuprofen', '09:00')]
+        self.assertEqual(len(find_timing_conflicts(prescriptions)), 1)
+        self.check(prescriptions)
+
+    def test_every_dose_within_window(self):
+        self.check([prescription('A', '09:00', '09:10'), prescription('B', '09:05'), prescription('C', '09:00')])
+
+    def test_across_midnight(self):
+        self.check([prescription('A', '23:50'), prescription('B', '00:10'), prescription('C', '12:00')])
+
+    def test_random_against_pairwise(self):
+        rng = random.Random(8)
+        for _ in range(300):
+            self.check(random_prescriptions(rng, rng.randint(0, 8)), window=rng.choice([1, 20, 30, 90, 720]))
+
+
+if __name__ == '__main__':
+    unittest.main()
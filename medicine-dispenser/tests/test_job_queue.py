@@ -0,0 +1,122 @@
+"""Job lifecycle, recovery of jobs left by exited workers, and expiry in the JobStore."""
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+os.environ['STATE_DIR'] = tempfile.mkdtemp(prefix='test_job_queue_')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import job_queue  # noqa: E402
+from job_queue import JobQueue, JobStore, QueueFullError  # noqa: E402
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+class JobStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='jobs_'), 'jobs.db')
+
+    def wait_for(self, queue, job_id, status, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = queue.get(job_id)
+            if job['status'] == status:
+                return job
+            time.sleep(0.01)
+        self.fail(f"job {job_id} is {queue.get(job_id)['status']}, not {status}")
+
+
+class JobLifecycleTest(JobStoreTestCase):
+    def test_success_and_failure(self):
+        def handler(value):
+            if value < 0:
+                raise ValueError('negative')
+            return {'doubled': value * 2}
+
+        queue = JobQueue(handler, workers=1, store=JobStore(self.path))
+        succeeded = self.wait_for(queue, queue.submit(21), 'succeeded')
+        self.assertEqual(succeeded['result'], {'doubled': 42})
+        failed = self.wait_for(queue, queue.submit(-1), 'failed')
+        self.assertEqual(failed['error'], 'negative')
+        self.assertIsNone(queue.get('missing'))
+
+    def test_full_queue_rejects_and_records_the_job(self):
+        release = threading.Event()
+        queue = JobQueue(lambda: release.wait(5), workers=1, max_queue=1, store=JobStore(self.path))
+        running = queue.submit()
+        self.wait_for(queue, running, 'running')
+        queue.submit()
+        with self.assertRaises(QueueFullError):
+            queue.submit()
+        statuses = [row[0] for row in queue.store._conn.execute('SELECT status FROM jobs ORDER BY created_at')]
+        self.assertEqual(statuses, ['running', 'queued', 'failed'])
+        release.set()
+
+    def test_store_is_opened_on_first_use(self):
+        os.environ['JOB_DB_PATH'] = self.path
+        try:
+            queue = JobQueue(lambda: None, workers=1)
+            self.assertFalse(os.path.exists(self.path))
+            self.wait_for(queue, queue.submit(), 'succeeded')
+            self.assertTrue(os.path.exists(self.path))
+        finally:
+            del os.environ['JOB_DB_PATH']
+
+
+class RecoveryTest(JobStoreTestCase):
+    def insert(self, store, job_id, status, owner_pid, updated_at=None):
+        now = time.time() if updated_at is None else updated_at
+        store._conn.execute(
+            'INSERT INTO jobs (id, status, created_at, updated_at, owner_pid) VALUES (?, ?, ?, ?, ?)',
+            (job_id, status, now, now, owner_pid)
+        )
+
+    def test_unfinished_jobs_of_exited_workers_fail_on_open(self):
+        store = JobStore(self.path)
+        self.insert(store, 'dead-queued', 'queued', exited_pid())
+        self.insert(store, 'dead-running', 'running', exited_pid())
+        self.insert(store, 'own-pid', 'queued', os.getpid())
+        self.insert(store, 'unowned', 'running', None)
+        self.insert(store, 'live', 'queued', os.getppid())
+        self.insert(store, 'done', 'succeeded', exited_pid())
+
+        reopened = JobStore(self.path)
+        for job_id in ('dead-queued', 'dead-running', 'own-pid', 'unowned'):
+            job = reopened.get(job_id)
+            self.assertEqual(job['status'], 'failed', job_id)
+            self.assertEqual(job['error'], 'Worker exited before the job finished')
+        self.assertEqual(reopened.get('live')['status'], 'queued')
+        self.assertEqual(reopened.get('done')['status'], 'succeeded')
+
+    def test_expiry_covers_unfinished_jobs(self):
+        store = JobStore(self.path)
+        stale = time.time() - job_queue.JOB_TTL_SECONDS - 1
+        self.insert(store, 'stale-queued', 'queued', os.getppid(), stale)
+        self.insert(store, 'stale-done', 'succeeded', os.getppid(), stale)
+        self.insert(store, 'fresh', 'queued', os.getppid())
+        store.create('new')
+        self.assertIsNone(store.get('stale-queued'))
+        self.assertIsNone(store.get('stale-done'))
+        self.assertEqual(store.get('fresh')['status'], 'queued')
+
+    def test_existing_database_gains_owner_column(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("""CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL, result TEXT, error TEXT)""")
+        conn.execute("INSERT INTO jobs VALUES ('old', 'running', 0, ?, NULL, NULL)", (time.time(),))
+        conn.commit()
+        conn.close()
+        self.assertEqual(JobStore(self.path).get('old')['status'], 'failed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+"""Outbox delivery order and retries, against a temporary SQLite file."""
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# Same settings as the other outbox tests, whichever module imports outbox first
+os.environ.update({
+    'STATE_DIR': tempfile.mkdtemp(prefix='test_outbox_'),
+    'OUTBOX_LINGER_SECONDS': '3600',
+})
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import outbox as outbox_module  # noqa: E402
+from device_config import DeviceConfigPublisher, set_alarms_operation, sync_operation  # noqa: E402
+from outbox import Outbox  # noqa: E402
+
+
+class Deliverer:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+
+    def __call__(self, target, payloads):
+        self.calls.append((target, payloads))
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('unavailable')
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def outbox(self, **deliverers):
+        # A long linger keeps the background flusher out of the way; the tests flush themselves
+        return Outbox(deliverers, path=os.path.join(self.dir.name, 'outbox.db'), linger_seconds=3600)
+
+    def test_each_target_delivered_in_append_order(self):
+        deliver = Deliverer()
+        box = self.outbox(writes=deliver)
+        box.append([('writes', 'a', 1), ('writes', 'b', 1)])
+        box.append([('writes', 'a', 2)])
+        box.append([('writes', 'b', 2), ('writes', 'a', 3)])
+
+        self.assertEqual(box.flush(), 5)
+        self.assertEqual(sorted(deliver.calls), [('a', [1, 2, 3]), ('b', [1, 2])])
+        self.assertEqual(box.depth(), 0)
+
+    def test_failed_group_is_retried_after_backoff_and_blocks_later_entries(self):
+        deliver = Deliverer(failures=1)
+        box = self.outbox(writes=deliver)
+        box.append([('writes', 'a', 1), ('writes', 'a', 2)])
+
+        with mock.patch.object(outbox_module, 'retry_delay', return_value=0.05):
+            self.assertEqual(box.flush(), 0)
+        box.append([('writes', 'a', 3)])
+        # Backing off: neither the failed entries nor the one behind them are ready
+        self.assertEqual(box.flush(), 0)
+        self.assertEqual(box.pending('writes', 'a'), [1, 2, 3])
+
+        time.sleep(0.1)
+        self.assertEqual(box.flush(), 3)
+        self.assertEqual(deliver.calls, [('a', [1, 2]), ('a', [1, 2, 3])])
+
+    def test_failure_of_one_target_does_not_hold_back_another(self):
+        deliver_a = Deliverer(failures=1)
+        deliver_b = Deliverer()
+        box = self.outbox(a=deliver_a, b=deliver_b)
+        box.append([('a', 'x', 1), ('b', 'x', 1)])
+
+        self.assertEqual(box.flush(), 1)
+        self.assertEqual(deliver_b.calls, [('x', [1])])
+        self.assertEqual(box.pending('a', 'x'), [1])
+
+
+class FlakyIoT:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.published = []
+
+    def publish(self, topic, qos, payload):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('unavailable')
+        self.published.append(payload)
+
+
+class DeviceConfigRetryTest(unittest.TestCase):
+    def test_redelivered_operations_send_the_committed_message(self):
+        with tempfile.TemporaryDirectory() as directory:
+            iot = FlakyIoT(failures=1)
+            publisher = DeviceConfigPublisher(iot, path=os.path.join(directory, 'device.db'))
+            alarms = [{'medication_name': 'Ibuprofen', 'dosage': '200mg', 'time': '09:00', 'with_food': True}]
+            operations = [set_alarms_operation('PRESC_1', alarms)]
+
+            with self.assertRaises(RuntimeError):
+                publisher.publish_operations('device', operations)
+            # The outbox redelivers the same operations: nothing new to change, the lost message still goes out
+            self.assertIsNone(publisher.publish_operations('device', operations))
+            self.assertEqual(len(iot.published), 1)
+            self.assertIn('"v":1,"b":0', iot.published[0])
+
+
+def alarm(time, name='Ibuprofen'):
+    return {'medication_name': name, 'dosage': '200mg', 'time': time, 'with_food': True}
+
+
+class DeviceConfigTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.iot = FlakyIoT()
+        self.publisher = DeviceConfigPublisher(self.iot, path=os.path.join(directory.name, 'device.db'))
+
+    def publish(self, *operations):
+        payload = self.publisher.publish_operations('device', list(operations))
+        return None if payload is None else json.loads(payload)
+
+    def test_two_doses_at_the_same_minute_are_two_alarms(self):
+        message = self.publish(set_alarms_operation('PRESC_1', [alarm('09:00'), alarm('09:00')]))
+        self.assertEqual([row[0] for row in message['add']], [1, 2])
+
+    def test_new_time_for_a_dose_is_a_change(self):
+        self.publish(set_alarms_operation('PRESC_1', [alarm('09:00'), alarm('21:00')]))
+        message = self.publish(set_alarms_operation('PRESC_1', [alarm('08:00'), alarm('21:00')]))
+        self.assertEqual(message['b'], 1)
+        self.assertEqual([row[:2] for row in message['chg']], [[1, 8 * 60]])
+        self.assertNotIn('add', message)
+        self.assertNotIn('del', message)
+
+    def test_sync_sends_a_full_config_keeping_alarm_ids(self):
+        self.publish(set_alarms_operation('PRESC_1', [alarm('09:00')]),
+                     set_alarms_operation('PRESC_2', [alarm('12:00', 'Amoxicillin')]))
+        message = self.publish(sync_operation({'PRESC_1': [alarm('09:00')]}))
+        self.assertEqual(message['v'], 2)
+        self.assertNotIn('b', message)
+        self.assertEqual([row[:2] for row in message['add']], [[1, 9 * 60]])
+
+        # Unchanged, but the device asked: it still gets the full config
+        message = self.publish(sync_operation({'PRESC_1': [alarm('09:00')]}))
+        self.assertEqual(message['v'], 3)
+        self.assertEqual(len(self.iot.published), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
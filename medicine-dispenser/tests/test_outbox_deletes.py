@@ -0,0 +1,147 @@
+"""Deletes of prescriptions still in the write-behind outbox (moto, no flusher until flush())."""
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-west-2',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'STATE_DIR': tempfile.mkdtemp(prefix='test_outbox_'),
+    # Keep the background flusher from delivering before the test flushes
+    'OUTBOX_LINGER_SECONDS': '3600',
+})
+os.environ.pop('AWS_ENDPOINT_URL', None)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from moto import mock_aws  # noqa: E402
+
+from clients import clients  # noqa: E402
+from device_config import get_device_publisher  # noqa: E402
+from prescription_handler import SCHEDULE_VERSION_TTL, PrescriptionHandler, get_outbox  # noqa: E402
+from prescription_parser import PrescriptionDetails  # noqa: E402
+from prescription_store import FLAT_TABLE_NAME, create_versions_table  # noqa: E402
+
+
+def prescription(name, end_date='2024-12-18'):
+    return PrescriptionDetails(
+        medication_name=name, dosage='500mg', frequency=1,
+        timing=[{'time': '09:00', 'with_food': True}],
+        start_date='2024-12-11', end_date=end_date
+    )
+
+
+class QueuedDeleteTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        clients.reset()
+        clients.dynamodb().create_table(
+            TableName=FLAT_TABLE_NAME,
+            KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        create_versions_table(clients.dynamodb())
+        self.handler = PrescriptionHandler()
+
+    def tearDown(self):
+        get_outbox().flush()
+        clients.reset()
+        self.mock.stop()
+
+    def table_ids(self):
+        return sorted(item['id'] for item in self.handler.store.load_all())
+
+    def schedule_names(self):
+        self.handler.refresh_schedule_index(force=True)
+        return [slot.medication_name for slot in self.handler.get_daily_schedule('2024-12-15')]
+
+    def test_cleanup_all_before_flush_keeps_only_the_latest_upload(self):
+        self.handler.save_prescription(prescription('Amoxicillin'))
+        self.handler.cleanup_old_prescriptions()
+        latest = self.handler.save_prescription(prescription('Ibuprofen'))
+        self.assertEqual(self.schedule_names(), ['Ibuprofen'])
+
+        get_outbox().flush()
+        self.assertEqual(self.table_ids(), [latest])
+        self.assertEqual(self.schedule_names(), ['Ibuprofen'])
+
+    def test_retention_cleanup_before_flush_removes_only_expired(self):
+        self.handler.save_prescription(prescription('Amoxicillin', end_date='2000-01-31'))
+        current = self.handler.save_prescription(prescription('Ibuprofen', end_date='2999-12-31'))
+        result = self.handler.cleanup_old_prescriptions(retention_days=30)
+        self.assertEqual(result['deleted'], 1)
+
+        get_outbox().flush()
+        self.assertEqual(self.table_ids(), [current])
+
+    def test_delete_before_flush(self):
+        deleted = self.handler.save_prescription(prescription('Amoxicillin'))
+        kept = self.handler.save_prescription(prescription('Ibuprofen'))
+        self.handler.delete_prescription(deleted)
+        self.assertEqual(self.schedule_names(), ['Ibuprofen'])
+
+        get_outbox().flush()
+        self.assertEqual(self.table_ids(), [kept])
+        self.assertIsNone(self.handler.get_prescription(deleted))
+
+    def test_delete_after_flush(self):
+        deleted = self.handler.save_prescription(prescription('Amoxicillin'))
+        get_outbox().flush()
+        self.handler.delete_prescription(deleted)
+        # Queued, not yet deleted from the table
+        self.assertEqual(self.table_ids(), [deleted])
+        self.assertIsNone(self.handler.get_prescription(deleted))
+
+        get_outbox().flush()
+        self.assertEqual(self.table_ids(), [])
+
+    def test_cleanup_leaves_table_writes_to_the_flusher(self):
+        saved = self.handler.save_prescription(prescription('Amoxicillin'))
+        get_outbox().flush()
+        version = self.handler.store.get_version()
+        self.assertEqual(self.handler.cleanup_old_prescriptions()['deleted'], 1)
+        self.assertEqual(self.table_ids(), [saved])
+        self.assertEqual(self.handler.store.get_version(), version)
+        self.assertEqual(self.schedule_names(), [])
+
+        get_outbox().flush()
+        self.assertEqual(self.table_ids(), [])
+        self.assertEqual(self.handler.store.get_version(), version + 1)
+
+    def test_resync_sends_full_config_for_active_prescriptions(self):
+        publisher = get_device_publisher(clients.iot_data())
+        with mock.patch.object(publisher.iot, 'publish') as publish:
+            self.handler.save_prescription(prescription('Amoxicillin', end_date='2000-01-31'))
+            get_outbox().flush()
+            self.handler.save_prescription(prescription('Ibuprofen', end_date='2999-12-31'))
+            self.assertEqual(self.handler.resync_device(), 1)
+            get_outbox().flush()
+
+        full = json.loads(publish.call_args_list[-1].kwargs['payload'])
+        self.assertNotIn('b', full)
+        self.assertEqual(full['s'][full['add'][0][2]], 'Ibuprofen')
+        self.assertEqual(len(full['add']), 1)
+
+    def test_version_stamp_is_reread_only_after_the_ttl(self):
+        self.handler.refresh_schedule_index(force=True)
+        with mock.patch.object(self.handler.store.version_stamp, 'get', return_value=0) as get_version:
+            for _ in range(5):
+                self.handler.schedule_version()
+            self.assertEqual(get_version.call_count, 0)
+            self.handler.schedule_index.checked_at -= SCHEDULE_VERSION_TTL
+            self.handler.schedule_version()
+            self.assertEqual(get_version.call_count, 1)
+
+    def test_get_prescription_sees_queued_put(self):
+        saved = self.handler.save_prescription(prescription('Amoxicillin'))
+        self.assertEqual(self.table_ids(), [])
+        self.assertEqual(self.handler.get_prescription(saved).medication_name, 'Amoxicillin')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Parse cache hits and misses, copy-on-read, and keys tied to the model and prompt."""
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+os.environ.update({
+    'STATE_DIR': tempfile.mkdtemp(prefix='test_parse_cache_'),
+    'ANTHROPIC_API_KEY': 'testing',
+    'ANTHROPIC_REQUESTS_PER_SECOND': '0',
+})
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from PIL import Image  # noqa: E402
+
+from clients import clients  # noqa: E402
+from parse_cache import ParseCache, image_cache_key  # noqa: E402
+from prescription_parser import PrescriptionDetails, PrescriptionParser  # noqa: E402
+
+ANSWER = ('{"medication_name": "Paracetamol", "dosage": "500mg", "frequency": 1, '
+          '"timing": [{"time": "09:00", "with_food": true}], '
+          '"start_date": "2024-12-11", "end_date": "2024-12-16", "refills": 0}')
+
+
+def prescription():
+    return PrescriptionDetails.model_validate_json(ANSWER)
+
+
+class StubMessages:
+    def __init__(self):
+        self.requests = []
+
+    def create(self, **request):
+        self.requests.append(request)
+        return SimpleNamespace(content=[SimpleNamespace(type='text', text=ANSWER)])
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='parse_cache_'), 'parse_cache.db')
+
+    def test_miss_then_memory_then_disk_hit(self):
+        cache = ParseCache(self.path)
+        self.assertIsNone(cache.get('key', PrescriptionDetails))
+        cache.put('key', prescription())
+        self.assertEqual(cache.get('key', PrescriptionDetails), prescription())
+        self.assertEqual(ParseCache(self.path).get('key', PrescriptionDetails), prescription())
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['memory_hits'], 1)
+
+    def test_callers_cannot_change_cached_results(self):
+        cache = ParseCache(self.path)
+        stored = prescription()
+        cache.put('key', stored)
+        stored.timing[0].time = '23:00'
+
+        hit = cache.get('key', PrescriptionDetails)
+        self.assertEqual(hit.timing[0].time, '09:00')
+        hit.dosage = '1g'
+        hit.timing.append(hit.timing[0])
+        self.assertEqual(cache.get('key', PrescriptionDetails), prescription())
+
+
+class ParserCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.messages = StubMessages()
+        clients.override('anthropic', SimpleNamespace(messages=self.messages))
+        self.addCleanup(clients.reset)
+        self.image = Image.new('RGB', (64, 48), (240, 240, 240))
+        self.image_key = image_cache_key(self.image)
+        self.cache = ParseCache(os.path.join(tempfile.mkdtemp(prefix='parse_cache_'), 'parse_cache.db'))
+
+    def parser(self, **attributes):
+        parser = PrescriptionParser()
+        parser.cache = self.cache
+        for name, value in attributes.items():
+            setattr(parser, name, value)
+        return parser
+
+    def parse(self, parser):
+        return parser.parse_prescription('unused', cache_key=self.image_key, image=self.image)
+
+    def test_same_image_hits_the_cache(self):
+        self.assertEqual(self.parse(self.parser()), prescription())
+        self.assertEqual(self.parse(self.parser()), prescription())
+        self.assertEqual(len(self.messages.requests), 1)
+
+    def test_new_prompt_version_or_model_misses(self):
+        self.parse(self.parser())
+        self.parse(self.parser(prompt_version=PrescriptionParser.prompt_version + 1))
+        self.parse(self.parser(model='claude-3-5-haiku-20241022'))
+        self.assertEqual(len(self.messages.requests), 3)
+        self.assertEqual(self.messages.requests[2]['model'], 'claude-3-5-haiku-20241022')
+        # The original parser's entry is still there
+        self.parse(self.parser())
+        self.assertEqual(len(self.messages.requests), 3)
+
+    def test_new_prompt_text_misses(self):
+        class Reworded(PrescriptionParser):
+            def format_prompt(self):
+                return super().format_prompt() + "\nReturn dates as YYYY-MM-DD."
+
+        self.parse(self.parser())
+        reworded = Reworded()
+        reworded.cache = self.cache
+        self.parse(reworded)
+        self.assertEqual(len(self.messages.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Per-patient store lookups against moto: id lookups and device queries stay inside one patient."""
+import os
+import sys
+import unittest
+
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-west-2',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+})
+os.environ.pop('AWS_ENDPOINT_URL', None)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+from prescription_store import (FlatPrescriptionStore, PartitionedPrescriptionStore,  # noqa: E402
+                                create_partitioned_table, create_versions_table)
+
+
+def item(prescription_id, device_id='dispenser-1', end_date='2999-12-31'):
+    return {'id': prescription_id, 'device_id': device_id, 'medication_name': prescription_id,
+            'start_date': '2024-12-11', 'end_date': end_date, 'timing': []}
+
+
+class PartitionedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        dynamodb = boto3.resource('dynamodb')
+        create_partitioned_table(dynamodb)
+        create_versions_table(dynamodb)
+        self.alice = PartitionedPrescriptionStore(dynamodb, 'alice')
+        self.bob = PartitionedPrescriptionStore(dynamodb, 'bob')
+
+    def test_get_and_key_for_id_only_see_the_patients_own_prescriptions(self):
+        self.alice.put(item('PRESC_A'))
+        self.assertEqual(self.alice.get('PRESC_A')['patient_id'], 'alice')
+        self.assertEqual(self.alice.key_for_id('PRESC_A')['patient_id'], 'alice')
+        self.assertIsNone(self.bob.get('PRESC_A'))
+        self.assertIsNone(self.bob.key_for_id('PRESC_A'))
+
+    def test_load_device_active(self):
+        self.alice.put_many([
+            item('PRESC_CURRENT'),
+            item('PRESC_ENDED', end_date='2000-01-31'),
+            item('PRESC_OTHER_DEVICE', device_id='dispenser-2'),
+        ])
+        self.bob.put(item('PRESC_BOB'))
+        active = self.alice.load_device_active('dispenser-1', '2024-12-15')
+        self.assertEqual([found['id'] for found in active], ['PRESC_CURRENT'])
+
+    def test_version_stamps_are_per_patient_and_outside_the_data(self):
+        self.alice.put(item('PRESC_A'))
+        self.assertEqual(self.alice.bump_version(), 1)
+        self.assertEqual(self.alice.bump_version(), 2)
+        self.assertEqual(self.bob.get_version(), 0)
+        self.assertEqual([found['id'] for found in self.alice.load_all()], ['PRESC_A'])
+        self.assertEqual(len(self.alice.list_keys()), 1)
+
+
+class FlatStoreTest(unittest.TestCase):
+    def test_version_stamp_is_not_a_row_in_the_prescriptions_table(self):
+        with mock_aws():
+            dynamodb = boto3.resource('dynamodb')
+            dynamodb.create_table(
+                TableName='Prescriptions', BillingMode='PAY_PER_REQUEST',
+                KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}]
+            )
+            create_versions_table(dynamodb)
+            store = FlatPrescriptionStore(dynamodb, 'Prescriptions')
+            store.bump_version()
+            self.assertEqual(store.get_version(), 1)
+            self.assertEqual(dynamodb.Table('Prescriptions').scan()['Items'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()